@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Conversation scripts replayed by `benchmarks.load`. Each script has two forms:
+
+- `webhook`: the webhook calls Dialogflow CX makes during the conversation, in order. Every step
+  names the tag, the user's message and the form parameters Dialogflow fills at that point; the
+  parameters returned by earlier steps are merged into the session like Dialogflow does.
+- `chat`: the messages the citizen sends to `/chat/ascsac/`, which go through Dialogflow itself.
+
+The data matches the tables in `benchmarks.upstreams`, so every script runs to the end against
+`benchmarks.simulator`.
+"""
+from typing import List
+
+CPF = "529.982.247-25"
+EMAIL = "cidadao@exemplo.com.br"
+
+
+def step(tag: str, text: str, page: str, **parameters) -> dict:
+    return {"tag": tag, "text": text, "page": page, "parameters": parameters}
+
+
+def identify_citizen() -> List[dict]:
+    return [
+        step("validador_cpf", CPF, "Coletar CPF", usuario_cpf=CPF),
+        step("validador_email", EMAIL, "Coletar E-mail", usuario_email=EMAIL),
+        step("confirma_email", EMAIL, "Confirmar E-mail"),
+    ]
+
+
+def locate_address(address: str, reference: str) -> List[dict]:
+    return [
+        step("localizador", address, "Coletar Endereço", logradouro_nome=address),
+        step(
+            "identificador_ipp",
+            "sim",
+            "Identificar Endereço IPP",
+            logradouro_numero=address.split()[-1],
+            logradouro_ponto_referencia=reference,
+        ),
+    ]
+
+
+def add_rebi_item(message: str, name: str, quantity: float) -> List[dict]:
+    return [
+        step("rebi_checa_item_duplicado", message, "Coletar Itens"),
+        step(
+            "rebi_tratador_lista_itens",
+            message,
+            "Coletar Itens",
+            rebi_material_nome=name,
+            rebi_material_quantidade=quantity,
+        ),
+        step("rebi_avaliador_combinacoes_itens", message, "Avaliar Itens"),
+        step("rebi_confirma_adicao_itens", "sim", "Confirmar Itens"),
+    ]
+
+
+CONVERSATIONS = [
+    {
+        "name": "chamado_com_geolocalizacao",
+        "weight": 6,
+        "webhook": [
+            *identify_citizen(),
+            *locate_address("rua conde de bonfim 500", "Em frente à praça"),
+            step(
+                "abrir_chamado_sgrc",
+                "sim",
+                "Abrir Chamado",
+                codigo_servico_1746="1647",
+                servico_1746_descricao="Entulho deixado na calçada há uma semana",
+            ),
+        ],
+        "chat": [
+            "Oi",
+            "Quero reclamar de entulho na calçada",
+            CPF,
+            EMAIL,
+            "Rua Conde de Bonfim, 500",
+            "sim",
+            "Em frente à praça",
+            "Entulho deixado na calçada há uma semana",
+            "sim",
+        ],
+    },
+    {
+        "name": "rebi_coleta_itens",
+        "weight": 3,
+        "webhook": [
+            *identify_citizen(),
+            step("rebi_elegibilidade_abertura_chamado", "sim", "Elegibilidade"),
+            *locate_address("rua conde de bonfim 500", "Portão azul"),
+            step("rebi_elegibilidade_endereco_abertura_chamado", "sim", "Elegibilidade Endereço"),
+            *add_rebi_item("uma cama de casal", "cama de casal", 1.0),
+            *add_rebi_item("2 cadeiras", "cadeiras/bancos", 2.0),
+            *add_rebi_item("um aspirador de pó", "aspirador de pó", 1.0),
+            step(
+                "abrir_chamado_sgrc",
+                "sim",
+                "Abrir Chamado",
+                codigo_servico_1746="1607",
+                servico_1746_descricao="",
+                endereco_tipo="Casa",
+                endereco_complemento="casa 2",
+                rebi_informacoes_complementares="Itens no portão",
+            ),
+        ],
+        "chat": [
+            "Oi",
+            "Quero remover móveis velhos",
+            CPF,
+            EMAIL,
+            "Rua Conde de Bonfim, 500",
+            "sim",
+            "uma cama de casal",
+            "sim",
+            "2 cadeiras",
+            "sim",
+            "um aspirador de pó",
+            "não",
+            "Casa",
+            "casa 2",
+            "Itens no portão",
+            "sim",
+        ],
+    },
+    {
+        "name": "consulta_debitos",
+        "weight": 1,
+        "webhook": [
+            *identify_citizen(),
+            step(
+                "da_consulta_debitos_contribuinte",
+                "01234567",
+                "Consultar Débitos",
+                da1_tipo_de_consulta="Inscrição Imobiliária",
+                codigo_inscricao_imobiliaria="01234567",
+            ),
+            step(
+                "da_consulta_debitos_contribuinte",
+                CPF,
+                "Consultar Débitos",
+                da1_tipo_de_consulta="CPF/CNPJ",
+                cpf_cnpj_contribuinte="52998224725",
+            ),
+        ],
+        "chat": [
+            "Oi",
+            "Quero consultar minhas dívidas ativas",
+            CPF,
+            EMAIL,
+            "Inscrição Imobiliária",
+            "01234567",
+            "CPF/CNPJ",
+            CPF,
+        ],
+    },
+]
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of a running service. Virtual users replay the conversation scripts in
+`benchmarks.conversations` against `/webhook/` (as Dialogflow CX would call it) and
+`/chat/ascsac/`, one request after the other, while the number of users ramps up stage by
+stage. Every stage reports, per endpoint, throughput, latency percentiles and error rates, as
+well as the event loop lag of the load generator and of the service.
+
+    python -m benchmarks.load --url http://localhost:8080 --token $TOKEN --stages 10,25,50,100
+
+Point the service at `benchmarks.simulator` (or at staging upstreams) first: the webhook
+scripts only run to the end against the data the simulator serves. `/chat/ascsac/` goes through
+Dialogflow CX, so only load it on an agent environment meant for it, with `--endpoints chat`.
+
+The service lag is read from `event_loop_lag_seconds` on `/metrics/` before and after each
+stage. With several uvicorn workers the two readings may come from different workers, in which
+case it is not reported; size a single worker first, then scale out.
+"""
+import asyncio
+import json
+import os
+import random
+from argparse import ArgumentParser
+from collections import Counter
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+import aiohttp
+
+from benchmarks.conversations import CONVERSATIONS
+from benchmarks.stats import histogram_quantile, parse_histogram, percentile
+
+ENDPOINTS = {"webhook": "/webhook/", "chat": "/chat/ascsac/"}
+
+# Seconds between samples of the load generator's own event loop lag
+LAG_SAMPLE_INTERVAL = 0.1
+
+DIALOGFLOW_SESSION = "projects/rj-chatbot/locations/global/agents/load-test/sessions/{session}"
+
+
+class Stage:
+    """
+    Measurements of the requests started while a number of virtual users was running.
+    """
+
+    def __init__(self, users: int):
+        self.users = users
+        self.duration = 0.0
+        self.latencies: Dict[str, List[float]] = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors: Dict[str, Counter] = {endpoint: Counter() for endpoint in ENDPOINTS}
+        self.conversations = Counter()
+        self.client_lag: List[float] = []
+        self.server_lag: Dict[str, Optional[float]] = {}
+
+    def record(self, endpoint: str, latency: float, error: str = None) -> None:
+        self.latencies[endpoint].append(latency)
+        if error:
+            self.errors[endpoint][error] += 1
+
+    def summary(self) -> dict:
+        endpoints = {}
+        for endpoint, latencies in self.latencies.items():
+            if not latencies:
+                continue
+            latencies = sorted(latencies)
+            errors = sum(self.errors[endpoint].values())
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "throughput_rps": len(latencies) / self.duration,
+                "error_rate": errors / len(latencies),
+                "errors": dict(self.errors[endpoint]),
+                "p50_ms": percentile(latencies, 50) * 1000,
+                "p95_ms": percentile(latencies, 95) * 1000,
+                "p99_ms": percentile(latencies, 99) * 1000,
+                "max_ms": latencies[-1] * 1000,
+            }
+        client_lag = sorted(self.client_lag) or [0.0]
+        return {
+            "users": self.users,
+            "duration_s": self.duration,
+            "conversations": dict(self.conversations),
+            "endpoints": endpoints,
+            "client_lag_p99_ms": percentile(client_lag, 99) * 1000,
+            "server_lag_ms": {
+                key: value * 1000 if value is not None else None
+                for key, value in self.server_lag.items()
+            },
+        }
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.url = args.url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {args.token}"}
+        self.endpoints: List[str] = args.endpoints
+        self.think_time: float = args.think_time
+        self.timeout = aiohttp.ClientTimeout(total=args.timeout)
+        self.seed: int = args.seed
+        self.run_id = uuid4().hex[:8]
+        self.session: aiohttp.ClientSession = None
+        # Requests are only recorded while a stage is running, not during the warm-up
+        self.stage: Optional[Stage] = None
+        self._users: List[asyncio.Task] = []
+
+    async def post(self, endpoint: str, body: dict) -> Optional[dict]:
+        """
+        Sends a request and records it in the current stage.
+
+        Returns:
+            Optional[dict]: The response body, or `None` if the request failed.
+        """
+        stage = self.stage
+        start = perf_counter()
+        error, data = None, None
+        try:
+            async with self.session.post(
+                self.url + ENDPOINTS[endpoint], json=body, headers=self.headers
+            ) as response:
+                content = await response.read()
+                if response.status >= 400:
+                    error = f"HTTP {response.status}"
+                else:
+                    data = json.loads(content)
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:  # noqa
+            error = type(exc).__name__
+        if stage is not None:
+            stage.record(endpoint, perf_counter() - start, error)
+        return data
+
+    async def think(self, rng: random.Random) -> None:
+        if self.think_time:
+            await asyncio.sleep(rng.expovariate(1 / self.think_time))
+
+    async def replay_webhook(self, conversation: dict, session: str, rng: random.Random) -> bool:
+        """
+        Plays the part of Dialogflow CX: sends each step with the session parameters gathered
+        so far and merges the returned parameters, where `None` removes a parameter.
+        """
+        parameters = {}
+        for step in conversation["webhook"]:
+            parameters.update(step["parameters"])
+            body = {
+                "detectIntentResponseId": str(uuid4()),
+                "pageInfo": {"displayName": step["page"]},
+                "sessionInfo": {
+                    "session": DIALOGFLOW_SESSION.format(session=session),
+                    "parameters": parameters,
+                },
+                "fulfillmentInfo": {"tag": step["tag"]},
+                "text": step["text"],
+                "languageCode": "pt-br",
+            }
+            data = await self.post("webhook", body)
+            if data is None:
+                return False
+            for key, value in data.get("sessionInfo", {}).get("parameters", {}).items():
+                if value is None:
+                    parameters.pop(key, None)
+                else:
+                    parameters[key] = value
+            await self.think(rng)
+        return True
+
+    async def replay_chat(self, conversation: dict, session: str, rng: random.Random) -> bool:
+        for message in conversation["chat"]:
+            # The protocol only names the Dialogflow session, so every conversation gets its own
+            if await self.post("chat", {"message": message, "protocol": session}) is None:
+                return False
+            await self.think(rng)
+        return True
+
+    async def virtual_user(self, user: int) -> None:
+        rng = random.Random(self.seed + user)
+        weights = [conversation["weight"] for conversation in CONVERSATIONS]
+        iteration = 0
+        while True:
+            conversation = rng.choices(CONVERSATIONS, weights)[0]
+            endpoint = rng.choice(self.endpoints)
+            session = f"load-{self.run_id}-{user}-{iteration}"
+            replay = self.replay_webhook if endpoint == "webhook" else self.replay_chat
+            completed = await replay(conversation, session, rng)
+            if self.stage is not None:
+                outcome = "completed" if completed else "aborted"
+                self.stage.conversations[f"{endpoint}/{conversation['name']}/{outcome}"] += 1
+            iteration += 1
+
+    def scale(self, users: int) -> None:
+        while len(self._users) < users:
+            self._users.append(asyncio.create_task(self.virtual_user(len(self._users))))
+        while len(self._users) > users:
+            self._users.pop().cancel()
+
+    async def sample_client_lag(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            if self.stage is not None:
+                self.stage.client_lag.append(max(0.0, loop.time() - start - LAG_SAMPLE_INTERVAL))
+
+    async def read_server_lag(self) -> Dict[str, float]:
+        try:
+            async with self.session.get(f"{self.url}/metrics/", headers=self.headers) as response:
+                if response.status != 200:
+                    return {}
+                return parse_histogram(await response.text(), "event_loop_lag_seconds")
+        except Exception:  # noqa
+            return {}
+
+    async def run_stage(self, users: int, duration: float) -> Stage:
+        self.scale(users)
+        before = await self.read_server_lag()
+        self.stage = stage = Stage(users)
+        start = perf_counter()
+        await asyncio.sleep(duration)
+        self.stage = None
+        stage.duration = perf_counter() - start
+        after = await self.read_server_lag()
+        count = after.get("_count", 0) - before.get("_count", 0)
+        if count > 0:
+            stage.server_lag = {
+                "mean": (after["_sum"] - before["_sum"]) / count,
+                "p99": histogram_quantile(before, after, 0.99),
+            }
+        return stage
+
+    async def run(self, stages: List[int], duration: float, warmup: float, stop_error_rate):
+        connector = aiohttp.TCPConnector(limit=0)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        lag_sampler = asyncio.create_task(self.sample_client_lag())
+        results = []
+        try:
+            if warmup:
+                self.scale(stages[0])
+                await asyncio.sleep(warmup)
+            for users in stages:
+                summary = (await self.run_stage(users, duration)).summary()
+                results.append(summary)
+                report_stage(summary)
+                error_rates = [data["error_rate"] for data in summary["endpoints"].values()]
+                if stop_error_rate is not None and max(error_rates, default=0) > stop_error_rate:
+                    print(f"Stopping: error rate above {stop_error_rate:.0%}")
+                    break
+        finally:
+            users = list(self._users)
+            self.scale(0)
+            lag_sampler.cancel()
+            await asyncio.gather(*users, lag_sampler, return_exceptions=True)
+            await self.session.close()
+        return results
+
+
+def report_stage(summary: dict) -> None:
+    server_lag = summary["server_lag_ms"]
+    if server_lag:
+        p99 = server_lag["p99"]
+        server = f"mean {server_lag['mean']:.1f} ms, p99 <= {p99:g} ms"
+    else:
+        server = "n/a"
+    print(
+        f"\n{summary['users']} users, {summary['duration_s']:.0f} s - event loop lag: load "
+        f"generator p99 {summary['client_lag_p99_ms']:.1f} ms, service {server}"
+    )
+    print(
+        f"  {'endpoint':<10} {'requests':>9} {'req/s':>8} {'errors':>7} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+    )
+    for endpoint, data in summary["endpoints"].items():
+        print(
+            f"  {endpoint:<10} {data['requests']:>9} {data['throughput_rps']:>8.1f} "
+            f"{data['error_rate']:>7.1%} {data['p50_ms']:>8.1f} {data['p95_ms']:>8.1f} "
+            f"{data['p99_ms']:>8.1f} {data['max_ms']:>8.1f}"
+        )
+        for error, count in data["errors"].items():
+            print(f"  {'':<10} {count:>9} x {error}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Load tests the webhook and chat endpoints")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument(
+        "--token",
+        default=os.getenv("CHATBOT_WEBHOOKS_TOKEN"),
+        help="Bearer token, defaults to $CHATBOT_WEBHOOKS_TOKEN",
+    )
+    parser.add_argument("--endpoints", nargs="+", choices=list(ENDPOINTS), default=["webhook"])
+    parser.add_argument(
+        "--stages",
+        type=lambda value: [int(users) for users in value.split(",")],
+        default=[10, 25, 50, 100],
+        help="Comma-separated numbers of concurrent virtual users",
+    )
+    parser.add_argument("--stage-duration", type=float, default=60, help="Seconds per stage")
+    parser.add_argument("--warmup", type=float, default=10, help="Unrecorded seconds before")
+    parser.add_argument(
+        "--think-time", type=float, default=0, help="Mean seconds between a user's messages"
+    )
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds per request")
+    parser.add_argument(
+        "--stop-error-rate", type=float, help="Stop ramping once a stage's error rate is above"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a bearer token is required (--token or $CHATBOT_WEBHOOKS_TOKEN)")
+
+    load_test = LoadTest(args)
+    results = asyncio.run(
+        load_test.run(args.stages, args.stage_duration, args.warmup, args.stop_error_rate)
+    )
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, ensure_ascii=False) + "\n")
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Local simulator of the upstreams the service calls: pgeo3 (IPP geocoding), Google geocoding,
+chatbot-integrations, the PGM API behind its `/request` proxy, SGRC, Discord webhooks and
+ChatbotLab. Responses come from `benchmarks.upstreams`; a profile adds latency, errors and
+hangs per upstream, so the service can be load tested on a laptop with no network.
+
+    python -m benchmarks.simulator --profile realistic --port 8900
+
+prints the environment variables that point the service at the simulator. Profiles are either
+one of `PROFILES` or a JSON file with the same structure, e.g.
+
+    {"ipp": {"latency": {"distribution": "lognormal", "median_ms": 150, "p99_ms": 1500},
+             "error_rate": 0.05, "error_status": 503, "timeout_rate": 0.01, "timeout_s": 30}}
+
+Upstreams missing from a profile answer immediately and never fail.
+"""
+import asyncio
+import json
+import math
+import random
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, Tuple
+
+from aiohttp import web
+
+from benchmarks.upstreams import UPSTREAMS
+
+# z-score of the 99th percentile of a normal distribution
+Z_99 = 2.326
+
+# Rough figures; replace them with the ones observed in `upstream_request_duration_seconds`
+REALISTIC = {
+    "ipp": {"latency": {"distribution": "lognormal", "median_ms": 150, "p99_ms": 1500}},
+    "google_maps": {"latency": {"distribution": "lognormal", "median_ms": 80, "p99_ms": 400}},
+    "integrations": {"latency": {"distribution": "lognormal", "median_ms": 50, "p99_ms": 400}},
+    "pgm": {"latency": {"distribution": "lognormal", "median_ms": 400, "p99_ms": 3000}},
+    "sgrc": {"latency": {"distribution": "lognormal", "median_ms": 700, "p99_ms": 5000}},
+    "discord": {"latency": {"distribution": "lognormal", "median_ms": 100, "p99_ms": 600}},
+    "chatbot_lab": {"latency": {"distribution": "lognormal", "median_ms": 1500, "p99_ms": 8000}},
+}
+
+PROFILES: Dict[str, Dict[str, dict]] = {
+    # No latency and no failures, for benchmarks of the service's own overhead
+    "instant": {},
+    "realistic": REALISTIC,
+    # Slow and failing IPP, SGRC and PGM, as seen during heavy-rain traffic spikes
+    "degraded": {
+        **REALISTIC,
+        "ipp": {
+            "latency": {"distribution": "lognormal", "median_ms": 1500, "p99_ms": 12000},
+            "error_rate": 0.05,
+            "timeout_rate": 0.02,
+        },
+        "pgm": {**REALISTIC["pgm"], "error_rate": 0.05},
+        "sgrc": {
+            "latency": {"distribution": "lognormal", "median_ms": 3000, "p99_ms": 20000},
+            "error_rate": 0.1,
+            "timeout_rate": 0.05,
+        },
+    },
+}
+
+
+class UpstreamProfile:
+    """
+    Behavior of a simulated upstream: a latency distribution, the share of requests that fail
+    with `error_status` and the share that hang for `timeout_s` seconds before failing.
+    """
+
+    def __init__(
+        self,
+        latency: dict = None,
+        error_rate: float = 0.0,
+        error_status: int = 503,
+        timeout_rate: float = 0.0,
+        timeout_s: float = 60.0,
+    ):
+        self.latency = latency or {"distribution": "fixed", "ms": 0}
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.timeout_s = timeout_s
+        if self.latency["distribution"] not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {self.latency['distribution']}")
+
+    def sample_latency(self, rng: random.Random) -> float:
+        """
+        Returns a latency, in seconds.
+        """
+        latency = self.latency
+        if latency["distribution"] == "fixed":
+            return latency["ms"] / 1000
+        if latency["distribution"] == "uniform":
+            return rng.uniform(latency["min_ms"], latency["max_ms"]) / 1000
+        sigma = math.log(latency["p99_ms"] / latency["median_ms"]) / Z_99
+        return rng.lognormvariate(math.log(latency["median_ms"]), sigma) / 1000
+
+
+def load_profile(name_or_path: str) -> Dict[str, UpstreamProfile]:
+    """
+    Loads a profile by name (see `PROFILES`) or from a JSON file.
+    """
+    if name_or_path in PROFILES:
+        profile = PROFILES[name_or_path]
+    else:
+        profile = json.loads(Path(name_or_path).read_text())
+    return {upstream: UpstreamProfile(**settings) for upstream, settings in profile.items()}
+
+
+def upstream_of(path: str) -> str:
+    for prefix, name, _ in UPSTREAMS:
+        if path == prefix or path.startswith(prefix + "/"):
+            # PGM is reached through the chatbot-integrations proxy
+            if name == "integrations" and path == f"{prefix}/request":
+                return "pgm"
+            return name
+    return "unknown"
+
+
+@web.middleware
+async def simulate(request: web.Request, handler) -> web.StreamResponse:
+    profile: UpstreamProfile = request.app["profile"].get(upstream_of(request.path))
+    if profile is None:
+        return await handler(request)
+    rng: random.Random = request.app["random"]
+    roll = rng.random()
+    if roll < profile.timeout_rate:
+        await asyncio.sleep(profile.timeout_s)
+        return web.json_response({"error": "simulated timeout"}, status=504)
+    await asyncio.sleep(profile.sample_latency(rng))
+    if roll < profile.timeout_rate + profile.error_rate:
+        return web.json_response({"error": "simulated failure"}, status=profile.error_status)
+    return await handler(request)
+
+
+def build_app(profile: Dict[str, UpstreamProfile] = None, seed: int = 0) -> web.Application:
+    app = web.Application(middlewares=[simulate])
+    app["profile"] = profile or {}
+    app["random"] = random.Random(seed)
+    for prefix, _, routes in UPSTREAMS:
+        for method, path, handler in routes:
+            app.router.add_route(method, prefix + path, handler)
+    return app
+
+
+def environment(base_url: str) -> Dict[str, str]:
+    """
+    Returns the environment variables (read by `config`) that point the service at a
+    simulator running on `base_url`.
+    """
+    return {
+        "PGEO3_URL": f"{base_url}/pgeo3",
+        "GMAPS_URL": f"{base_url}/maps",
+        "CHATBOT_INTEGRATIONS_URL": f"{base_url}/integrations",
+        "CHATBOT_PGM_API_URL": "https://pgm.simulated",
+        "CHATBOT_LAB_API_URL": f"{base_url}/lab",
+        "SGRC_URL": f"{base_url}/sgrc",
+        "DISCORD_WEBHOOK_NEW_TICKET": f"{base_url}/discord/simulated",
+    }
+
+
+async def start(
+    profile: str = "instant", host: str = "127.0.0.1", port: int = 0, seed: int = 0
+) -> Tuple[web.AppRunner, str]:
+    """
+    Starts the simulator in the running event loop. With `port=0` a free port is picked.
+
+    Returns:
+        Tuple[web.AppRunner, str]: The runner, to be cleaned up, and the base URL.
+    """
+    runner = web.AppRunner(build_app(load_profile(profile), seed), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner, f"http://{host}:{runner.addresses[0][1]}"
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Simulates the upstreams of the service")
+    parser.add_argument("--profile", default="realistic", help="Profile name or JSON file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app = build_app(load_profile(args.profile), args.seed)
+    print(f"Simulating upstreams with the '{args.profile}' profile. Point the service at it with:")
+    for name, value in environment(f"http://{args.host}:{args.port}").items():
+        print(f"export {name}={value}")
+    web.run_app(app, host=args.host, port=args.port, access_log=None, print=None)
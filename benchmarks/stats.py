@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import math
+from typing import Dict, List, Optional
+
+
+def percentile(values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def parse_histogram(text: str, name: str) -> Dict[str, float]:
+    """
+    Reads an unlabeled histogram from metrics in the Prometheus text format.
+
+    Returns:
+        Dict[str, float]: The cumulative count of every bucket, keyed by its upper bound as
+            written in the `le` label, plus the `_sum` and `_count` of the histogram.
+    """
+    values = {}
+    for line in text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            bound = line[len(name) + len('_bucket{le="') : line.index('"}')]  # noqa: E203
+            values[bound] = float(line.rsplit(" ", 1)[1])
+        elif line.startswith((f"{name}_sum ", f"{name}_count ")):
+            key, value = line.split(" ")
+            values[key[len(name) :]] = float(value)  # noqa: E203
+    return values
+
+
+def histogram_quantile(
+    before: Dict[str, float], after: Dict[str, float], q: float
+) -> Optional[float]:
+    """
+    Upper bound of the bucket holding the `q` quantile of the observations made between two
+    readings of a histogram (see `parse_histogram`), or `None` if there were none.
+    """
+    count = after.get("_count", 0) - before.get("_count", 0)
+    if count <= 0:
+        return None
+    bounds = sorted((key for key in after if not key.startswith("_")), key=float)
+    for bound in bounds:
+        if after[bound] - before.get(bound, 0) >= q * count:
+            return float(bound)
+    return float("inf")
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmark of the webhook tags. Every fixture in `benchmarks/fixtures` is an anonymized
+Dialogflow CX webhook request, which is sent through the real `/webhook/` route (with the same
+middlewares as the service) while the upstreams are answered by `benchmarks.simulator` with
+its "instant" profile: deterministic responses and no added latency. Latency percentiles and
+allocations are reported per fixture and compared against a stored baseline.
+
+    python -m benchmarks.tags                       # run and compare with the baseline
+    python -m benchmarks.tags --save-baseline       # store the results as the new baseline
+    python -m benchmarks.tags --only "abrir_chamado_sgrc_*" --cold
+
+The fakes run in the same event loop as the app, so the latencies include their (small, fixed)
+cost. Numbers are only comparable with a baseline taken on the same machine.
+"""
+import asyncio
+import json
+import sys
+import tracemalloc
+from argparse import ArgumentParser
+from fnmatch import fnmatch
+from pathlib import Path
+from time import perf_counter_ns
+from typing import Dict, List, Tuple
+
+from fastapi import FastAPI
+from loguru import logger
+
+from chatbot_webhooks import config
+
+# No span export and no persistent geocoding cache, so that runs do not affect each other
+config.TRACING_EXPORTER = None
+config.GEOCODE_CACHE_PATH = None
+
+from benchmarks import simulator, upstreams  # noqa: E402
+from benchmarks.stats import percentile  # noqa: E402
+from chatbot_webhooks.dependencies import validate_token  # noqa: E402
+from chatbot_webhooks.routers import webhook  # noqa: E402
+from chatbot_webhooks.webhooks import clients, utils  # noqa: E402
+from chatbot_webhooks.webhooks.breaker import BREAKERS  # noqa: E402
+from chatbot_webhooks.webhooks.cache import CACHES  # noqa: E402
+from chatbot_webhooks.webhooks.metrics import MetricsMiddleware  # noqa: E402
+from chatbot_webhooks.webhooks.neighborhoods import neighborhood_resolver  # noqa: E402
+from chatbot_webhooks.webhooks.tracing import TracingMiddleware  # noqa: E402
+
+BENCHMARKS_PATH = Path(__file__).parent
+FIXTURES_PATH = BENCHMARKS_PATH / "fixtures"
+BASELINE_PATH = BENCHMARKS_PATH / "baseline.json"
+
+
+def point_upstreams_at(base_url: str) -> None:
+    """
+    Points every upstream the tags call at the simulator.
+    """
+    for name, value in simulator.environment(base_url).items():
+        setattr(config, name, value)
+    config.CHATBOT_INTEGRATIONS_KEY = "bench"
+    config.GMAPS_API_TOKEN = "bench"
+    # `prefeitura_rio` calls SGRC with its own client and settings, so it is replaced outright
+    utils.async_sgrc_new_ticket = upstreams.fake_sgrc_new_ticket
+
+
+def reset_state() -> None:
+    """
+    Forgets everything learned from previous requests: cached upstream answers, neighborhoods,
+    circuit breakers and the PGM token.
+    """
+    for cache in list(CACHES):
+        cache.clear()
+    BREAKERS.clear()
+    neighborhood_resolver.replace([])
+    utils._pgm_token.update(value=None, expires_at=0.0)
+
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(TracingMiddleware)
+    app.include_router(webhook.router)
+    app.dependency_overrides[validate_token] = lambda: None
+    return app
+
+
+async def post(app: FastAPI, path: str, body: bytes) -> Tuple[int, bytes]:
+    """
+    Sends a POST request straight to the ASGI app, without a server or an HTTP client.
+    """
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8080),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    response = {"status": None, "body": b""}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body":
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["body"]
+
+
+def load_fixtures(pattern: str = None) -> Dict[str, bytes]:
+    fixtures = {}
+    for path in sorted(FIXTURES_PATH.glob("*.json")):
+        if pattern is None or fnmatch(path.stem, pattern):
+            fixtures[path.stem] = path.read_bytes()
+    return fixtures
+
+
+async def measure(
+    app: FastAPI, body: bytes, iterations: int, warmup: int, allocations: int, cold: bool
+) -> dict:
+    """
+    Measures one fixture: latencies over `iterations` requests, then memory over `allocations`
+    requests with `tracemalloc` on, since tracing allocations slows everything down.
+    """
+    for _ in range(warmup):
+        if cold:
+            reset_state()
+        status, content = await post(app, "/webhook/", body)
+        if status != 200:
+            raise RuntimeError(f"Webhook answered {status}: {content[:200]!r}")
+
+    latencies = []
+    for _ in range(iterations):
+        if cold:
+            reset_state()
+        start = perf_counter_ns()
+        await post(app, "/webhook/", body)
+        latencies.append((perf_counter_ns() - start) / 1e6)
+    latencies.sort()
+
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for _ in range(allocations):
+            if cold:
+                reset_state()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            await post(app, "/webhook/", body)
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "tag": json.loads(body)["fulfillmentInfo"]["tag"],
+        "iterations": iterations,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "peak_kib": sum(peaks) / len(peaks) / 1024 if peaks else None,
+        "retained_kib": sum(retained) / len(retained) / 1024 if retained else None,
+    }
+
+
+def change(current: float, baseline: float) -> str:
+    if not baseline:
+        return ""
+    return f"{(current - baseline) / baseline * 100:+.0f}%"
+
+
+def report(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """
+    Prints the results table and returns the fixtures whose p95 regressed past `threshold`.
+    """
+    header = (
+        f"{'fixture':<44} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'peak KiB':>9} {'kept KiB':>9} {'Δp50':>6} {'Δp95':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        flag = ""
+        if base.get("p95_ms") and result["p95_ms"] > base["p95_ms"] * (1 + threshold):
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<44} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+            f"{result['p99_ms']:>8.2f} {result['peak_kib'] or 0:>9.1f} "
+            f"{result['retained_kib'] or 0:>9.1f} "
+            f"{change(result['p50_ms'], base.get('p50_ms')):>6} "
+            f"{change(result['p95_ms'], base.get('p95_ms')):>6}{flag}"
+        )
+    return regressions
+
+
+async def run(args) -> int:
+    fixtures = load_fixtures(args.only)
+    if not fixtures:
+        print(f"No fixtures match '{args.only}'")
+        return 1
+
+    runner, base_url = await simulator.start("instant")
+    point_upstreams_at(base_url)
+    app = build_app()
+    results = {}
+    try:
+        for name, body in fixtures.items():
+            reset_state()
+            results[name] = await measure(
+                app, body, args.iterations, args.warmup, args.allocations, args.cold
+            )
+    finally:
+        await clients.close_sessions()
+        await runner.cleanup()
+
+    mode = "cold" if args.cold else "warm"
+    stored = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    print(f"Mode: {mode} caches, {args.iterations} iterations per fixture\n")
+    regressions = report(results, stored.get(mode, {}), args.threshold)
+
+    if args.save_baseline:
+        stored[mode] = {**stored.get(mode, {}), **results}
+        args.baseline.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n")
+        print(f"\nBaseline saved to {args.baseline}")
+    elif regressions:
+        print(f"\n{len(regressions)} fixture(s) regressed more than {args.threshold:.0%} on p95")
+        return 1 if args.fail_on_regression else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmarks the webhook tags against fake upstreams")
+    parser.add_argument("--only", help="Glob on the fixture names, e.g. 'validador_*'")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument(
+        "--allocations", type=int, default=20, help="Requests measured with tracemalloc"
+    )
+    parser.add_argument(
+        "--cold", action="store_true", help="Clear caches and learned state before each request"
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold", type=float, default=0.2, help="Relative p95 increase flagged as regression"
+    )
+    parser.add_argument("--fail-on-regression", action="store_true")
+    parser.add_argument("--log", action="store_true", help="Print the application logs")
+    args = parser.parse_args()
+
+    # The tags log a lot; keep paying for formatting the messages, but do not print them
+    logger.remove()
+    logger.add(sys.stderr if args.log else (lambda message: None), level="INFO")
+    sys.exit(asyncio.run(run(args)))
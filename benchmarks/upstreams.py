@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic fakes of the upstreams called by the service. Every upstream lives under its own
+path prefix (e.g. `/pgeo3/arcgis/...`, `/integrations/person`) and answers from the small,
+anonymized tables below, so the same request always gets the same response. They are served by
+`benchmarks.simulator`.
+"""
+import json
+from itertools import count
+from types import SimpleNamespace
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from aiohttp import web
+from unidecode import unidecode
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
+
+# Known addresses, as Google Maps and the IPP see them
+PLACES = [
+    {
+        "route": "Rua Conde de Bonfim",
+        "number": "500",
+        "neighborhood": "Tijuca",
+        "postal_code": "20520-053",
+        "lat": -22.9246,
+        "lng": -43.2326,
+        "ipp_street_code": "60456",
+        "ipp_neighborhood_code": "33",
+        "ipp_label": "Rua Conde de Bonfim",
+        "ipp_neighborhood": "Tijuca",
+    },
+    {
+        # The IPP abbreviates this one, so the tags fall back to `findAddressCandidates`
+        "route": "Avenida Presidente Vargas",
+        "number": "1000",
+        "neighborhood": "Centro",
+        "postal_code": "20071-004",
+        "lat": -22.9035,
+        "lng": -43.1870,
+        "ipp_street_code": "17116",
+        "ipp_neighborhood_code": "5",
+        "ipp_label": "Av Pres Vargas",
+        "ipp_neighborhood": "Centro",
+    },
+]
+
+ADDRESS_CANDIDATES = [
+    ("Avenida Presidente Vargas, Centro", "17116", -22.9035, -43.1870),
+    ("Avenida Presidente Vargas, Cidade Nova", "17116", -22.9096, -43.2042),
+    ("Rua Presidente Vargas, Campo Grande", "95321", -22.9012, -43.5618),
+    ("Rua Conde de Bonfim, Tijuca", "60456", -22.9246, -43.2326),
+]
+
+PERSON = {
+    "id": 1234567,
+    "name": "Maria da Silva",
+    "cpf": "52998224725",
+    "email": "cidadao@exemplo.com.br",
+    "phones": ["21999999999"],
+}
+
+PROTOCOLS = [
+    {
+        "protocol": "20260000000001",
+        "tickets": [
+            {"classification": 1647, "status": "Fechado", "end_date": "2026-01-10"},
+            {"classification": 1607, "status": "Fechado", "end_date": "2025-11-03"},
+        ],
+    }
+]
+
+ADDRESS_PROTOCOLS = [
+    {
+        "protocol": "20250000000002",
+        "tickets": [{"classification": 1607, "status": "Fechado", "end_date": "2025-08-20"}],
+    }
+]
+
+DIVIDAS_CONTRIBUINTE = {
+    "enderecoImovel": "RUA CONDE DE BONFIM 500 APT 101 - TIJUCA",
+    "dataVencimento": "31/10/2026",
+    "debitosNaoParceladosComSaldoTotal": {
+        "saldoTotalNaoParcelado": "R$ 3.250,40",
+        "cdasNaoAjuizadasNaoParceladas": [
+            {"cdaId": f"0100000{i:05d}", "valorSaldoTotal": f"R$ {150 + i},20"} for i in range(8)
+        ],
+        "efsNaoParceladas": [
+            {
+                "numeroExecucaoFiscal": f"0{i}23456-78.2019.8.19.0001",
+                "saldoExecucaoFiscalNaoParcelada": f"R$ {900 + i},00",
+            }
+            for i in range(2)
+        ],
+    },
+    "guiasParceladasComSaldoTotal": {
+        "guiasParceladas": [
+            {"numero": f"2026{i:06d}", "dataUltimoPagamento": "10/09/2026"} for i in range(3)
+        ]
+    },
+}
+
+
+def normalize(text: str) -> str:
+    return unidecode(text or "").lower()
+
+
+def find_place(address: str) -> Optional[dict]:
+    address = normalize(address)
+    for place in PLACES:
+        if normalize(place["route"]) in address:
+            return place
+    return None
+
+
+def nearest_place(lat: float, lng: float) -> dict:
+    return min(PLACES, key=lambda place: (place["lat"] - lat) ** 2 + (place["lng"] - lng) ** 2)
+
+
+def google_result(place: dict) -> dict:
+    components = [
+        (place["number"], ["street_number"]),
+        (place["route"], ["route"]),
+        (place["neighborhood"], ["political", "sublocality", "sublocality_level_1"]),
+        ("Rio de Janeiro", ["administrative_area_level_2", "political"]),
+        ("RJ", ["administrative_area_level_1", "political"]),
+        ("Brasil", ["country", "political"]),
+        (place["postal_code"], ["postal_code"]),
+    ]
+    return {
+        "address_components": [
+            {"long_name": name, "short_name": name, "types": types} for name, types in components
+        ],
+        "formatted_address": (
+            f'{place["route"]}, {place["number"]} - {place["neighborhood"]}, '
+            f'Rio de Janeiro - RJ, {place["postal_code"]}, Brasil'
+        ),
+        "geometry": {"location": {"lat": place["lat"], "lng": place["lng"]}},
+        "place_id": f'bench-{place["ipp_street_code"]}',
+        "types": ["street_address"],
+    }
+
+
+def text_plain(data) -> web.Response:
+    # The ArcGIS server answers JSON as text/plain, which the helpers rely on
+    return web.Response(text=json.dumps(data), content_type="text/plain")
+
+
+async def ipp_reverse_geocode(request: web.Request) -> web.Response:
+    lng, lat = (float(value) for value in request.query["location"].split(","))
+    place = nearest_place(lat, lng)
+    return text_plain(
+        {
+            "address": {
+                "CL": place["ipp_street_code"],
+                "COD_Bairro": place["ipp_neighborhood_code"],
+                "ShortLabel": place["ipp_label"],
+                "Neighborhood": place["ipp_neighborhood"],
+            },
+            "location": {"x": place["lng"], "y": place["lat"]},
+        }
+    )
+
+
+async def ipp_find_address_candidates(request: web.Request) -> web.Response:
+    street = normalize(request.query.get("Address", "").split(",")[0])
+    candidates = [
+        {
+            "address": address,
+            "location": {"x": lng, "y": lat},
+            "score": 100 if normalize(address).startswith(street) else 80,
+            "attributes": {"cl": code},
+        }
+        for address, code, lat, lng in ADDRESS_CANDIDATES
+    ]
+    return text_plain({"spatialReference": {"wkid": 4326}, "candidates": candidates})
+
+
+async def google_geocode(request: web.Request) -> web.Response:
+    if "latlng" in request.query:
+        lat, lng = (float(value) for value in request.query["latlng"].split(","))
+        place = nearest_place(lat, lng)
+    else:
+        place = find_place(request.query.get("address", ""))
+    if place is None:
+        return web.json_response({"status": "ZERO_RESULTS", "results": []})
+    return web.json_response({"status": "OK", "results": [google_result(place)]})
+
+
+async def integrations_person(request: web.Request) -> web.Response:
+    return web.json_response(PERSON)
+
+
+async def integrations_protocols(request: web.Request) -> web.Response:
+    return web.json_response(PROTOCOLS)
+
+
+async def integrations_address_protocols(request: web.Request) -> web.Response:
+    return web.json_response(ADDRESS_PROTOCOLS)
+
+
+async def integrations_neighborhood_id(request: web.Request) -> web.Response:
+    name = normalize((await request.json())["name"])
+    for place in PLACES:
+        if normalize(place["ipp_neighborhood"]) == name:
+            return web.json_response(
+                {"id": place["ipp_neighborhood_code"], "name": place["ipp_neighborhood"]}
+            )
+    return web.json_response({"id": "0", "name": ""})
+
+
+async def integrations_request(request: web.Request) -> web.Response:
+    # Proxied calls to the PGM API
+    url = (await request.json())["url"]
+    if url.endswith("/security/token"):
+        return web.json_response({"access_token": "bench-token", "expires_in": 3600})
+    if url.endswith("/dividas-contribuinte"):
+        return web.json_response({"success": True, "data": DIVIDAS_CONTRIBUINTE})
+    return web.json_response({"success": True, "data": {}})
+
+
+async def discord_webhook(request: web.Request) -> web.Response:
+    return web.Response(status=204)
+
+
+_ticket_ids = count(1)
+
+
+def next_ticket() -> Tuple[str, str]:
+    ticket_id = next(_ticket_ids)
+    return f"2026{ticket_id:010d}", str(ticket_id)
+
+
+async def sgrc_new_ticket(request: web.Request) -> web.Response:
+    protocol_id, ticket_id = next_ticket()
+    return web.json_response({"protocolo": protocol_id, "chamado": ticket_id})
+
+
+async def chatbot_lab(request: web.Request) -> web.Response:
+    message = (await request.json()).get("message", "")
+    return web.json_response({"answer": f"Resposta simulada para: {message}"})
+
+
+async def fake_sgrc_new_ticket(**kwargs) -> SimpleNamespace:
+    """
+    Stands in for `prefeitura_rio`'s `async_new_ticket`, which talks to SGRC with its own
+    client instead of the pooled sessions.
+    """
+    protocol_id, ticket_id = next_ticket()
+    return SimpleNamespace(protocol_id=protocol_id, ticket_id=ticket_id)
+
+
+GEOCODE_SERVER = "/arcgis/rest/services/Geocode/Geocode_Logradouros_WGS84/GeocodeServer"
+
+# Path prefix, upstream name and routes of every fake upstream
+UPSTREAMS: List[Tuple[str, str, List[Tuple[str, str, Handler]]]] = [
+    (
+        "/pgeo3",
+        "ipp",
+        [
+            ("GET", f"{GEOCODE_SERVER}/reverseGeocode", ipp_reverse_geocode),
+            ("GET", f"{GEOCODE_SERVER}/findAddressCandidates", ipp_find_address_candidates),
+        ],
+    ),
+    ("/maps", "google_maps", [("GET", "/maps/api/geocode/json", google_geocode)]),
+    (
+        "/integrations",
+        "integrations",
+        [
+            ("POST", "/person", integrations_person),
+            ("POST", "/protocols", integrations_protocols),
+            ("POST", "/address_protocols", integrations_address_protocols),
+            ("POST", "/neighborhood_id", integrations_neighborhood_id),
+            ("POST", "/request", integrations_request),
+        ],
+    ),
+    ("/sgrc", "sgrc", [("POST", "/{path:.*}", sgrc_new_ticket)]),
+    ("/discord", "discord", [("POST", "/{webhook:.*}", discord_webhook)]),
+    ("/lab", "chatbot_lab", [("POST", "", chatbot_lab), ("POST", "/{path:.*}", chatbot_lab)]),
+]
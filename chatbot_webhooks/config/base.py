@@ -11,3 +11,89 @@ SENTRY_ENVIRONMENT = None
 # DialogFlow
 SIGNATURE_BUTTONS_MESSAGE = "BUTTONOPTIONS:"
 SIGNATURE_FILE_MESSAGE = "FILE:"
+
+# HTTP client pool
+HTTP_POOL_LIMIT_PER_HOST = 100
+HTTP_KEEPALIVE_TIMEOUT = 30
+HTTP_DNS_CACHE_TTL = 300
+# Total timeout, in seconds, of the calls made outside of a webhook request (e.g. refreshes)
+HTTP_DEFAULT_TIMEOUT = 30
+
+# Circuit breakers
+# Consecutive failures after which calls to an upstream fail fast
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+# Seconds an open breaker fails calls before letting trial calls through
+CIRCUIT_BREAKER_RECOVERY_TIMEOUT = 30
+CIRCUIT_BREAKER_HALF_OPEN_MAX_CALLS = 1
+# Settings of specific upstreams, e.g. {"sgrc": {"failure_threshold": 3}}
+CIRCUIT_BREAKER_OVERRIDES = {}
+
+# Citizen profile cache
+# Conversations (Dialogflow sessions) whose citizen lookups are kept
+CITIZEN_PROFILE_CACHE_MAXSIZE = 10000
+# Seconds the lookups are reused for, about as long as a conversation
+CITIZEN_PROFILE_CACHE_TTL = 60 * 10
+
+# Google Cloud credentials
+# Seconds before the access token expiry at which it gets refreshed in the background
+GCP_TOKEN_REFRESH_MARGIN = 300
+
+# PGM
+# Seconds before the access token expiry at which it stops being reused
+PGM_TOKEN_EXPIRY_MARGIN = 60
+# Lifetime assumed when the token response has no `expires_in`
+PGM_TOKEN_DEFAULT_EXPIRES_IN = 600
+
+# Google Maps geocoding cache
+GEOCODE_CACHE_MAXSIZE = 10000
+GEOCODE_CACHE_TTL = 60 * 60 * 24
+
+# Hedged requests
+# Quantile of the recent latencies of an upstream after which a call to it is hedged
+HEDGE_QUANTILE = 0.9
+# Latest calls per upstream from which the quantile is estimated
+HEDGE_LATENCY_WINDOW = 500
+# The quantile is only used once there are this many latencies; until then calls are hedged
+# after HEDGE_DEFAULT_DELAY seconds
+HEDGE_MIN_SAMPLES = 50
+HEDGE_DEFAULT_DELAY = 1
+# Hedged calls allowed per call made, across all upstreams, and how many can be saved up
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_BUDGET_BURST = 10
+
+# IPP reverseGeocode cache
+IPP_CACHE_MAXSIZE = 50000
+IPP_CACHE_TTL = 60 * 60 * 24
+# Coordinates are rounded to this many decimals to build the cache grid
+IPP_CACHE_GRID_DECIMALS = 4
+
+# IPP neighborhoods
+IPP_NEIGHBORHOODS_REFRESH_INTERVAL = 60 * 60 * 24
+# Minimum name similarity for a neighborhood to be resolved locally
+IPP_NEIGHBORHOODS_SIMILARITY_THRESHOLD = 0.9
+
+# Metrics
+# Seconds between samples of the event loop lag
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+# Token validation cache
+TOKEN_CACHE_MAXSIZE = 1000
+# Seconds a validated token is reused without querying the database. Each uvicorn worker has
+# its own cache and a deactivated token is only dropped from the worker that handled the
+# change, so the other workers keep accepting it for up to this long
+TOKEN_CACHE_TTL = 60
+
+# Webhook tags
+# Seconds Dialogflow CX waits for the webhook before giving up on it, which is the time budget
+# of every tag. Must match the timeout of the webhook in the agent (5 seconds by default)
+DIALOGFLOW_WEBHOOK_TIMEOUT = 5
+# Part of the budget, in seconds, kept to answer Dialogflow: upstream calls time out this
+# early and tags still running halfway through it are cancelled
+TAG_TIMEOUT_MARGIN = 0.5
+
+# Tracing
+TRACING_SERVICE_NAME = "chatbot-webhooks"
+# Seconds between span exports
+TRACING_EXPORT_INTERVAL = 5
+# Finished spans kept while waiting for an export; further spans are dropped
+TRACING_MAX_QUEUE_SIZE = 10000
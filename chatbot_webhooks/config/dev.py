@@ -16,6 +16,14 @@ ALLOWED_METHODS = getenv_list_or_action("ALLOWED_METHODS", default=["*"])
 ALLOWED_HEADERS = getenv_list_or_action("ALLOWED_HEADERS", default=["*"])
 ALLOW_CREDENTIALS = getenv_or_action("ALLOW_CREDENTIALS", default="true").lower() == "true"
 
+# JSON codec used by the routers: "auto" (orjson if installed), "orjson" or "json"
+JSON_CODEC = getenv_or_action("JSON_CODEC", default="auto")
+
+# Tracing: "file" (JSON lines in TRACING_FILE_PATH), "otlp" (OTLP/HTTP collector) or unset
+TRACING_EXPORTER = getenv_or_action("TRACING_EXPORTER", action="ignore")
+TRACING_FILE_PATH = getenv_or_action("TRACING_FILE_PATH", default="spans.jsonl")
+TRACING_OTLP_ENDPOINT = getenv_or_action("TRACING_OTLP_ENDPOINT", default="http://localhost:4318")
+
 # Google Cloud Platform
 # DialogFlow
 GCP_PROJECT_ID = getenv_or_action("GCP_PROJECT_ID", action="warn")
@@ -26,7 +34,11 @@ DIALOGFLOW_ENVIRONMENT_ID = getenv_or_action("DIALOGFLOW_ENVIRONMENT_ID", action
 DIALOGFLOW_LANGUAGE_CODE = getenv_or_action("DIALOGFLOW_LANGUAGE_CODE", action="warn")
 SIGNATURE_BUTTONS_MESSAGE = "BUTTONOPTIONS:"
 # Google Maps API
+# Base URL of the Maps web services, e.g. a local upstream simulator
+GMAPS_URL = getenv_or_action("GMAPS_URL", default="https://maps.googleapis.com")
 GMAPS_API_TOKEN = getenv_or_action("GMAPS_API_TOKEN", action="warn")
+# Optional SQLite file that persists the geocoding cache across restarts
+GEOCODE_CACHE_PATH = getenv_or_action("GEOCODE_CACHE_PATH", action="ignore")
 
 # ChatbotLab
 CHATBOT_LAB_API_URL = getenv_or_action("CHATBOT_LAB_API_URL", action="warn")
@@ -38,6 +50,16 @@ CHATBOT_INTEGRATIONS_KEY = getenv_or_action("CHATBOT_INTEGRATIONS_KEY", action="
 CHATBOT_PGM_ACCESS_KEY = getenv_or_action("CHATBOT_PGM_ACCESS_KEY", action="warn")
 CHATBOT_PGM_API_URL = getenv_or_action("CHATBOT_PGM_API_URL", action="warn").rstrip("/")
 
+# IPP
+# Base URL of the IPP geocoding services (pgeo3), e.g. a local upstream simulator
+PGEO3_URL = getenv_or_action("PGEO3_URL", default="https://pgeo3.rio.rj.gov.br")
+# Optional gazetteer data file used instead of the findAddressCandidates geocoder
+IPP_GAZETTEER_PATH = getenv_or_action("IPP_GAZETTEER_PATH", action="ignore")
+# Optional URL of the full neighborhood table, a JSON list of {"id", "name"} objects
+IPP_NEIGHBORHOODS_URL = getenv_or_action("IPP_NEIGHBORHOODS_URL", action="ignore")
+# Comma-separated upstreams whose idempotent calls are hedged, e.g. "ipp"
+HEDGED_UPSTREAMS = getenv_list_or_action("HEDGED_UPSTREAMS", action="ignore")
+
 # SGRC
 SGRC_URL = getenv_or_action("SGRC_URL", action="warn")
 SGRC_AUTHORIZATION_HEADER = getenv_or_action("SGRC_AUTHORIZATION_HEADER", action="warn")
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
-from typing import Annotated
+import hashlib
+from typing import Annotated, Union
+from uuid import UUID
 
 import pendulum
 from fastapi import Depends, HTTPException
@@ -7,13 +9,35 @@ from fastapi.security import HTTPBearer
 
 from chatbot_webhooks import config
 from chatbot_webhooks.models import User
+from chatbot_webhooks.webhooks.cache import TTLCache
+
+token_cache = TTLCache("token", maxsize=config.TOKEN_CACHE_MAXSIZE, ttl=config.TOKEN_CACHE_TTL)
+
+
+def hash_token(token: Union[str, UUID]) -> str:
+    """
+    Returns the key under which a token is cached, so raw tokens are never kept in memory.
+    """
+    return hashlib.sha256(str(token).encode("utf-8")).hexdigest()
+
+
+def invalidate_token(token: Union[str, UUID]) -> None:
+    """
+    Removes a token from the validation cache. Must be called whenever a user changes. Only the
+    cache of the current worker is cleared; other workers notice after `TOKEN_CACHE_TTL`.
+    """
+    token_cache.delete(hash_token(token))
 
 
 async def validate_token(token: Annotated[str, Depends(HTTPBearer())]):
     token = token.credentials
-    user: User = await User.get_or_none(token=token)
-    if not user:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    key = hash_token(token)
+    user: User = token_cache.get(key)
+    if user is None:
+        user = await User.get_or_none(token=token)
+        if not user:
+            raise HTTPException(status_code=401, detail="Invalid token")
+        token_cache.set(key, user)
     if not user.is_active:
         raise HTTPException(status_code=401, detail="Inactive user")
     if user.token_expiry and user.token_expiry < pendulum.now(tz=config.TIMEZONE):
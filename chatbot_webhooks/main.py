@@ -7,7 +7,19 @@ from tortoise.contrib.fastapi import register_tortoise
 
 from chatbot_webhooks import config
 from chatbot_webhooks.db import TORTOISE_ORM
-from chatbot_webhooks.routers import chat, token, webhook
+from chatbot_webhooks.routers import chat, metrics, token, webhook
+from chatbot_webhooks.webhooks.clients import close_sessions, open_sessions
+from chatbot_webhooks.webhooks.gazetteer import get_ipp_gazetteer
+from chatbot_webhooks.webhooks.geo import load_shape_rj
+from chatbot_webhooks.webhooks.metrics import MetricsMiddleware, event_loop_lag_monitor
+from chatbot_webhooks.webhooks.middleware import close_session_async_clients
+from chatbot_webhooks.webhooks.neighborhoods import neighborhood_resolver
+from chatbot_webhooks.webhooks.tracing import TracingMiddleware, exporter
+from chatbot_webhooks.webhooks.utils import (
+    close_credentials,
+    close_geocode_store,
+    get_credentials_from_env,
+)
 
 if config.SENTRY_ENABLE:
     sentry_sdk.init(
@@ -36,8 +48,11 @@ app.add_middleware(
     allow_headers=config.ALLOWED_HEADERS,
     allow_credentials=config.ALLOW_CREDENTIALS,
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 app.include_router(chat.router)
+app.include_router(metrics.router)
 app.include_router(token.router)
 app.include_router(webhook.router)
 
@@ -47,3 +62,28 @@ register_tortoise(
     generate_schemas=False,
     add_exception_handlers=True,
 )
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    await open_sessions()
+    event_loop_lag_monitor.start(config.EVENT_LOOP_LAG_INTERVAL)
+    load_shape_rj()
+    get_ipp_gazetteer(config.IPP_GAZETTEER_PATH)
+    neighborhood_resolver.start()
+    if exporter is not None:
+        exporter.start()
+    if config.GCP_SERVICE_ACCOUNT:
+        await get_credentials_from_env()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    neighborhood_resolver.stop()
+    event_loop_lag_monitor.stop()
+    await close_sessions()
+    await close_session_async_clients()
+    await close_credentials()
+    close_geocode_store()
+    if exporter is not None:
+        await exporter.shutdown()
@@ -7,7 +7,7 @@ class User(Model):
     id = fields.BigIntField(pk=True)
     username = fields.CharField(max_length=100, unique=True)
     is_active = fields.BooleanField(default=True)
-    token = fields.UUIDField()
+    token = fields.UUIDField(unique=True)
     token_expiry = fields.DatetimeField(null=True)
     created_at = fields.DatetimeField(auto_now_add=True)
     updated_at = fields.DatetimeField(auto_now=True)
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import json
 from typing import List
 from uuid import uuid4
 
@@ -8,6 +7,7 @@ from loguru import logger
 
 from chatbot_webhooks import config
 from chatbot_webhooks.dependencies import validate_token
+from chatbot_webhooks.webhooks import codec
 from chatbot_webhooks.webhooks.middleware import detect_intent_text
 from chatbot_webhooks.webhooks.utils import fix_unicode
 
@@ -28,12 +28,11 @@ async def input_ascsac(request: Request) -> Response:
 
     # Get the request body as JSON
     try:
-        body_str = body_bytes.decode("utf-8")
-        body_str = body_str.replace("\n", " ")
-        body_str = body_str.replace("\r", " ")
-        body_str = body_str.replace("\t", " ")
-        body_str = body_str.replace("\\", "")
-        body = json.loads(body_str)
+        body_bytes = body_bytes.replace(b"\n", b" ")
+        body_bytes = body_bytes.replace(b"\r", b" ")
+        body_bytes = body_bytes.replace(b"\t", b" ")
+        body_bytes = body_bytes.replace(b"\\", b"")
+        body = codec.loads(body_bytes)
     except:  # noqa: E722
         logger.error(f"Request {request_id} body is not valid JSON")
         return Response(content="Invalid request body", status_code=400)
@@ -125,10 +124,11 @@ async def input_ascsac(request: Request) -> Response:
 
     # Return the answer
     return Response(
-        content=json.dumps(
+        content=codec.dumps(
             {"answer_messages": answer_messages, "buttons": buttons, "files": files, "order": order}
         ),
         status_code=200,
+        media_type="application/json",
     )
 
 
@@ -146,9 +146,8 @@ async def input_telegram(request: Request) -> Response:
 
     # Get the request body as JSON
     try:
-        body_str = body_bytes.decode("utf-8")
-        body_str = body_str.replace("\n", " ")
-        body = json.loads(body_str)
+        body_bytes = body_bytes.replace(b"\n", b" ")
+        body = codec.loads(body_bytes)
     except:  # noqa: E722
         logger.error(f"Request {request_id} body is not valid JSON")
         return Response(content="Invalid request body", status_code=400)
@@ -176,4 +175,8 @@ async def input_telegram(request: Request) -> Response:
 
     # Return the answer
     logger.info(f"{request_id} - Answers: {answer_messages}")
-    return Response(content=json.dumps({"answer_messages": answer_messages}), status_code=200)
+    return Response(
+        content=codec.dumps({"answer_messages": answer_messages}),
+        status_code=200,
+        media_type="application/json",
+    )
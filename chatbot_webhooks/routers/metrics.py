@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from fastapi import APIRouter, Depends, Response
+
+from chatbot_webhooks.dependencies import validate_token
+from chatbot_webhooks.webhooks.metrics import render
+
+router = APIRouter(prefix="/metrics", tags=["metrics"], dependencies=[Depends(validate_token)])
+
+
+@router.get("/")
+async def get_metrics() -> Response:
+    """Metrics in the Prometheus text format."""
+    return Response(content=render(), media_type="text/plain; version=0.0.4; charset=utf-8")
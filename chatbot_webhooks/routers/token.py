@@ -5,7 +5,7 @@ from fastapi import APIRouter, Depends, HTTPException
 from loguru import logger
 from tortoise.contrib.pydantic import pydantic_model_creator
 
-from chatbot_webhooks.dependencies import validate_token
+from chatbot_webhooks.dependencies import invalidate_token, validate_token
 from chatbot_webhooks.models import User
 
 TokenInPydantic = pydantic_model_creator(
@@ -28,6 +28,7 @@ async def get_tokens() -> list[TokenOutPydantic]:
 async def create_token(user_info: TokenInPydantic) -> TokenOutPydantic:
     """Create a new token."""
     user = await User.create(**user_info.dict(exclude_unset=True), token=uuid4())
+    invalidate_token(user.token)
     logger.info(f"Created token for user {user.username}")
     return await TokenOutPydantic.from_tortoise_orm(user)
 
@@ -40,6 +41,7 @@ async def deactivate_token(token_id: int) -> None:
         raise HTTPException(status_code=404, detail="Token not found")
     user.is_active = False
     await user.save()
+    invalidate_token(user.token)
     logger.info(f"Deactivated token for user {user.username}")
 
 
@@ -51,4 +53,5 @@ async def activate_token(token_id: int) -> None:
         raise HTTPException(status_code=404, detail="Token not found")
     user.is_active = True
     await user.save()
+    invalidate_token(user.token)
     logger.info(f"Activated token for user {user.username}")
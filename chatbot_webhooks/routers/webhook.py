@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
-import json
+import asyncio
+from copy import deepcopy
 from typing import Any, Dict, Tuple, Union
 from uuid import uuid4
 
 from fastapi import APIRouter, Depends, Request, Response
 from loguru import logger
 
+from chatbot_webhooks import config
 from chatbot_webhooks.dependencies import validate_token
-from chatbot_webhooks.webhooks import tags
+from chatbot_webhooks.webhooks import codec, tags  # noqa: F401 (registers the tags)
+from chatbot_webhooks.webhooks.deadline import deadline
+from chatbot_webhooks.webhooks.metrics import track_tag
+from chatbot_webhooks.webhooks.registry import get_tag
+from chatbot_webhooks.webhooks.tracing import span
+from chatbot_webhooks.webhooks.utils import parameters_delta
 
 router = APIRouter(prefix="/webhook", tags=["webhook"], dependencies=[Depends(validate_token)])
 
@@ -23,8 +30,7 @@ async def webhook(request: Request) -> Response:
     # Get the request body as JSON
     try:
         body_bytes: bytes = await request.body()
-        body_str: str = body_bytes.decode("utf-8")
-        body: dict = json.loads(body_str)
+        body: dict = codec.loads(body_bytes)
     except Exception:  # noqa
         logger.error(f"Request {request_id} body is not valid JSON")
         return Response(content="Invalid request body", status_code=400)
@@ -38,14 +44,38 @@ async def webhook(request: Request) -> Response:
 
     # See if we can find a webhook for this tag
     logger.info(f"{request_id} - Tag: {tag}. Calling webhook function")
-    webhook_func = getattr(tags, tag, None)
-    if webhook_func is None or not callable(webhook_func):
+    tag_spec = get_tag(tag)
+    if tag_spec is None:
         logger.error(f"{request_id} - Tag '{tag}' is not implemented")
         return Response(content="Tag is invalid", status_code=400)
+    incoming_parameters: dict = body.get("sessionInfo", {}).get("parameters") or {}
+    missing_parameters = tag_spec.missing_parameters(incoming_parameters)
+    if missing_parameters:
+        logger.warning(f"{request_id} - Tag '{tag}' is missing parameters: {missing_parameters}")
+    # Handlers change the parameters in place, so keep a pristine copy to diff against. Only
+    # nested values (e.g. lists of items) can be changed without replacing them
+    if tag_spec.delta_response:
+        incoming_parameters = {
+            key: deepcopy(value) if isinstance(value, (dict, list)) else value
+            for key, value in incoming_parameters.items()
+        }
 
-    # Call the webhook function
+    # Call the webhook function. Upstream calls inherit the deadline, so the tag can handle
+    # their timeouts itself; a tag still running halfway through the margin is cancelled
+    timed_out = False
+    budget = tag_spec.timeout - config.TAG_TIMEOUT_MARGIN
     try:
-        response: Union[str, Tuple[str, Dict[str, Any]]] = await webhook_func(body)
+        with span(f"tag {tag}", attributes={"tag": tag}), track_tag(tag), deadline(budget):
+            response: Union[str, Tuple[str, Dict[str, Any]]] = await asyncio.wait_for(
+                tag_spec.handler(body), budget + config.TAG_TIMEOUT_MARGIN / 2
+            )
+    except asyncio.TimeoutError as exc:
+        if tag_spec.on_timeout is None:
+            logger.exception(f"{request_id} - Tag '{tag}' timed out: {exc}")
+            raise exc
+        logger.error(f"{request_id} - Tag '{tag}' timed out. Answering {tag_spec.on_timeout}")
+        response = "", dict(tag_spec.on_timeout)
+        timed_out = True
     except Exception as exc:  # noqa
         logger.exception(f"{request_id} - An error occurred: {exc}")
         raise exc
@@ -54,6 +84,7 @@ async def webhook(request: Request) -> Response:
     if isinstance(response, str):
         response_text = response
         session_parameters = {}
+        form_parameters = []
     elif isinstance(response, tuple):
         response_text = response[0]
         session_parameters = response[1]
@@ -70,11 +101,17 @@ async def webhook(request: Request) -> Response:
         logger.error(f"{request_id} - Webhook response is invalid.")
         return Response(content="Webhook response is invalid.", status_code=400)
 
+    # Plain text responses do not touch the session parameters. Timeout answers are already a
+    # delta, as the handler may have left the incoming parameters half changed
+    if tag_spec.delta_response and isinstance(response, tuple) and not timed_out:
+        session_parameters = parameters_delta(incoming_parameters, session_parameters)
+        logger.info(f"{request_id} - Changed session parameters: {list(session_parameters)}")
+
     # Ref: https://cloud.google.com/dialogflow/cx/docs/reference/rest/v3/WebhookResponse
     # Build response
     if form_parameters:
         return Response(
-            content=json.dumps(
+            content=codec.dumps(
                 {
                     "fulfillmentResponse": {
                         "messages": [
@@ -97,11 +134,12 @@ async def webhook(request: Request) -> Response:
                     },
                     "payload": {"telephony": {"caller_id": "+18558363987"}},
                 }
-            )
+            ),
+            media_type="application/json",
         )
     else:
         return Response(
-            content=json.dumps(
+            content=codec.dumps(
                 {
                     "fulfillmentResponse": {
                         "messages": [
@@ -119,5 +157,6 @@ async def webhook(request: Request) -> Response:
                     },
                     "payload": {"telephony": {"caller_id": "+18558363987"}},
                 }
-            )
+            ),
+            media_type="application/json",
         )
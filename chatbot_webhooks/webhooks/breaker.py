@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breakers for the upstreams. After `failure_threshold` consecutive failures the breaker
+of an upstream opens and calls to it fail at once with `CircuitOpenError`, which the tags
+handle like any other upstream error, instead of piling up on a service that is down. After
+`recovery_timeout` seconds the breaker is half-open and lets a few trial calls through: a
+success closes it, a failure opens it again.
+"""
+from contextlib import asynccontextmanager
+from time import monotonic
+from typing import AsyncIterator, Dict, Tuple, Type
+
+import aiohttp
+from loguru import logger
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream whose circuit breaker is open.
+    """
+
+    def __init__(self, upstream: str):
+        super().__init__(f"Circuit breaker of '{upstream}' is open")
+        self.upstream = upstream
+
+
+def is_failure(exc: BaseException) -> bool:
+    """
+    Tells whether an exception raised while calling an upstream counts against it. Client
+    errors are answers (e.g. a CPF that is not registered) and cancellations say nothing about
+    the upstream.
+    """
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500
+    return isinstance(exc, Exception)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int,
+        recovery_timeout: float,
+        half_open_max_calls: int = 1,
+    ):
+        """
+        Args:
+            name (str): Upstream name, used in logs and metrics.
+            failure_threshold (int): Consecutive failures that open the breaker.
+            recovery_timeout (float): Seconds the breaker stays open before trial calls.
+            half_open_max_calls (int, optional): Trial calls let through at a time while
+                half-open. Defaults to 1.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+
+    def __repr__(self) -> str:
+        return f"<CircuitBreaker {self.name} {self.state}>"
+
+    def allow(self) -> bool:
+        """
+        Tells whether a call may go through, moving from open to half-open once the recovery
+        timeout has passed.
+        """
+        if self.state == OPEN:
+            if monotonic() - self._opened_at < self.recovery_timeout:
+                return False
+            self.state = HALF_OPEN
+            self._trial_calls = 0
+            logger.info(f"Circuit breaker of '{self.name}' is half-open")
+        if self.state == HALF_OPEN:
+            if self._trial_calls >= self.half_open_max_calls:
+                return False
+            self._trial_calls += 1
+        return True
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logger.info(f"Circuit breaker of '{self.name}' is closed")
+        self.state = CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opened += 1
+                logger.warning(
+                    f"Circuit breaker of '{self.name}' is open after {self.failures} failures"
+                )
+            self.state = OPEN
+            self._opened_at = monotonic()
+
+    def reset(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_calls = 0
+
+    @asynccontextmanager
+    async def guard(self, ignore: Tuple[Type[BaseException], ...] = ()) -> AsyncIterator[None]:
+        """
+        Wraps a call to the upstream, recording its outcome.
+
+        Args:
+            ignore (Tuple[Type[BaseException], ...], optional): Exceptions that are answers of
+                the upstream rather than failures, e.g. business rule errors. Defaults to ().
+
+        Raises:
+            CircuitOpenError: If the breaker does not let the call through.
+        """
+        if not self.allow():
+            self.rejected += 1
+            raise CircuitOpenError(self.name)
+        try:
+            yield
+        except BaseException as exc:
+            if is_failure(exc) and not isinstance(exc, ignore):
+                self.record_failure()
+            elif isinstance(exc, Exception):
+                self.record_success()
+            elif self.state == HALF_OPEN:
+                # A cancelled trial call gives its place to the next one
+                self._trial_calls -= 1
+            raise
+        self.record_success()
+
+
+BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker of an upstream, created on first use with the settings in
+    `CIRCUIT_BREAKER_OVERRIDES` or the defaults.
+    """
+    breaker = BREAKERS.get(upstream)
+    if breaker is None:
+        # Read on first use, so that breakers registered beforehand (e.g. in tests) need no
+        # settings
+        from chatbot_webhooks import config
+
+        settings = {
+            "failure_threshold": config.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            "recovery_timeout": config.CIRCUIT_BREAKER_RECOVERY_TIMEOUT,
+            "half_open_max_calls": config.CIRCUIT_BREAKER_HALF_OPEN_MAX_CALLS,
+            **config.CIRCUIT_BREAKER_OVERRIDES.get(upstream, {}),
+        }
+        breaker = BREAKERS[upstream] = CircuitBreaker(upstream, **settings)
+    return breaker
+
+
+def circuit_breaker(upstream: str, ignore: Tuple[Type[BaseException], ...] = ()):
+    """
+    Shorthand for `get_breaker(upstream).guard(ignore)`, e.g.
+
+        async with circuit_breaker("ipp"):
+            async with session.get(url) as response:
+                data = await response.json()
+    """
+    return get_breaker(upstream).guard(ignore)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+# Every live TTLCache, so they can be monitored
+CACHES: "weakref.WeakSet[TTLCache]" = weakref.WeakSet()
+
+
+class TTLCache:
+    """
+    In-memory LRU cache whose entries also expire after a time-to-live. Lookups count hits and
+    misses so the cache can be monitored. Expired entries are kept until evicted, so they can
+    still be served (see `get_stale`) while the upstream behind the cache is down.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        """
+        Args:
+            name (str): Name used in logs and metrics.
+            maxsize (int): Maximum number of entries. The least recently used entry is evicted
+                when it is exceeded.
+            ttl (float): Default time-to-live of the entries, in seconds.
+        """
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        CACHES.add(self)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[0] > time.monotonic()
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value stored for `key`, or `default` if it is missing or expired.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[0] <= time.monotonic():
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value stored for `key` even if it has expired, or `default` if it is missing.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self.stale_hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        """
+        Stores `value` for `key`, evicting the least recently used entry if the cache is full.
+        """
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class SQLiteStore:
+    """
+    Persistent key-value store backed by a local SQLite file, used to keep cached values across
+    restarts and share them between workers. Values must be JSON serializable.
+    """
+
+    def __init__(self, path: str, table: str):
+        self.table = table
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            f'CREATE TABLE IF NOT EXISTS "{table}" '
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Returns the value stored for `key`, or `None` if it is missing or expired.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                f'SELECT value, expires_at FROM "{self.table}" WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._connection.execute(
+                f'INSERT OR REPLACE INTO "{self.table}" (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), time.time() + ttl),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._connection.execute(f'DELETE FROM "{self.table}" WHERE key = ?', (key,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+from contextlib import asynccontextmanager
+from time import perf_counter
+from types import SimpleNamespace
+from typing import AsyncIterator, Dict, List, Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+from loguru import logger
+
+from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.metrics import (
+    UPSTREAM_DURATION,
+    UPSTREAM_IN_FLIGHT,
+    UPSTREAM_RESPONSE_BYTES,
+    UPSTREAM_RETRIES,
+)
+from chatbot_webhooks.webhooks.tracing import Span, current_span, start_span
+
+# Upstreams that are not named after the host they are on
+DISCORD_URLS = ["https://discord.com", "https://discordapp.com"]
+
+_sessions: Dict[Tuple[str, str, int], aiohttp.ClientSession] = {}
+
+
+def get_origin(url: str) -> Tuple[str, str, int]:
+    """
+    Returns the (scheme, host, port) tuple that identifies the upstream of an URL.
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme or "https"
+    port = parts.port or (443 if scheme == "https" else 80)
+    return scheme, parts.hostname or "", port
+
+
+def known_upstreams() -> List[Tuple[str, str]]:
+    """
+    Returns the (base URL, name) pairs of the upstreams with friendlier names, read from
+    `config` so that they still match when the upstreams are pointed at a simulator.
+    """
+    upstreams = [
+        (config.PGEO3_URL, "ipp"),
+        (config.GMAPS_URL, "google_maps"),
+        (config.CHATBOT_LAB_API_URL, "chatbot_lab"),
+        (config.DISCORD_WEBHOOK_NEW_TICKET, "discord"),
+    ] + [(url, "discord") for url in DISCORD_URLS]
+    return [(url.rstrip("/"), name) for url, name in upstreams if url]
+
+
+def upstream_name(url: str) -> str:
+    """
+    Returns the name under which calls to an URL are measured. Calls to chatbot-integrations
+    are named after their endpoint (e.g. `integrations/person`), other upstreams after their
+    base URL or host, so that secrets in paths (e.g. Discord webhooks) never end up in labels.
+    """
+    url = url.split("?")[0]
+    integrations = (config.CHATBOT_INTEGRATIONS_URL or "").rstrip("/")
+    if integrations and (url == integrations or url.startswith(integrations + "/")):
+        endpoint = url[len(integrations) :].strip("/")  # noqa: E203
+        return f"integrations/{endpoint}" if endpoint else "integrations"
+    for base_url, name in known_upstreams():
+        if url == base_url or url.startswith(base_url + "/"):
+            return name
+    return urlsplit(url).hostname or "unknown"
+
+
+def finish_upstream_call(upstream: str, span: Span, status: str, start: float) -> None:
+    UPSTREAM_DURATION.observe(perf_counter() - start, upstream, status)
+    UPSTREAM_IN_FLIGHT.dec(upstream)
+    span.set_attribute("upstream.status", status)
+    span.end()
+
+
+async def on_request_start(session, context: SimpleNamespace, params) -> None:
+    request_ctx = context.trace_request_ctx or {}
+    context.upstream = request_ctx.get("upstream") or upstream_name(str(params.url))
+    context.start = perf_counter()
+    context.span = start_span(
+        f"{params.method} {context.upstream}",
+        kind="client",
+        attributes={"http.method": params.method, "upstream": context.upstream},
+    )
+    if request_ctx.get("attempt", 1) > 1:
+        UPSTREAM_RETRIES.inc(context.upstream)
+        context.span.set_attribute("upstream.attempt", request_ctx["attempt"])
+    UPSTREAM_IN_FLIGHT.inc(context.upstream)
+
+
+async def on_request_end(session, context: SimpleNamespace, params) -> None:
+    response = params.response
+    if response.content_length is not None:
+        context.span.set_attribute("http.response_content_length", response.content_length)
+    finish_upstream_call(context.upstream, context.span, str(response.status), context.start)
+
+
+async def on_request_exception(session, context: SimpleNamespace, params) -> None:
+    context.span.record_exception(params.exception)
+    finish_upstream_call(
+        context.upstream, context.span, type(params.exception).__name__, context.start
+    )
+
+
+async def on_response_chunk_received(session, context: SimpleNamespace, params) -> None:
+    UPSTREAM_RESPONSE_BYTES.inc(context.upstream, amount=len(params.chunk))
+
+
+def build_trace_config() -> aiohttp.TraceConfig:
+    """
+    Instruments the pooled sessions: every call records its latency (up to the response
+    headers), status and response size per upstream, and opens a client span under the current
+    span. Callers can name the upstream and flag retries with
+    `trace_request_ctx={"upstream": ..., "attempt": ...}`.
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    trace_config.on_response_chunk_received.append(on_response_chunk_received)
+    return trace_config
+
+
+@asynccontextmanager
+async def track_upstream(upstream: str, operation: str, attempt: int = 1) -> AsyncIterator[Span]:
+    """
+    Measures a call to an upstream that is not made through the pooled sessions (e.g. SGRC or
+    Dialogflow), with the same metrics and spans.
+    """
+    upstream_span = start_span(
+        f"{operation} {upstream}", kind="client", attributes={"upstream": upstream}
+    )
+    if attempt > 1:
+        UPSTREAM_RETRIES.inc(upstream)
+        upstream_span.set_attribute("upstream.attempt", attempt)
+    token = current_span.set(upstream_span)
+    UPSTREAM_IN_FLIGHT.inc(upstream)
+    start = perf_counter()
+    status = "ok"
+    try:
+        yield upstream_span
+    except BaseException as exc:
+        status = type(exc).__name__
+        upstream_span.record_exception(exc)
+        raise
+    finally:
+        current_span.reset(token)
+        finish_upstream_call(upstream, upstream_span, status, start)
+
+
+def get_session(url: str) -> aiohttp.ClientSession:
+    """
+    Returns the pooled session for the upstream host of the given URL. Sessions keep their
+    connections alive between calls, so DNS, TCP and TLS are only paid once per host.
+
+    Args:
+        url (str): Any URL on the upstream host.
+
+    Returns:
+        aiohttp.ClientSession: A session that must not be closed by the caller.
+    """
+    origin = get_origin(url)
+    session = _sessions.get(origin)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit_per_host=config.HTTP_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+        )
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[build_trace_config()])
+        _sessions[origin] = session
+        logger.info(f"Opened HTTP session for {origin[0]}://{origin[1]}:{origin[2]}")
+    return session
+
+
+async def open_sessions() -> None:
+    """
+    Opens the sessions for the upstreams that are called on every conversation.
+    """
+    for url in [config.PGEO3_URL, config.GMAPS_URL, config.CHATBOT_INTEGRATIONS_URL]:
+        if url:
+            get_session(url)
+
+
+async def close_sessions() -> None:
+    """
+    Closes every pooled session. Must be called on application shutdown.
+    """
+    while _sessions:
+        origin, session = _sessions.popitem()
+        await session.close()
+        logger.info(f"Closed HTTP session for {origin[0]}://{origin[1]}:{origin[2]}")
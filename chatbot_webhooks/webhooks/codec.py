@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+from typing import Any, Dict, Union
+
+from loguru import logger
+
+from chatbot_webhooks import config
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+class JSONCodec:
+    """
+    Standard library JSON codec. Decodes bytes and encodes straight to UTF-8 bytes, without the
+    whitespace and ASCII escaping of the `json.dumps` defaults, as `orjson` does. Responses with
+    these bytes must be sent as `application/json`, whose encoding is UTF-8.
+    """
+
+    name = "json"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    `orjson` codec. Values that `orjson` cannot encode (e.g. integers above 64 bits) are
+    encoded by the standard library instead.
+    """
+
+    name = "orjson"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+        except TypeError:
+            return super().dumps(obj)
+
+
+CODECS: Dict[str, JSONCodec] = {"json": JSONCodec()}
+if orjson is not None:
+    CODECS["orjson"] = OrjsonCodec()
+
+
+def get_codec(name: str = None) -> JSONCodec:
+    """
+    Returns a JSON codec by name. `None` or `"auto"` picks the fastest one available.
+    """
+    if not name or name == "auto":
+        return CODECS.get("orjson", CODECS["json"])
+    if name not in CODECS:
+        logger.warning(f"JSON codec '{name}' is not available, using the standard library")
+        return CODECS["json"]
+    return CODECS[name]
+
+
+codec = get_codec(config.JSON_CODEC)
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decodes a JSON document, given as bytes or as a string.
+    """
+    return codec.loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """
+    Encodes an object as JSON, returning UTF-8 bytes.
+    """
+    return codec.dumps(obj)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Request-scoped deadline. The webhook router sets it from the time budget of the tag being
+handled and every upstream call made on the way gets only the time that is left, so no
+coroutine or pooled connection is kept busy after Dialogflow has given up on the request.
+"""
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import monotonic
+from typing import Awaitable, Iterator, Optional, TypeVar
+
+import aiohttp
+
+T = TypeVar("T")
+
+# Monotonic time by which the request being handled must be answered
+current_deadline: ContextVar[Optional[float]] = ContextVar("current_deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """
+    Raised when the time budget of the request runs out.
+    """
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[float]:
+    """
+    Sets the deadline of the code run inside the block, including the tasks it creates. A
+    deadline set inside another one can only shorten it.
+
+    Args:
+        seconds (float): Time budget, from now.
+
+    Returns:
+        Iterator[float]: The deadline, in `time.monotonic` time.
+    """
+    at = monotonic() + seconds
+    outer = current_deadline.get()
+    if outer is not None:
+        at = min(at, outer)
+    token = current_deadline.set(at)
+    try:
+        yield at
+    finally:
+        current_deadline.reset(token)
+
+
+@contextmanager
+def without_deadline() -> Iterator[None]:
+    """
+    Lifts the deadline, for work shared between requests (e.g. refreshing a token) that must
+    not fail because the request that happened to start it is out of time.
+    """
+    token = current_deadline.set(None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    Returns the seconds left until the deadline, or `None` if there is none.
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed.
+    """
+    at = current_deadline.get()
+    if at is None:
+        return None
+    left = at - monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("The time budget of the request ran out")
+    return left
+
+
+def upstream_timeout() -> aiohttp.ClientTimeout:
+    """
+    Returns the timeout of a call made through the pooled sessions: the time left until the
+    deadline, capped at `HTTP_DEFAULT_TIMEOUT`.
+
+    Raises:
+        DeadlineExceeded: If the deadline has passed, so the call is not even attempted.
+    """
+    # Only this helper needs the settings, so the deadline itself works without them
+    from chatbot_webhooks import config
+
+    left = remaining()
+    if left is None or left > config.HTTP_DEFAULT_TIMEOUT:
+        left = config.HTTP_DEFAULT_TIMEOUT
+    return aiohttp.ClientTimeout(total=left)
+
+
+async def within_deadline(awaitable: Awaitable[T]) -> T:
+    """
+    Awaits something that cannot be given a timeout itself (e.g. a call made by a third-party
+    client), cancelling it when the deadline passes.
+
+    Raises:
+        DeadlineExceeded: If the deadline passes first.
+    """
+    try:
+        left = remaining()
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        # Tells the deadline passing apart from a timeout raised by the call itself
+        remaining()
+        raise
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+import gzip
+import json
+import math
+import re
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+import numpy as np
+from jellyfish import jaro_similarity
+from loguru import logger
+from unidecode import unidecode
+
+from chatbot_webhooks.webhooks.geo import haversine_distances
+
+# Size of the spatial index cells, in degrees (about 1.1 km)
+GRID_CELL_SIZE = 0.01
+
+# Street type abbreviations expanded before matching
+ABBREVIATIONS = {
+    "r": "rua",
+    "av": "avenida",
+    "avn": "avenida",
+    "estr": "estrada",
+    "est": "estrada",
+    "trav": "travessa",
+    "tv": "travessa",
+    "pc": "praca",
+    "pca": "praca",
+    "lgo": "largo",
+    "al": "alameda",
+    "rod": "rodovia",
+    "vd": "viaduto",
+    "pres": "presidente",
+    "dr": "doutor",
+    "sen": "senador",
+    "gen": "general",
+}
+
+
+def normalize_street_name(name: str) -> str:
+    """
+    Removes accents and punctuation, lowercases a street name and expands the usual
+    abbreviations.
+
+    Exemplos:
+    >>> normalize_street_name("Rua Conde de Bonfim,  Tijuca")
+    'rua conde de bonfim tijuca'
+    >>> normalize_street_name("Av. Pres. Vargas")
+    'avenida presidente vargas'
+    """
+    name = re.sub(r"[^a-z0-9 ]", " ", unidecode(name).lower())
+    return " ".join(ABBREVIATIONS.get(word, word) for word in name.split())
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Returns the character trigrams of a normalized text, padded so that word boundaries count.
+    """
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}  # noqa: E203
+
+
+class Street:
+    __slots__ = ("cl", "name", "neighborhood", "neighborhood_key", "lat", "lng", "trigrams")
+
+    def __init__(self, cl: str, name: str, neighborhood: str, lat: float, lng: float):
+        self.cl = str(cl)
+        self.name = name
+        self.neighborhood = neighborhood
+        self.neighborhood_key = normalize_street_name(neighborhood or "")
+        self.lat = float(lat)
+        self.lng = float(lng)
+        self.trigrams = trigrams(normalize_street_name(name))
+
+    def as_candidate(self, score: float = 100.0) -> dict:
+        """
+        Returns the street in the format of a `findAddressCandidates` candidate.
+        """
+        return {
+            "address": f"{self.name}, {self.neighborhood}" if self.neighborhood else self.name,
+            "location": {"x": self.lng, "y": self.lat},
+            "score": score,
+            "attributes": {"cl": self.cl},
+        }
+
+
+class IPPGazetteer:
+    """
+    In-memory gazetteer of the IPP streets. Names are indexed by trigram for fuzzy lookups and
+    representative coordinates are indexed in a regular grid for nearest-street lookups.
+    """
+
+    def __init__(self, streets: List[Street], version: str = None):
+        self.version = version
+        self.streets = streets
+        self._trigram_index: Dict[str, List[int]] = defaultdict(list)
+        self._grid_index: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, street in enumerate(streets):
+            for trigram in street.trigrams:
+                self._trigram_index[trigram].append(i)
+            self._grid_index[self._cell(street.lat, street.lng)].append(i)
+
+    def __len__(self) -> int:
+        return len(self.streets)
+
+    @classmethod
+    def from_file(cls, path: Union[str, Path]) -> "IPPGazetteer":
+        """
+        Loads a gazetteer data file, optionally gzipped, in the following format:
+            {
+                "version": "2024-01-15",
+                "streets": [
+                    ["cl", "name", "neighborhood", lat, lng],
+                ]
+            }
+        """
+        opener = gzip.open if str(path).endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        streets = [Street(*row) for row in data["streets"]]
+        return cls(streets, version=data.get("version"))
+
+    @staticmethod
+    def _cell(lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / GRID_CELL_SIZE), math.floor(lng / GRID_CELL_SIZE)
+
+    @staticmethod
+    def _similarity(query: Set[str], street: Street) -> float:
+        # Dice coefficient of the trigrams
+        return 2 * len(query & street.trigrams) / (len(query) + len(street.trigrams))
+
+    def search(
+        self, name: str, neighborhood: str = None, limit: int = 20, min_score: float = 0.5
+    ) -> List[Tuple[Street, float]]:
+        """
+        Fuzzy searches streets by name. Streets in the given neighborhood come first, then the
+        most similar ones. Streets tied with the last one kept are returned too, so the results
+        never depend on the order of the data file.
+
+        Args:
+            name (str): Street name, as typed or as returned by Google.
+            neighborhood (str, optional): Neighborhood whose streets come first. Defaults to
+                None.
+            limit (int, optional): Maximum number of results, ties aside. Defaults to 20.
+            min_score (float, optional): Minimum trigram similarity (Dice coefficient).
+                Defaults to 0.5.
+
+        Returns:
+            List[Tuple[Street, float]]: Streets and their similarity, best first.
+        """
+        query = trigrams(normalize_street_name(name))
+        if not query:
+            return []
+        wanted = normalize_street_name(neighborhood) if neighborhood else None
+        common: Dict[int, int] = defaultdict(int)
+        for trigram in query:
+            for i in self._trigram_index.get(trigram, ()):
+                common[i] += 1
+        scored: List[Tuple[bool, float, int]] = []
+        for i, count in common.items():
+            street = self.streets[i]
+            score = 2 * count / (len(query) + len(street.trigrams))
+            if score >= min_score:
+                scored.append((street.neighborhood_key == wanted, score, i))
+        scored.sort(key=lambda item: (not item[0], -item[1], item[2]))
+        end = limit
+        while 0 < end < len(scored) and scored[end][:2] == scored[limit - 1][:2]:
+            end += 1
+        return [(self.streets[i], score) for _, score, i in scored[:end]]
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        name: str = None,
+        limit: int = 1,
+        min_score: float = 0.5,
+        max_rings: int = 5,
+    ) -> List[Tuple[Street, float]]:
+        """
+        Returns the streets whose representative coordinates are closest to a point, searching
+        the grid cells around it ring by ring.
+
+        Args:
+            lat (float): Latitude of the point.
+            lng (float): Longitude of the point.
+            name (str, optional): Only streets whose name is similar to this one are returned.
+                Defaults to None, which returns any street.
+            limit (int, optional): Maximum number of results. Defaults to 1.
+            min_score (float, optional): Minimum trigram similarity to `name`. Defaults to 0.5.
+            max_rings (int, optional): Rings of cells searched around the point's cell.
+                Defaults to 5.
+
+        Returns:
+            List[Tuple[Street, float]]: Streets and their distance in meters, closest first.
+        """
+        lat, lng = float(lat), float(lng)
+        query = trigrams(normalize_street_name(name)) if name else None
+        row, col = self._cell(lat, lng)
+        found: List[int] = []
+        last_ring = max_rings
+        for ring in range(max_rings + 1):
+            for d_row in range(-ring, ring + 1):
+                for d_col in range(-ring, ring + 1):
+                    if max(abs(d_row), abs(d_col)) == ring:
+                        found.extend(
+                            i
+                            for i in self._grid_index.get((row + d_row, col + d_col), ())
+                            if query is None
+                            or self._similarity(query, self.streets[i]) >= min_score
+                        )
+            # Streets in the next ring may still be closer than the ones found so far
+            if len(found) >= limit and last_ring == max_rings:
+                last_ring = ring + 1
+            if ring >= last_ring:
+                break
+        if not found:
+            return []
+        distances = haversine_distances(
+            lat,
+            lng,
+            [self.streets[i].lat for i in found],
+            [self.streets[i].lng for i in found],
+        )
+        order = np.argsort(distances, kind="stable")[:limit]
+        return [(self.streets[found[i]], float(distances[i])) for i in order]
+
+    def find_address_candidates(
+        self, address: str, limit: int = 20, lat: float = None, lng: float = None
+    ) -> List[dict]:
+        """
+        Local equivalent of the IPP `findAddressCandidates` geocoder for "street, neighborhood"
+        queries. Candidates from every neighborhood come back, those of the given one first,
+        and the caller picks among them, just like with the upstream service. If no street of
+        the given neighborhood matches, no candidates are returned, so that the caller asks the
+        upstream service, which knows more neighborhood names than the data file.
+
+        When a point is given, the neighborhood is not known and the candidates are instead the
+        streets with the given name closest to the point, so picking the closest candidate
+        gives the same street as with the upstream service.
+        """
+        name, _, neighborhood = address.partition(",")
+        if lat is not None and lng is not None:
+            return [
+                street.as_candidate()
+                for street, _ in self.nearest(lat, lng, name=name, limit=limit)
+            ]
+        neighborhood = neighborhood.strip()
+        results = self.search(name, neighborhood=neighborhood or None, limit=limit)
+        if neighborhood and not any(
+            street.neighborhood_key == normalize_street_name(neighborhood) for street, _ in results
+        ):
+            return []
+        return [street.as_candidate(score=round(score * 100, 2)) for street, score in results]
+
+
+def rank_ipp_candidates(
+    candidates: List[dict],
+    reference: str = None,
+    lat: float = None,
+    lng: float = None,
+    k: int = 1,
+) -> List[Tuple[dict, float]]:
+    """
+    Ranks IPP geocoder candidates, either by distance to a point or by text similarity of their
+    address to a reference. Only candidates whose address contains a neighborhood (i.e. a
+    comma) are considered, and ties keep the upstream order.
+
+    Args:
+        candidates (List[dict]): Candidates as returned by `findAddressCandidates`.
+        reference (str, optional): Address to compare against. Used when no point is given.
+        lat (float, optional): Latitude of the point.
+        lng (float, optional): Longitude of the point.
+        k (int, optional): Number of candidates to return. Defaults to 1.
+
+    Returns:
+        List[Tuple[dict, float]]: Best candidates with their distance in meters (closest first)
+            or their similarity (most similar first).
+    """
+    if not candidates:
+        return []
+    addresses = [candidato["address"] for candidato in candidates]
+    has_neighborhood = np.fromiter(("," in address for address in addresses), dtype=bool)
+    if lat is not None and lng is not None:
+        scores = haversine_distances(
+            lat,
+            lng,
+            [candidato["location"]["y"] for candidato in candidates],
+            [candidato["location"]["x"] for candidato in candidates],
+        )
+        valid = has_neighborhood
+        order = np.argsort(scores, kind="stable")
+    else:
+        scores = np.fromiter(
+            (jaro_similarity(address, reference) for address in addresses), dtype=float
+        )
+        valid = has_neighborhood & (scores > 0)
+        order = np.argsort(-scores, kind="stable")
+    order = order[valid[order]][:k]
+    return [(candidates[i], float(scores[i])) for i in order]
+
+
+_gazetteer: Optional[IPPGazetteer] = None
+_gazetteer_failed = False
+
+
+def get_ipp_gazetteer(path: Optional[Union[str, Path]]) -> Optional[IPPGazetteer]:
+    """
+    Returns the IPP gazetteer, loading it from `path` (`IPP_GAZETTEER_PATH`) on the first call.
+    Returns `None` when no path is set or the file cannot be loaded, in which case callers must
+    fall back to the upstream geocoder.
+    """
+    global _gazetteer, _gazetteer_failed
+    if _gazetteer is None and path and not _gazetteer_failed:
+        try:
+            _gazetteer = IPPGazetteer.from_file(path)
+            logger.info(
+                f"Loaded IPP gazetteer version {_gazetteer.version} with {len(_gazetteer)} streets"
+            )
+        except Exception as exc:  # noqa
+            logger.exception(f"Failed to load IPP gazetteer: {exc}")
+            _gazetteer_failed = True
+    return _gazetteer
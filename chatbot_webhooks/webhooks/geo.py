@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+
+SHAPE_RJ_PATH = Path(__file__).parent.parent.parent / "shape_rj.geojson"
+
+# Maximum number of point/edge pairs evaluated at once in bulk checks
+CHUNK_SIZE = 1_000_000
+
+
+class PolygonIndex:
+    """
+    Point-in-polygon engine for (Multi)Polygon GeoJSON geometries. Every polygon is stored as a
+    bounding box plus the arrays of its edges, so a check only runs the ray-casting (even-odd)
+    test against the edges of polygons whose bounding box contains the point.
+    """
+
+    def __init__(self, polygons: List[List[np.ndarray]]):
+        """
+        Args:
+            polygons (List[List[np.ndarray]]): Polygons as lists of rings, each ring a (N, 2)
+                array of (x, y) coordinates. Interior rings (holes) are handled by the
+                even-odd rule.
+        """
+        self.bboxes = np.empty((len(polygons), 4))
+        self.edges: List[np.ndarray] = []
+        for i, rings in enumerate(polygons):
+            vertices = np.concatenate(rings)
+            self.bboxes[i] = (*vertices.min(axis=0), *vertices.max(axis=0))
+            edges = np.concatenate([np.hstack([ring, np.roll(ring, -1, axis=0)]) for ring in rings])
+            # Horizontal edges never cross a horizontal ray
+            x1, y1, x2, y2 = edges[edges[:, 1] != edges[:, 3]].T
+            self.edges.append(np.stack([x1, y1, y2, (x2 - x1) / (y2 - y1)]))
+
+    @classmethod
+    def from_geojson(cls, geojson: dict) -> "PolygonIndex":
+        """
+        Builds the index from a GeoJSON FeatureCollection, Feature or geometry object.
+        """
+        if geojson["type"] == "FeatureCollection":
+            geometries = [feature["geometry"] for feature in geojson["features"]]
+        elif geojson["type"] == "Feature":
+            geometries = [geojson["geometry"]]
+        else:
+            geometries = [geojson]
+        polygons = []
+        for geometry in geometries:
+            if geometry["type"] == "Polygon":
+                coordinates = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                coordinates = geometry["coordinates"]
+            else:
+                raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+            for polygon in coordinates:
+                polygons.append([np.asarray(ring, dtype=float)[:, :2] for ring in polygon])
+        return cls(polygons)
+
+    def contains(
+        self, x: Union[float, np.ndarray], y: Union[float, np.ndarray]
+    ) -> Union[bool, np.ndarray]:
+        """
+        Checks whether points are inside any of the polygons.
+
+        Args:
+            x (Union[float, np.ndarray]): X coordinate (longitude), or an array of them.
+            y (Union[float, np.ndarray]): Y coordinate (latitude), or an array of them.
+
+        Returns:
+            Union[bool, np.ndarray]: Whether the point is inside, or a boolean array with one
+                entry per point.
+        """
+        if np.ndim(x) == 0 and np.ndim(y) == 0:
+            return self._contains_point(float(x), float(y))
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        inside = np.zeros(x.shape, dtype=bool)
+        in_bbox = (
+            (x[:, None] >= self.bboxes[:, 0])
+            & (y[:, None] >= self.bboxes[:, 1])
+            & (x[:, None] <= self.bboxes[:, 2])
+            & (y[:, None] <= self.bboxes[:, 3])
+        )
+        for i in np.flatnonzero(in_bbox.any(axis=0)):
+            candidates = np.flatnonzero(in_bbox[:, i] & ~inside)
+            x1, y1, y2, slope = self.edges[i]
+            step = max(CHUNK_SIZE // max(len(x1), 1), 1)
+            for start in range(0, len(candidates), step):
+                chunk = candidates[start : start + step]  # noqa: E203
+                px = x[chunk, None]
+                py = y[chunk, None]
+                crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * slope)
+                inside[chunk] = np.count_nonzero(crosses, axis=1) % 2 == 1
+        return inside
+
+    def _contains_point(self, x: float, y: float) -> bool:
+        bboxes = self.bboxes
+        in_bbox = (
+            (x >= bboxes[:, 0]) & (y >= bboxes[:, 1]) & (x <= bboxes[:, 2]) & (y <= bboxes[:, 3])
+        )
+        for i in np.flatnonzero(in_bbox):
+            x1, y1, y2, slope = self.edges[i]
+            crosses = ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * slope)
+            if np.count_nonzero(crosses) % 2 == 1:
+                return True
+        return False
+
+
+_shape_rj: PolygonIndex = None
+
+
+def load_shape_rj(path: Union[str, Path] = SHAPE_RJ_PATH) -> PolygonIndex:
+    """
+    Loads the Rio de Janeiro municipality boundary. It is parsed only once per process, later
+    calls return the same index.
+
+    Args:
+        path (Union[str, Path], optional): GeoJSON file with the boundary. Defaults to
+            `SHAPE_RJ_PATH`.
+
+    Returns:
+        PolygonIndex: The boundary, ready for repeated point-in-polygon checks.
+    """
+    global _shape_rj
+    if _shape_rj is None:
+        with open(path, "r", encoding="utf-8") as f:
+            _shape_rj = PolygonIndex.from_geojson(json.load(f))
+    return _shape_rj
+
+
+def is_inside_rio(
+    lat: Union[float, np.ndarray], lng: Union[float, np.ndarray]
+) -> Union[bool, np.ndarray]:
+    """
+    Checks whether points fall inside the city of Rio de Janeiro.
+
+    Args:
+        lat (Union[float, np.ndarray]): Latitude, or an array of latitudes.
+        lng (Union[float, np.ndarray]): Longitude, or an array of longitudes.
+
+    Returns:
+        Union[bool, np.ndarray]: Whether the point is inside the city, or a boolean array with
+            one entry per point.
+
+    Examples:
+    >>> is_inside_rio(-22.9068, -43.1729)
+    True
+    >>> is_inside_rio(np.array([-22.9068, -22.8833]), np.array([-43.1729, -43.1036]))
+    array([ True, False])
+    """
+    return load_shape_rj().contains(lng, lat)
+
+
+def haversine_distances(lat: float, lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distances from one point to many, using the haversine formula on a sphere
+    of the Earth's mean radius (6371 km).
+
+    Args:
+        lat (float): Latitude of the origin.
+        lng (float): Longitude of the origin.
+        lats (np.ndarray): Latitudes of the destinations.
+        lngs (np.ndarray): Longitudes of the destinations.
+
+    Returns:
+        np.ndarray: Distances in meters.
+    """
+    lat1 = np.radians(float(lat))
+    lng1 = np.radians(float(lng))
+    lat2 = np.radians(np.asarray(lats, dtype=float))
+    lng2 = np.radians(np.asarray(lngs, dtype=float))
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * 6371.0 * 1000 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
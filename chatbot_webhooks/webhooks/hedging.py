@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Hedged requests. When an idempotent call to an upstream listed in `HEDGED_UPSTREAMS` has not
+answered by the `HEDGE_QUANTILE` of the latencies recently observed for that upstream, a second,
+identical call is sent and whichever answers first wins, the other one being cancelled. This
+cuts the long tail of upstreams that are usually fast but sometimes stall. The extra calls are
+limited by a budget shared by all upstreams, so hedging can never more than slightly increase
+the load on a service that is slow for everyone.
+"""
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, TypeVar
+
+from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.metrics import HEDGE_DELAY, HEDGED_REQUESTS
+
+T = TypeVar("T")
+
+
+class LatencyWindow:
+    """
+    Latencies of the latest calls to an upstream. Calls that fail, time out or are cancelled
+    count with the time they took until then, so slow calls are never left out.
+    """
+
+    def __init__(self, size: int):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Returns the nearest-rank `q` quantile of the window, or `None` if it has fewer than
+        `HEDGE_MIN_SAMPLES` latencies.
+        """
+        if len(self._samples) < config.HEDGE_MIN_SAMPLES:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class HedgeBudget:
+    """
+    Token bucket of hedged calls: every call made earns `ratio` tokens, up to `burst`, and every
+    hedged call spends one, so at most about `ratio` extra calls are made per call.
+    """
+
+    def __init__(self, ratio: float, burst: float):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+
+    def deposit(self) -> None:
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+LATENCIES: Dict[str, LatencyWindow] = {}
+budget = HedgeBudget(config.HEDGE_BUDGET_RATIO, config.HEDGE_BUDGET_BURST)
+
+
+def get_latencies(upstream: str) -> LatencyWindow:
+    window = LATENCIES.get(upstream)
+    if window is None:
+        window = LATENCIES[upstream] = LatencyWindow(config.HEDGE_LATENCY_WINDOW)
+    return window
+
+
+def hedge_delay(upstream: str) -> float:
+    """
+    Returns the seconds to wait for a call to an upstream before hedging it: the observed
+    `HEDGE_QUANTILE` of its latencies, or `HEDGE_DEFAULT_DELAY` until there are enough of them.
+    """
+    delay = get_latencies(upstream).quantile(config.HEDGE_QUANTILE)
+    return config.HEDGE_DEFAULT_DELAY if delay is None else delay
+
+
+def succeeded(task: asyncio.Task) -> bool:
+    return task.done() and not task.cancelled() and task.exception() is None
+
+
+async def hedged(upstream: str, call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Makes a call to an upstream, hedging it if the upstream is in `HEDGED_UPSTREAMS`. Only use
+    it for idempotent calls, since the upstream may get the same request twice.
+
+    Args:
+        upstream (str): Upstream name, whose latencies decide when to hedge.
+        call (Callable[[], Awaitable[T]]): Makes the call. It is called again to hedge.
+
+    Returns:
+        T: The result of the first call to succeed. If every call fails, the exception of the
+            first one is raised.
+    """
+    if upstream not in config.HEDGED_UPSTREAMS:
+        return await call()
+
+    latencies = get_latencies(upstream)
+
+    async def attempt() -> T:
+        start = perf_counter()
+        try:
+            return await call()
+        finally:
+            latencies.observe(perf_counter() - start)
+
+    budget.deposit()
+    delay = hedge_delay(upstream)
+    HEDGE_DELAY.set(delay, upstream)
+    tasks: List[asyncio.Task] = [asyncio.ensure_future(attempt())]
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            if budget.withdraw():
+                tasks.append(asyncio.ensure_future(attempt()))
+                HEDGED_REQUESTS.inc(upstream, "sent")
+            else:
+                HEDGED_REQUESTS.inc(upstream, "skipped")
+            pending = set(tasks)
+            # Waits for a call to succeed or for every call to fail
+            while pending and not any(succeeded(task) for task in tasks):
+                _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in tasks:
+            if succeeded(task):
+                if task is not tasks[0]:
+                    HEDGED_REQUESTS.inc(upstream, "won")
+                return task.result()
+        return tasks[0].result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Marks the error of a losing call as retrieved
+                task.exception()
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+In-process metrics exposed in the Prometheus text format. Recording a value is a dict lookup
+and a few additions, so instrumentation can stay on in production. Metrics are kept per worker
+process, so each worker must be scraped on its own.
+"""
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from chatbot_webhooks.webhooks.breaker import BREAKERS, CLOSED, HALF_OPEN, OPEN
+from chatbot_webhooks.webhooks.cache import CACHES
+
+# Latency buckets, in seconds, from fast local tags up to the Dialogflow webhook timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30)
+
+# Tag being handled by the current request, used to label errors recorded deep in helpers
+current_tag: ContextVar[str] = ContextVar("current_tag", default="")
+
+
+def escape_label_value(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labelnames: Sequence[str], labels: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    Base class of the metric families. Values are stored per tuple of label values, given
+    positionally in the order of `labelnames`.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def collect(self) -> Iterable[str]:
+        yield from self.header()
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: one (non-cumulative) count per bucket plus +Inf, then sum and count
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def collect(self) -> Iterable[str]:
+        yield from self.header()
+        for labels, (counts, total, count) in list(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float("inf")), counts):
+                cumulative += bucket_count
+                le = f'le="{format_value(float(bound))}"'
+                yield (
+                    f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            yield f"{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labelnames, labels)} {count}"
+
+
+class CallbackMetric(Metric):
+    """
+    Metric whose values are read from a callback when the metrics are rendered, for state that
+    already lives elsewhere (e.g. cache sizes).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str],
+        callback: Callable[[], Dict[Tuple[str, ...], float]],
+        type: str = "gauge",
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.callback = callback
+
+    def collect(self) -> Iterable[str]:
+        self._values = self.callback()
+        yield from super().collect()
+
+
+REGISTRY: List[Metric] = []
+
+
+def render() -> str:
+    """
+    Renders every registered metric in the Prometheus text exposition format.
+    """
+    return "\n".join(line for metric in REGISTRY for line in metric.collect()) + "\n"
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Latency of the HTTP requests, per endpoint.",
+    ["method", "endpoint", "status"],
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled.")
+TAG_DURATION = Histogram(
+    "webhook_tag_duration_seconds",
+    "Latency of the Dialogflow webhook tags.",
+    ["tag", "outcome"],
+)
+TAG_IN_FLIGHT = Gauge("webhook_tag_in_flight", "Webhook tags being handled.", ["tag"])
+TAG_ERRORS = Counter(
+    "webhook_tag_errors_total",
+    "Errors raised while handling webhook tags, by exception class.",
+    ["tag", "exception"],
+)
+UPSTREAM_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Latency of the calls to upstream services, by status code or exception class.",
+    ["upstream", "status"],
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "upstream_requests_in_flight", "Calls to upstream services in flight.", ["upstream"]
+)
+UPSTREAM_RESPONSE_BYTES = Counter(
+    "upstream_response_bytes_total", "Bytes received from upstream services.", ["upstream"]
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total", "Calls to upstream services that were retries.", ["upstream"]
+)
+UPSTREAM_COALESCED = Counter(
+    "upstream_coalesced_requests_total",
+    "Lookups that shared the answer of an identical call to an upstream service in flight.",
+    ["upstream"],
+)
+HEDGED_REQUESTS = Counter(
+    "upstream_hedged_requests_total",
+    "Hedged calls to upstream services: sent, won (answered first) or skipped for lack of budget.",
+    ["upstream", "outcome"],
+)
+HEDGE_DELAY = Gauge(
+    "upstream_hedge_delay_seconds",
+    "Time after which the latest call to an upstream service would have been hedged.",
+    ["upstream"],
+)
+
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds",
+    "Delay of the event loop in running a callback scheduled for a given time.",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+CACHE_HITS = CallbackMetric(
+    "cache_hits_total",
+    "Lookups served by the in-memory caches.",
+    ["cache"],
+    lambda: {(cache.name,): cache.hits for cache in list(CACHES)},
+    type="counter",
+)
+CACHE_MISSES = CallbackMetric(
+    "cache_misses_total",
+    "Lookups not served by the in-memory caches.",
+    ["cache"],
+    lambda: {(cache.name,): cache.misses for cache in list(CACHES)},
+    type="counter",
+)
+CACHE_ENTRIES = CallbackMetric(
+    "cache_entries",
+    "Entries stored in the in-memory caches, including expired ones not yet evicted.",
+    ["cache"],
+    lambda: {(cache.name,): len(cache) for cache in list(CACHES)},
+)
+CACHE_STALE_HITS = CallbackMetric(
+    "cache_stale_hits_total",
+    "Expired entries served because the upstream behind the cache failed.",
+    ["cache"],
+    lambda: {(cache.name,): cache.stale_hits for cache in list(CACHES)},
+    type="counter",
+)
+
+BREAKER_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+CIRCUIT_BREAKER_STATE = CallbackMetric(
+    "circuit_breaker_state",
+    "State of the circuit breakers of the upstreams: 0 closed, 1 half-open, 2 open.",
+    ["upstream"],
+    lambda: {(name,): BREAKER_STATE_VALUES[breaker.state] for name, breaker in BREAKERS.items()},
+)
+CIRCUIT_BREAKER_OPENED = CallbackMetric(
+    "circuit_breaker_opened_total",
+    "Times the circuit breakers of the upstreams opened.",
+    ["upstream"],
+    lambda: {(name,): breaker.opened for name, breaker in BREAKERS.items()},
+    type="counter",
+)
+CIRCUIT_BREAKER_REJECTED = CallbackMetric(
+    "circuit_breaker_rejected_total",
+    "Calls to the upstreams failed fast by an open circuit breaker.",
+    ["upstream"],
+    lambda: {(name,): breaker.rejected for name, breaker in BREAKERS.items()},
+    type="counter",
+)
+
+
+def record_error(exc: BaseException, tag: str = None) -> None:
+    """
+    Counts an error of the tag being handled, including errors that the tag catches itself.
+    """
+    TAG_ERRORS.inc(tag or current_tag.get() or "none", type(exc).__name__)
+
+
+@contextmanager
+def track_tag(tag: str) -> Iterator[None]:
+    """
+    Measures the handling of a webhook tag: latency, in-flight requests and escaping errors.
+    Timeouts get their own outcome, since the router may still answer them.
+    """
+    token = current_tag.set(tag)
+    TAG_IN_FLIGHT.inc(tag)
+    outcome = "success"
+    start = perf_counter()
+    try:
+        yield
+    except asyncio.TimeoutError as exc:
+        outcome = "timeout"
+        record_error(exc, tag)
+        raise
+    except BaseException as exc:
+        outcome = "error"
+        record_error(exc, tag)
+        raise
+    finally:
+        TAG_DURATION.observe(perf_counter() - start, tag, outcome)
+        TAG_IN_FLIGHT.dec(tag)
+        current_tag.reset(token)
+
+
+class EventLoopLagMonitor:
+    """
+    Samples how late the event loop wakes up a sleeping task. A lag that grows with the load
+    means the worker spends too long on CPU-bound work between awaits and needs to be scaled out.
+    """
+
+    def __init__(self):
+        self.interval: float = None
+        self._task: asyncio.Task = None
+
+    async def sample_periodically(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - self.interval))
+
+    def start(self, interval: float) -> None:
+        """
+        Starts sampling every `interval` seconds (`EVENT_LOOP_LAG_INTERVAL`).
+        """
+        self.interval = interval
+        if self._task is None:
+            self._task = asyncio.create_task(self.sample_periodically())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+event_loop_lag_monitor = EventLoopLagMonitor()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that measures the latency of every endpoint and the requests in flight.
+    Endpoints are labeled by their route path, so path parameters do not create new series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._paths: Dict[Callable, str] = {}
+
+    def endpoint_label(self, scope: dict) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if endpoint not in self._paths:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    self._paths[endpoint] = route.path
+                    break
+            else:
+                self._paths[endpoint] = getattr(endpoint, "__name__", "unknown")
+        return self._paths[endpoint]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        start = perf_counter()
+        HTTP_REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUESTS_IN_FLIGHT.dec()
+            HTTP_REQUEST_DURATION.observe(
+                perf_counter() - start,
+                scope["method"],
+                self.endpoint_label(scope),
+                str(status["code"]),
+            )
@@ -1,17 +1,25 @@
 # -*- coding: utf-8 -*-
-from typing import Any, Dict, List
+import asyncio
+from typing import Any, Dict, List, Tuple
 
+from google.auth.credentials import Credentials
 from google.cloud import dialogflowcx_v3 as dialogflow
+from loguru import logger
 
 from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.clients import track_upstream
 from chatbot_webhooks.webhooks.utils import get_credentials_from_env
 
+_session_clients: Dict[Tuple[str, str, str, str], dialogflow.SessionsAsyncClient] = {}
+_session_clients_lock = asyncio.Lock()
+
 
 async def build_session_async_client(
     project_id: str = config.GCP_PROJECT_ID,
     location_id: str = config.DIALOGFLOW_LOCATION_ID,
     agent_id: str = config.DIALOGFLOW_AGENT_ID,
     environment_id: str = config.DIALOGFLOW_ENVIRONMENT_ID,
+    credentials: Credentials = None,
 ) -> dialogflow.SessionsAsyncClient:
     project = f"projects/{project_id}"
     location = f"locations/{location_id}"
@@ -25,9 +33,46 @@ async def build_session_async_client(
     if location_id != "global":
         api_endpoint = f"{location_id}-dialogflow.googleapis.com:443"
         client_options = {"api_endpoint": api_endpoint}
-    return dialogflow.SessionsAsyncClient(
-        client_options=client_options, credentials=await get_credentials_from_env()
-    )
+    if credentials is None:
+        credentials = await get_credentials_from_env()
+    return dialogflow.SessionsAsyncClient(client_options=client_options, credentials=credentials)
+
+
+async def get_session_async_client(
+    project_id: str = config.GCP_PROJECT_ID,
+    location_id: str = config.DIALOGFLOW_LOCATION_ID,
+    agent_id: str = config.DIALOGFLOW_AGENT_ID,
+    environment_id: str = config.DIALOGFLOW_ENVIRONMENT_ID,
+) -> dialogflow.SessionsAsyncClient:
+    """
+    Returns the process-wide session client for an agent environment, building it (and its
+    gRPC channel) only on the first call. All clients share the process credentials.
+    """
+    key = (project_id, location_id, agent_id, environment_id)
+    client = _session_clients.get(key)
+    if client is not None:
+        return client
+    async with _session_clients_lock:
+        client = _session_clients.get(key)
+        if client is None:
+            client = await build_session_async_client(
+                project_id=project_id,
+                location_id=location_id,
+                agent_id=agent_id,
+                environment_id=environment_id,
+            )
+            _session_clients[key] = client
+            logger.info(f"Built Dialogflow session client for {key}")
+    return client
+
+
+async def close_session_async_clients() -> None:
+    """
+    Closes every cached session client.
+    """
+    while _session_clients:
+        _, client = _session_clients.popitem()
+        await client.transport.close()
 
 
 async def detect_intent_text(
@@ -42,7 +87,7 @@ async def detect_intent_text(
     parameters: Dict[str, Any] = None,
 ) -> List[str]:
     if session_client is None:
-        session_client = await build_session_async_client(
+        session_client = await get_session_async_client(
             project_id=project_id,
             location_id=location_id,
             agent_id=agent_id,
@@ -64,7 +109,8 @@ async def detect_intent_text(
         )
     else:
         request = dialogflow.DetectIntentRequest(session=session_path, query_input=query_input)
-    response = await session_client.detect_intent(request=request)
+    async with track_upstream("dialogflow", "detect_intent"):
+        response = await session_client.detect_intent(request=request)
     response_messages = [" ".join(msg.text.text) for msg in response.query_result.response_messages]
     ret_messages = [msg for msg in response_messages if msg.strip() != ""]
     return ret_messages
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import re
+from typing import Dict, List, Optional
+
+from jellyfish import jaro_similarity
+from loguru import logger
+from unidecode import unidecode
+
+from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.clients import get_session
+from chatbot_webhooks.webhooks.deadline import upstream_timeout
+
+
+def normalize_neighborhood_name(name: str) -> str:
+    """
+    Exemplos:
+    >>> normalize_neighborhood_name(" Freguesia (Jacarepaguá) ")
+    'freguesia jacarepagua'
+    """
+    name = re.sub(r"[^a-z0-9 ]", " ", unidecode(name).lower())
+    return re.sub(r"\s+", " ", name).strip()
+
+
+class NeighborhoodResolver:
+    """
+    Resolves neighborhood names into IPP neighborhood ids without leaving the process. The
+    table is loaded from `IPP_NEIGHBORHOODS_URL` (a JSON list of `{"id", "name"}` objects) and
+    refreshed in the background. Names resolved by the `neighborhood_id` endpoint are learned
+    as well, so the table also fills up when no URL is configured.
+    """
+
+    def __init__(self, threshold: float = 0.9):
+        """
+        Args:
+            threshold (float, optional): Minimum similarity for a fuzzy match. Defaults to 0.9.
+        """
+        self.threshold = threshold
+        self._neighborhoods: Dict[str, dict] = {}
+        self._refresh_task: asyncio.Task = None
+
+    def __len__(self) -> int:
+        return len(self._neighborhoods)
+
+    def learn(self, neighborhood_id: str, name: str) -> None:
+        """
+        Adds a neighborhood to the table.
+        """
+        self._neighborhoods[normalize_neighborhood_name(name)] = {
+            "id": neighborhood_id,
+            "name": name,
+        }
+
+    def replace(self, neighborhoods: List[dict]) -> None:
+        """
+        Replaces the whole table with a list of `{"id", "name"}` objects.
+        """
+        self._neighborhoods = {
+            normalize_neighborhood_name(item["name"]): {"id": item["id"], "name": item["name"]}
+            for item in neighborhoods
+        }
+
+    def lookup(self, name: str) -> Optional[dict]:
+        """
+        Returns the `{"id", "name"}` entry whose name matches best, or `None` if no name is
+        similar enough.
+        """
+        normalized = normalize_neighborhood_name(name)
+        if normalized in self._neighborhoods:
+            return self._neighborhoods[normalized]
+        best_similarity = 0
+        best = None
+        for key, item in self._neighborhoods.items():
+            similarity = jaro_similarity(normalized, key)
+            if similarity > best_similarity:
+                best_similarity = similarity
+                best = item
+        if best_similarity >= self.threshold:
+            return best
+        return None
+
+    async def load(self) -> None:
+        """
+        Loads the full table from `IPP_NEIGHBORHOODS_URL`.
+        """
+        url = config.IPP_NEIGHBORHOODS_URL
+        session = get_session(url)
+        async with session.get(
+            url,
+            headers={"Authorization": f"Bearer {config.CHATBOT_INTEGRATIONS_KEY}"},
+            timeout=upstream_timeout(),
+        ) as response:
+            response.raise_for_status()
+            neighborhoods = await response.json(content_type=None)
+        self.replace(neighborhoods)
+        logger.info(f"Loaded {len(self)} IPP neighborhoods")
+
+    async def refresh_periodically(self) -> None:
+        while True:
+            try:
+                await self.load()
+            except Exception as exc:  # noqa
+                logger.exception(f"Failed to load IPP neighborhoods: {exc}")
+            await asyncio.sleep(config.IPP_NEIGHBORHOODS_REFRESH_INTERVAL)
+
+    def start(self) -> None:
+        """
+        Starts refreshing the table in the background, if `IPP_NEIGHBORHOODS_URL` is set.
+        """
+        if config.IPP_NEIGHBORHOODS_URL and self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self.refresh_periodically())
+
+    def stop(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+
+
+neighborhood_resolver = NeighborhoodResolver(
+    threshold=config.IPP_NEIGHBORHOODS_SIMILARITY_THRESHOLD
+)
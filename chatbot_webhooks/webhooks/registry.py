@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from chatbot_webhooks import config
+
+TagHandler = Callable[[dict], Awaitable]
+
+
+class TagSpec:
+    """
+    Webhook tag handler along with the attributes it was registered with.
+    """
+
+    __slots__ = (
+        "name",
+        "handler",
+        "parameters",
+        "timeout",
+        "io_bound",
+        "cacheable",
+        "delta_response",
+        "on_timeout",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        handler: TagHandler,
+        parameters: Tuple[str, ...] = (),
+        timeout: float = None,
+        io_bound: bool = False,
+        cacheable: bool = False,
+        delta_response: bool = True,
+        on_timeout: Dict[str, Any] = None,
+    ):
+        self.name = name
+        self.handler = handler
+        self.parameters = tuple(parameters)
+        self.timeout = config.DIALOGFLOW_WEBHOOK_TIMEOUT if timeout is None else timeout
+        if self.timeout > config.DIALOGFLOW_WEBHOOK_TIMEOUT:
+            raise ValueError(
+                f"Tag '{name}' has a timeout of {self.timeout}s, longer than the "
+                f"{config.DIALOGFLOW_WEBHOOK_TIMEOUT}s Dialogflow waits for the webhook"
+            )
+        self.io_bound = io_bound
+        self.cacheable = cacheable
+        self.delta_response = delta_response
+        self.on_timeout = on_timeout
+
+    def __repr__(self) -> str:
+        return f"<TagSpec {self.name}>"
+
+    def missing_parameters(self, parameters: dict) -> List[str]:
+        """
+        Returns the expected session parameters that are missing from a request.
+        """
+        return [parameter for parameter in self.parameters if parameter not in parameters]
+
+
+TAGS: Dict[str, TagSpec] = {}
+
+
+def tag(
+    name: str = None,
+    *,
+    parameters: Iterable[str] = (),
+    timeout: float = None,
+    io_bound: bool = False,
+    cacheable: bool = False,
+    delta_response: bool = True,
+    on_timeout: Dict[str, Any] = None,
+) -> Callable[[TagHandler], TagHandler]:
+    """
+    Registers a function as the handler of a Dialogflow webhook tag. Only registered functions
+    can be called by the webhook router.
+
+    Args:
+        name (str, optional): Tag name. Defaults to the function name.
+        parameters (Iterable[str], optional): Session parameters the handler expects.
+        timeout (float, optional): Time budget of the handler, in seconds. Only a shorter
+            budget than `DIALOGFLOW_WEBHOOK_TIMEOUT` can be given, since Dialogflow gives up on
+            the webhook after that. Defaults to `DIALOGFLOW_WEBHOOK_TIMEOUT`.
+        io_bound (bool, optional): Whether the handler calls external services. Defaults to
+            `False`.
+        cacheable (bool, optional): Whether the values the handler computes depend only on its
+            expected parameters, so they can be reused for equal inputs. Defaults to `False`.
+        delta_response (bool, optional): Whether only the session parameters the handler
+            changed are sent back to Dialogflow. Defaults to `True`.
+        on_timeout (Dict[str, Any], optional): Session parameters answered when the handler
+            runs out of its time budget, so that the flow can tell the citizen or hand over to
+            an attendant. Defaults to `None`, which fails the request instead.
+
+    Returns:
+        Callable[[TagHandler], TagHandler]: Decorator that returns the function unchanged.
+    """
+
+    def decorator(handler: TagHandler) -> TagHandler:
+        spec = TagSpec(
+            name or handler.__name__,
+            handler,
+            parameters=parameters,
+            timeout=timeout,
+            io_bound=io_bound,
+            cacheable=cacheable,
+            delta_response=delta_response,
+            on_timeout=on_timeout,
+        )
+        if spec.name in TAGS:
+            raise ValueError(f"Tag '{spec.name}' is already registered")
+        TAGS[spec.name] = spec
+        return handler
+
+    return decorator
+
+
+def get_tag(name: str) -> Optional[TagSpec]:
+    """
+    Returns the registered spec of a tag, or `None` if the tag is not implemented.
+    """
+    return TAGS.get(name)
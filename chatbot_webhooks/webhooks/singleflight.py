@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Single-flight coalescing of upstream lookups. While a lookup is in flight, identical lookups
+(same upstream and normalized request) wait for its answer instead of calling the upstream
+again, which matters when many sessions look up the same citizen or address at once. The
+answer, or the exception, is shared by every caller, so answers must not be mutated.
+"""
+import asyncio
+from functools import partial
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from chatbot_webhooks.webhooks.deadline import (
+    DeadlineExceeded,
+    current_deadline,
+    deadline,
+    within_deadline,
+    without_deadline,
+)
+from chatbot_webhooks.webhooks.metrics import UPSTREAM_COALESCED
+
+T = TypeVar("T")
+
+
+class Flight:
+    """
+    A lookup in flight and the deadlines of the callers waiting for it.
+    """
+
+    def __init__(self):
+        self.task: asyncio.Task = None
+        self.deadlines: List[Optional[float]] = []
+        # Deadline the lookup is currently running under
+        self.running_until: Optional[float] = None
+
+    def latest_deadline(self) -> Optional[float]:
+        """
+        Returns the latest deadline among the waiting callers, or `None` if one has none.
+        """
+        if not self.deadlines or None in self.deadlines:
+            return None
+        return max(self.deadlines)
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Makes the lookup under the latest deadline of the waiting callers, so an upstream that
+        does not answer in time fails the lookup with a timeout, which counts against it (e.g.
+        in its circuit breaker). The timeouts of calls already made cannot be extended, so if
+        a caller with a later deadline joined meanwhile, the lookup is made again.
+        """
+        while True:
+            self.running_until = self.latest_deadline()
+            try:
+                with without_deadline():
+                    if self.running_until is None:
+                        return await call()
+                    with deadline(self.running_until - monotonic()):
+                        return await call()
+            except asyncio.TimeoutError:
+                # Only retries when the deadline itself passed and a caller has more time left
+                latest = self.latest_deadline()
+                if (
+                    self.running_until is None
+                    or monotonic() < self.running_until
+                    or not self.deadlines
+                    or (latest is not None and latest <= self.running_until)
+                ):
+                    raise
+
+
+_flights: Dict[Tuple[str, Hashable], Flight] = {}
+
+
+def _land(key: Tuple[str, Hashable], flight: Flight) -> None:
+    if _flights.get(key) is flight:
+        del _flights[key]
+
+
+def _landed(key: Tuple[str, Hashable], flight: Flight, task: asyncio.Task) -> None:
+    _land(key, flight)
+    if not task.cancelled():
+        # Marks the error of a lookup nobody waits for anymore as retrieved
+        task.exception()
+
+
+async def single_flight(upstream: str, request: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+    """
+    Returns the answer of `call`, sharing it with identical lookups made at the same time.
+
+    The lookup runs until the latest deadline of the callers waiting for it, while each caller
+    stops waiting at its own deadline. If every caller leaves before their deadlines (e.g. they
+    are cancelled), the lookup is cancelled.
+
+    Args:
+        upstream (str): Upstream name, used in the key and in metrics.
+        request (Hashable): Normalized request, the rest of the key.
+        call (Callable[[], Awaitable[T]]): Makes the lookup.
+
+    Returns:
+        T: The answer of the lookup, shared with the other callers.
+    """
+    key = (upstream, request)
+    waiter_deadline = current_deadline.get()
+    flight = _flights.get(key)
+    if flight is None:
+        flight = _flights[key] = Flight()
+        flight.deadlines.append(waiter_deadline)
+        flight.task = asyncio.ensure_future(flight.run(call))
+        flight.task.add_done_callback(partial(_landed, key, flight))
+    else:
+        UPSTREAM_COALESCED.inc(upstream)
+        flight.deadlines.append(waiter_deadline)
+    expired = False
+    try:
+        return await within_deadline(asyncio.shield(flight.task))
+    except DeadlineExceeded:
+        expired = True
+        raise
+    finally:
+        flight.deadlines.remove(waiter_deadline)
+        if not flight.deadlines and not flight.task.done():
+            _land(key, flight)
+            # A lookup running under the deadline that just passed is about to time out on its
+            # own, which must count against the upstream; any other lookup is abandoned
+            if not (
+                expired
+                and flight.running_until is not None
+                and flight.running_until <= waiter_deadline
+            ):
+                flight.task.cancel()
@@ -1,9 +1,9 @@
 # -*- coding: utf-8 -*-
+import asyncio
 from copy import copy
 from datetime import datetime, timedelta
 from typing import Tuple
 
-import aiohttp
 from loguru import logger
 import pandas as pd
 from prefeitura_rio.integrations.sgrc.exceptions import SGRCBusinessRuleException
@@ -19,10 +19,14 @@ from prefeitura_rio.integrations.sgrc.models import Requester
 from unidecode import unidecode
 
 from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.clients import get_session
+from chatbot_webhooks.webhooks.deadline import upstream_timeout
+from chatbot_webhooks.webhooks.registry import tag
+from chatbot_webhooks.webhooks.utils import forget_citizen_profile
 from chatbot_webhooks.webhooks.utils import get_address_protocols
 from chatbot_webhooks.webhooks.utils import get_ipp_info
-from chatbot_webhooks.webhooks.utils import get_user_info
-from chatbot_webhooks.webhooks.utils import get_user_protocols
+from chatbot_webhooks.webhooks.utils import get_session_user_info
+from chatbot_webhooks.webhooks.utils import get_session_user_protocols
 from chatbot_webhooks.webhooks.utils import google_geolocator
 from chatbot_webhooks.webhooks.utils import mask_email
 from chatbot_webhooks.webhooks.utils import new_ticket
@@ -33,31 +37,54 @@ from chatbot_webhooks.webhooks.utils import validate_name
 from chatbot_webhooks.webhooks.utils import validate_cpf_cnpj
 from chatbot_webhooks.webhooks.utils import rebi_combinacoes_permitidas
 
-
+# Respostas dadas quando uma tag estoura o seu tempo (ver `on_timeout` em `tag`)
+TIMEOUT_TRANSBORDO = {"encaminhar_transbordo_agora": True}
+# O chamado pode ter sido criado mesmo sem resposta do SGRC, então não dizemos que não foi (o
+# cidadão tentaria de novo, duplicando-o) e passamos o atendimento para um atendente conferir
+TIMEOUT_SGRC = {
+    **TIMEOUT_TRANSBORDO,
+    "solicitacao_criada": None,
+    "solicitacao_retorno": "erro_timeout",
+}
+TIMEOUT_DIVIDA_ATIVA = {
+    "api_resposta_sucesso": False,
+    "api_descricao_erro": (
+        "O sistema da Dívida Ativa demorou a responder. Por favor, tente novamente mais tarde."
+    ),
+}
+
+
+@tag(io_bound=True)
 async def ai(request_data: dict) -> str:
     input_message: str = request_data["text"]
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            config.CHATBOT_LAB_API_URL,
-            headers={
-                "Authorization": f"Bearer {config.CHATBOT_LAB_API_KEY}",
-            },
-            json={
-                "message": input_message,
-                "chat_session_id": "e23bdc43-bb26-4273-a187-e3e23836e0c2",
-                "contexts": ["cariocadigital"],
-            },
-        ) as response:
-            try:
-                response.raise_for_status()
-            except Exception as exc:
-                logger.error(f"Backend error: {exc}")
-                logger.error(f"Message: {response.text}")
-            response = await response.json(content_type=None)
-            logger.info(f"API response: {response}")
-            return response["answer"]
-
-
+    session = get_session(config.CHATBOT_LAB_API_URL)
+    async with session.post(
+        config.CHATBOT_LAB_API_URL,
+        timeout=upstream_timeout(),
+        headers={
+            "Authorization": f"Bearer {config.CHATBOT_LAB_API_KEY}",
+        },
+        json={
+            "message": input_message,
+            "chat_session_id": "e23bdc43-bb26-4273-a187-e3e23836e0c2",
+            "contexts": ["cariocadigital"],
+        },
+    ) as response:
+        try:
+            response.raise_for_status()
+        except Exception as exc:
+            logger.error(f"Backend error: {exc}")
+            logger.error(f"Message: {response.text}")
+        response = await response.json(content_type=None)
+        logger.info(f"API response: {response}")
+        return response["answer"]
+
+
+@tag(
+    parameters=["codigo_servico_1746"],
+    io_bound=True,
+    on_timeout=TIMEOUT_SGRC,
+)
 async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
     try:
         parameters = request_data["sessionInfo"]["parameters"]
@@ -189,6 +216,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -286,6 +316,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -439,6 +472,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -573,6 +609,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -682,6 +721,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -807,6 +849,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -934,6 +979,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -1082,6 +1130,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -1201,6 +1252,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -1319,6 +1373,9 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
                 parameters["solicitacao_retorno"] = "erro_sgrc"
+            except asyncio.TimeoutError:
+                # O chamado pode ter sido criado sem resposta do SGRC (ver `TIMEOUT_SGRC`)
+                raise
             except Exception as exc:
                 logger.exception(exc)
                 parameters["solicitacao_criada"] = False
@@ -1326,14 +1383,21 @@ async def abrir_chamado_sgrc(request_data: dict) -> Tuple[str, dict]:
             return message, parameters
         else:
             raise NotImplementedError("Classification code not implemented")
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         parameters = request_data["sessionInfo"]["parameters"]
         message = ""
 
         parameters["encaminhar_transbordo_agora"] = True
         return message, parameters
+    finally:
+        # O chamado pode ter sido criado mesmo em caso de erro, então os protocolos do cidadão
+        # guardados para a conversa ficam desatualizados
+        forget_citizen_profile(request_data)
 
 
+@tag(parameters=["logradouro_nome"], io_bound=True, on_timeout=TIMEOUT_TRANSBORDO)
 async def localizador(request_data: dict) -> Tuple[str, dict]:
     logger.info(request_data)
     try:
@@ -1360,6 +1424,8 @@ async def localizador(request_data: dict) -> Tuple[str, dict]:
         #         address_to_google, parameters
         #     )
 
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         parameters = request_data["sessionInfo"]["parameters"]
         message = ""
@@ -1369,6 +1435,11 @@ async def localizador(request_data: dict) -> Tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["logradouro_nome", "logradouro_numero"],
+    io_bound=True,
+    on_timeout={"logradouro_indicador_validade": False},
+)
 async def identificador_ipp(request_data: dict) -> Tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1472,6 +1543,7 @@ async def identificador_ipp(request_data: dict) -> Tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["usuario_cpf"], cacheable=True)
 async def validador_cpf(request_data: dict) -> tuple[str, dict, list]:
     parameters = request_data["sessionInfo"]["parameters"]
     # form_parameters_list = request_data["pageInfo"]["formInfo"]["parameterInfo"]
@@ -1482,6 +1554,7 @@ async def validador_cpf(request_data: dict) -> tuple[str, dict, list]:
     return message, parameters  # , form_parameters_list
 
 
+@tag(parameters=["usuario_cpf"], cacheable=True)
 async def validador_cpf_cnpj(request_data: dict) -> tuple[str, dict, list]:
     parameters = request_data["sessionInfo"]["parameters"]
     # form_parameters_list = request_data["pageInfo"]["formInfo"]["parameterInfo"]
@@ -1492,6 +1565,7 @@ async def validador_cpf_cnpj(request_data: dict) -> tuple[str, dict, list]:
     return message, parameters  # , form_parameters_list
 
 
+@tag(parameters=["usuario_email"], cacheable=True)
 async def validador_email(request_data: dict) -> tuple[str, dict, list]:
     parameters = request_data["sessionInfo"]["parameters"]
     # form_parameters_list = request_data["pageInfo"]["formInfo"]["parameterInfo"]
@@ -1502,6 +1576,7 @@ async def validador_email(request_data: dict) -> tuple[str, dict, list]:
     return message, parameters  # , form_parameters_list
 
 
+@tag(parameters=["usuario_nome_cadastrado"], cacheable=True)
 async def validador_nome(request_data: dict) -> tuple[str, dict, list]:
     parameters = request_data["sessionInfo"]["parameters"]
     # form_parameters_list = request_data["pageInfo"]["formInfo"]["parameterInfo"]
@@ -1515,6 +1590,12 @@ async def validador_nome(request_data: dict) -> tuple[str, dict, list]:
     return message, parameters  # , form_parameters_list
 
 
+@tag(
+    parameters=["usuario_cpf", "usuario_email"],
+    io_bound=True,
+    # Como quando o SGRC falha: segue com o e-mail informado
+    on_timeout={"usuario_email_confirmado": True, "usuario_email_cadastrado": None},
+)
 async def confirma_email(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -1523,7 +1604,9 @@ async def confirma_email(request_data: dict) -> tuple[str, dict]:
     logger.info(f"Email informado pelo usuário: {email_dialogflow}")
     try:
         logger.info(f"Buscando informações do usuário no SGRC com CPF {cpf}")
-        user_info = await get_user_info(cpf)
+        user_info = await get_session_user_info(request_data, cpf)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         logger.error(f"Erro ao buscar informações do usuário no SGRC com CPF {cpf}")
         parameters["usuario_email_confirmado"] = True
@@ -1557,6 +1640,7 @@ async def confirma_email(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["variavel_recebe_ultima_mensagem"])
 async def define_variavel_ultima_mensagem(request_data: dict) -> tuple[str, dict]:
     # logger.info(request_data)
     parameters = request_data["sessionInfo"]["parameters"]
@@ -1583,6 +1667,7 @@ async def define_variavel_ultima_mensagem(request_data: dict) -> tuple[str, dict
     return message, parameters
 
 
+@tag()
 async def reseta_parametros(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1593,6 +1678,7 @@ async def reseta_parametros(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag()
 async def identifica_ambiente(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1602,6 +1688,7 @@ async def identifica_ambiente(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag()
 async def contador_no_match(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1614,6 +1701,7 @@ async def contador_no_match(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["logradouro_nome"])
 async def checa_endereco_especial(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1653,6 +1741,7 @@ async def checa_endereco_especial(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["reparo_luminaria_defeito"])
 async def rlu_classifica_defeito(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1689,6 +1778,11 @@ async def rlu_classifica_defeito(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["opcao_consulta_protesto", "parametro_de_consulta"],
+    io_bound=True,
+    on_timeout=TIMEOUT_DIVIDA_ATIVA,
+)
 async def da_consulta_protestos(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1748,6 +1842,11 @@ async def da_consulta_protestos(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["da1_tipo_de_consulta"],
+    io_bound=True,
+    on_timeout=TIMEOUT_DIVIDA_ATIVA,
+)
 async def da_consulta_debitos_contribuinte(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1905,6 +2004,11 @@ async def da_consulta_debitos_contribuinte(request_data: dict) -> tuple[str, dic
     return message, parameters
 
 
+@tag(
+    parameters=["itens_informados", "dicionario_itens", "total_itens_pagamento"],
+    io_bound=True,
+    on_timeout=TIMEOUT_DIVIDA_ATIVA,
+)
 async def da_emitir_guia_pagamento_a_vista(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -1976,6 +2080,11 @@ async def da_emitir_guia_pagamento_a_vista(request_data: dict) -> tuple[str, dic
     return message, parameters
 
 
+@tag(
+    parameters=["itens_informados", "dicionario_itens", "total_itens_pagamento"],
+    io_bound=True,
+    on_timeout=TIMEOUT_DIVIDA_ATIVA,
+)
 async def da_emitir_guia_regularizacao(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -2047,6 +2156,11 @@ async def da_emitir_guia_regularizacao(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["usuario_cpf", "usuario_telefone", "usuario_email"],
+    io_bound=True,
+    on_timeout=TIMEOUT_DIVIDA_ATIVA,
+)
 async def da_cadastro(request_data: dict) -> tuple[str, dict]:
     parameters = request_data["sessionInfo"]["parameters"]
     message = ""
@@ -2084,6 +2198,14 @@ async def da_cadastro(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["usuario_cpf"],
+    io_bound=True,
+    on_timeout={
+        "rebi_elegibilidade_abertura_chamado": False,
+        "rebi_elegibilidade_abertura_chamado_justificativa": "erro_desconhecido",
+    },
+)
 async def rebi_elegibilidade_abertura_chamado(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2091,7 +2213,9 @@ async def rebi_elegibilidade_abertura_chamado(request_data: dict) -> tuple[str,
 
     try:
         logger.info(f"Buscando informações do usuário no SGRC com CPF {cpf}")
-        user_info = await get_user_info(cpf)
+        user_info = await get_session_user_info(request_data, cpf)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except Exception as e:  # noqa
         logger.error(f"Erro ao buscar informações do usuário no SGRC com CPF {cpf}")
         if "message='NOT FOUND'" in str(e):
@@ -2113,7 +2237,9 @@ async def rebi_elegibilidade_abertura_chamado(request_data: dict) -> tuple[str,
 
     try:
         logger.info(f"Buscando tickets do usuário no SGRC com CPF {cpf} e person_id {person_id}")
-        user_protocols = await get_user_protocols(person_id)
+        user_protocols = await get_session_user_protocols(request_data, cpf, person_id)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         logger.error(
             f"Erro ao buscar informações do usuário no SGRC com CPF {cpf} e person_id {person_id}"
@@ -2163,6 +2289,7 @@ async def rebi_elegibilidade_abertura_chamado(request_data: dict) -> tuple[str,
     return message, parameters
 
 
+@tag(parameters=["rebi_material_quantidade"])
 async def rebi_tratador_lista_itens(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2204,6 +2331,7 @@ async def rebi_tratador_lista_itens(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["rebi_material_quantidade"])
 async def rebi_avaliador_combinacoes_itens(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2701,6 +2829,7 @@ async def rebi_avaliador_combinacoes_itens(request_data: dict) -> tuple[str, dic
     return message, parameters
 
 
+@tag(parameters=["rebi_material_nome", "rebi_material_quantidade"])
 async def rebi_confirma_adicao_itens(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2711,6 +2840,7 @@ async def rebi_confirma_adicao_itens(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(parameters=["rebi_coleta_material_1"])
 async def rebi_define_texto(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2750,6 +2880,7 @@ async def rebi_define_texto(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag()
 async def rebi_checa_item_duplicado(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2791,6 +2922,14 @@ async def rebi_checa_item_duplicado(request_data: dict) -> tuple[str, dict]:
     return message, parameters
 
 
+@tag(
+    parameters=["logradouro_id_ipp", "logradouro_id_bairro_ipp"],
+    io_bound=True,
+    on_timeout={
+        "rebi_elegibilidade_endereco_abertura_chamado": False,
+        "rebi_elegibilidade_endereco_abertura_chamado_justificativa": "erro_desconhecido",
+    },
+)
 async def rebi_elegibilidade_endereco_abertura_chamado(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -2820,6 +2959,8 @@ async def rebi_elegibilidade_endereco_abertura_chamado(request_data: dict) -> tu
             "min_date": min_date,
         }
         address_tickets = await get_address_protocols(address)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         logger.error("Erro ao buscar informações desse endereço")
         parameters["rebi_elegibilidade_endereco_abertura_chamado"] = False
@@ -2867,6 +3008,7 @@ async def rebi_elegibilidade_endereco_abertura_chamado(request_data: dict) -> tu
     return message, parameters
 
 
+@tag(parameters=["rebi_material_nome"])
 async def rebi_gerador_pergunta_quantidade(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
@@ -3178,6 +3320,7 @@ async def rebi_gerador_pergunta_quantidade(request_data: dict) -> tuple[str, dic
     return message, parameters
 
 
+@tag()
 async def rebi_orientacoes_finais_especificas(request_data: dict) -> tuple[str, dict]:
     message = ""
     parameters = request_data["sessionInfo"]["parameters"]
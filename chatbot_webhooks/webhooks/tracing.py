@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""
+Minimal tracing: spans are nested through a contextvar, so every span opened while handling a
+request becomes a child of the request span. Finished spans are buffered and exported in the
+background, either as JSON lines to a file or to an OpenTelemetry collector through OTLP/HTTP
+(JSON encoding).
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+import aiohttp
+from loguru import logger
+
+from chatbot_webhooks import config
+
+# W3C trace context header, e.g. 00-<trace id>-<parent id>-01
+TRACEPARENT_REGEX = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "kind",
+        "start_time",
+        "end_time",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str = None,
+        parent_id: str = None,
+        kind: str = "internal",
+        attributes: Dict[str, Any] = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id or os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.kind = kind
+        self.start_time = time.time_ns()
+        self.end_time: Optional[int] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_exception(self, exc: BaseException) -> None:
+        self.error = f"{type(exc).__name__}: {exc}"
+        self.attributes["exception.type"] = type(exc).__name__
+
+    def end(self) -> None:
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            if exporter is not None:
+                exporter.add(self)
+
+    @property
+    def duration(self) -> float:
+        """
+        Duration in seconds, up to now if the span has not ended.
+        """
+        return ((self.end_time or time.time_ns()) - self.start_time) / 1e9
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def start_span(
+    name: str, kind: str = "internal", attributes: Dict[str, Any] = None, traceparent: str = None
+) -> Span:
+    """
+    Starts a span as a child of the current span, or of the remote parent given by a W3C
+    `traceparent` header. The span must be ended with `Span.end`.
+    """
+    parent = current_span.get()
+    trace_id = parent.trace_id if parent else None
+    parent_id = parent.span_id if parent else None
+    match = TRACEPARENT_REGEX.match(traceparent or "")
+    if parent is None and match:
+        trace_id, parent_id = match.groups()
+    return Span(name, trace_id=trace_id, parent_id=parent_id, kind=kind, attributes=attributes)
+
+
+@contextmanager
+def span(
+    name: str, kind: str = "internal", attributes: Dict[str, Any] = None, traceparent: str = None
+) -> Iterator[Span]:
+    """
+    Runs a block inside a new span, which becomes the current span while the block runs.
+    """
+    new_span = start_span(name, kind=kind, attributes=attributes, traceparent=traceparent)
+    token = current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as exc:
+        new_span.record_exception(exc)
+        raise
+    finally:
+        current_span.reset(token)
+        new_span.end()
+
+
+class SpanExporter:
+    """
+    Buffers finished spans and exports them in batches. The buffer is bounded, so spans are
+    dropped rather than piling up when the destination is unavailable.
+    """
+
+    def __init__(self, max_queue_size: int = None):
+        self.max_queue_size = max_queue_size or config.TRACING_MAX_QUEUE_SIZE
+        self.dropped = 0
+        self._spans: List[Span] = []
+        self._task: asyncio.Task = None
+
+    def add(self, span: Span) -> None:
+        if len(self._spans) >= self.max_queue_size:
+            self.dropped += 1
+            return
+        self._spans.append(span)
+
+    async def export(self, spans: List[Span]) -> None:
+        raise NotImplementedError
+
+    async def flush(self) -> None:
+        spans, self._spans = self._spans, []
+        if not spans:
+            return
+        try:
+            await self.export(spans)
+        except Exception as exc:  # noqa
+            self.dropped += len(spans)
+            logger.warning(f"Failed to export {len(spans)} spans: {exc}")
+
+    async def export_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(config.TRACING_EXPORT_INTERVAL)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.export_periodically())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+
+class FileSpanExporter(SpanExporter):
+    """
+    Appends spans to a file, one JSON object per line.
+    """
+
+    def __init__(self, path: str, max_queue_size: int = None):
+        super().__init__(max_queue_size)
+        self.path = path
+
+    def _write(self, lines: List[str]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    async def export(self, spans: List[Span]) -> None:
+        lines = [json.dumps(span.to_dict(), default=str) + "\n" for span in spans]
+        await asyncio.to_thread(self._write, lines)
+
+
+# OTLP span kinds
+OTLP_SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPSpanExporter(SpanExporter):
+    """
+    Sends spans to an OpenTelemetry collector with the OTLP/HTTP protocol, JSON encoded.
+    """
+
+    def __init__(self, endpoint: str, max_queue_size: int = None):
+        super().__init__(max_queue_size)
+        self.url = endpoint.rstrip("/") + "/v1/traces"
+        self._session: aiohttp.ClientSession = None
+
+    def encode(self, spans: List[Span]) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": otlp_value(config.TRACING_SERVICE_NAME),
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "chatbot_webhooks"},
+                            "spans": [
+                                {
+                                    "traceId": span.trace_id,
+                                    "spanId": span.span_id,
+                                    "parentSpanId": span.parent_id or "",
+                                    "name": span.name,
+                                    "kind": OTLP_SPAN_KINDS.get(span.kind, 1),
+                                    "startTimeUnixNano": str(span.start_time),
+                                    "endTimeUnixNano": str(span.end_time),
+                                    "attributes": [
+                                        {"key": key, "value": otlp_value(value)}
+                                        for key, value in span.attributes.items()
+                                    ],
+                                    "status": (
+                                        {"code": 2, "message": span.error}
+                                        if span.error
+                                        else {"code": 1}
+                                    ),
+                                }
+                                for span in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    async def export(self, spans: List[Span]) -> None:
+        # A dedicated, untraced session, so exporting does not create spans itself
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        async with self._session.post(self.url, json=self.encode(spans)) as response:
+            response.raise_for_status()
+
+    async def shutdown(self) -> None:
+        await super().shutdown()
+        if self._session is not None:
+            await self._session.close()
+
+
+def build_exporter() -> Optional[SpanExporter]:
+    """
+    Builds the exporter selected by `TRACING_EXPORTER` ("file" or "otlp"), or `None` when
+    tracing is disabled.
+    """
+    if config.TRACING_EXPORTER == "file":
+        return FileSpanExporter(config.TRACING_FILE_PATH)
+    if config.TRACING_EXPORTER == "otlp":
+        return OTLPSpanExporter(config.TRACING_OTLP_ENDPOINT)
+    return None
+
+
+exporter: Optional[SpanExporter] = build_exporter()
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that opens the root span of every HTTP request, continuing the trace of
+    the caller when it sends a `traceparent` header.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        traceparent = None
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                traceparent = value.decode("latin-1")
+                break
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                request_span.set_attribute("http.status_code", message["status"])
+            await send(message)
+
+        with span(
+            f"{scope['method']} {scope['path']}",
+            kind="server",
+            attributes={"http.method": scope["method"], "http.target": scope["path"]},
+            traceparent=traceparent,
+        ) as request_span:
+            await self.app(scope, receive, send_wrapper)
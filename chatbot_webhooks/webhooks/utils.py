@@ -1,25 +1,51 @@
 # -*- coding: utf-8 -*-
+import asyncio
 import base64
 import json
-import math
 import re
+import threading
 import time
 from datetime import datetime
-from pathlib import Path
-from typing import Any, Dict, Union
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Union
 from itertools import cycle
 
 import aiohttp
-import geopandas as gpd
-from async_googlemaps import AsyncClient
+from google.auth.credentials import Credentials
+from google.auth.transport.requests import Request as AuthRequest
 from google.oauth2 import service_account
 from jellyfish import jaro_similarity
 from loguru import logger
 from prefeitura_rio.integrations.sgrc import Address, NewTicket, Requester
 from prefeitura_rio.integrations.sgrc import async_new_ticket as async_sgrc_new_ticket
-from shapely.geometry import Point
+from prefeitura_rio.integrations.sgrc.exceptions import (
+    SGRCBusinessRuleException,
+    SGRCDuplicateTicketException,
+    SGRCEquivalentTicketException,
+    SGRCInvalidBodyException,
+    SGRCMalformedBodyException,
+)
+from unidecode import unidecode
 
 from chatbot_webhooks import config
+from chatbot_webhooks.webhooks.breaker import circuit_breaker
+from chatbot_webhooks.webhooks.cache import SQLiteStore, TTLCache
+from chatbot_webhooks.webhooks.clients import get_session, track_upstream
+from chatbot_webhooks.webhooks.deadline import (
+    upstream_timeout,
+    within_deadline,
+    without_deadline,
+)
+from chatbot_webhooks.webhooks.gazetteer import get_ipp_gazetteer, rank_ipp_candidates
+from chatbot_webhooks.webhooks.geo import is_inside_rio
+from chatbot_webhooks.webhooks.hedging import hedged
+from chatbot_webhooks.webhooks.metrics import record_error
+from chatbot_webhooks.webhooks.neighborhoods import neighborhood_resolver
+from chatbot_webhooks.webhooks.singleflight import single_flight
+
+GCP_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+# Number of IPP candidates kept (and logged) when ranking geocoder results
+IPP_RANKING_TOP_K = 5
+IPP_GEOCODE_SERVER_PATH = "/arcgis/rest/services/Geocode/Geocode_Logradouros_WGS84/GeocodeServer"
 
 
 async def get_ipp_street_code(parameters: dict) -> dict:
@@ -35,23 +61,20 @@ async def get_ipp_street_code(parameters: dict) -> dict:
             break
 
     logger.info(f"Logradouro IPP: {logradouro_ipp}")
-    if (jaro_similarity(logradouro_google, logradouro_ipp) > THRESHOLD) and parameters[
-        "logradouro_bairro_ipp"
-    ] != " ":
-        logger.info(
-            f"Similaridade alta o suficiente: {jaro_similarity(logradouro_google, logradouro_ipp)}"
-        )
+    similaridade_logradouro = jaro_similarity(logradouro_google, logradouro_ipp)
+    if (similaridade_logradouro > THRESHOLD) and parameters["logradouro_bairro_ipp"] != " ":
+        logger.info(f"Similaridade alta o suficiente: {similaridade_logradouro}")
         geocode_logradouro_ipp_url = str(
-            "https://pgeo3.rio.rj.gov.br/arcgis/rest/services/Geocode/Geocode_Logradouros_WGS84/GeocodeServer/findAddressCandidates?"
+            get_ipp_geocode_url("findAddressCandidates")
             + f"Address={logradouro_completo}&Address2=&Address3=&Neighborhood=&City=&Subregion=&Region=&Postal=&PostalExt=&CountryCode=&SingleLine=&outFields=cl"
             + "&maxLocations=&matchOutOfRange=true&langCode=&locationType=&sourceCountry=&category=&location=&searchExtent=&outSR=&magicKey=&preferredLabelValues=&f=pjson"
         )
         logger.info(f"Geocode IPP URL: {geocode_logradouro_ipp_url}")
         return parameters
     else:
-        if jaro_similarity(logradouro_google, logradouro_ipp) < THRESHOLD:
+        if similaridade_logradouro < THRESHOLD:
             logger.info(
-                f"logradouro_nome retornado pelo Google significantemente diferente do retornado pelo IPP. Threshold: {jaro_similarity(logradouro_google, logradouro_ipp)}"
+                f"logradouro_nome retornado pelo Google significantemente diferente do retornado pelo IPP. Threshold: {similaridade_logradouro}"
             )
             if parameters["logradouro_bairro_ipp"] == " ":
                 logger.info(
@@ -68,62 +91,84 @@ async def get_ipp_street_code(parameters: dict) -> dict:
             logradouro_completo = f'{logradouro_ipp}, {parameters.get("logradouro_bairro", parameters["logradouro_bairro_ipp"])}'
         # Call IPP api
         geocode_logradouro_ipp_url = str(
-            "https://pgeo3.rio.rj.gov.br/arcgis/rest/services/Geocode/Geocode_Logradouros_WGS84/GeocodeServer/findAddressCandidates?"
+            get_ipp_geocode_url("findAddressCandidates")
             + f"Address={logradouro_completo}&Address2=&Address3=&Neighborhood=&City=&Subregion=&Region=&Postal=&PostalExt=&CountryCode=&SingleLine=&outFields=cl"
             + "&maxLocations=&matchOutOfRange=true&langCode=&locationType=&sourceCountry=&category=&location=&searchExtent=&outSR=&magicKey=&preferredLabelValues=&f=pjson"
         )
-        logger.info(f"Geocode IPP URL: {geocode_logradouro_ipp_url}")
+        # Usa o gazetteer local do IPP e só chama a API caso ele não encontre candidatos no bairro
+        # ou, sem bairro, perto do ponto retornado pelo Google
+        data = None
+        gazetteer = get_ipp_gazetteer(config.IPP_GAZETTEER_PATH)
+        if gazetteer is not None:
+            if parameters["logradouro_bairro_ipp"] == " ":
+                local_candidates = gazetteer.find_address_candidates(
+                    logradouro_completo,
+                    lat=parameters["logradouro_latitude"],
+                    lng=parameters["logradouro_longitude"],
+                )
+            else:
+                local_candidates = gazetteer.find_address_candidates(logradouro_completo)
+            logger.info(
+                f"Gazetteer IPP versão {gazetteer.version}: {len(local_candidates)} candidatos"
+            )
+            if local_candidates:
+                data = {"candidates": local_candidates}
+
+        if data is None:
+            logger.info(f"Geocode IPP URL: {geocode_logradouro_ipp_url}")
+
+            session = get_session(geocode_logradouro_ipp_url)
+
+            async def find_address_candidates() -> dict:
+                async with session.request(
+                    "GET",
+                    geocode_logradouro_ipp_url,
+                    timeout=upstream_timeout(),
+                ) as response:
+                    return await response.json(content_type="text/plain")
 
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                "GET",
-                geocode_logradouro_ipp_url,
-            ) as response:
-                data = await response.json(content_type="text/plain")
+            async def call() -> dict:
+                async with circuit_breaker("ipp"):
+                    return await hedged("ipp", find_address_candidates)
+
+            data = await single_flight("ipp", geocode_logradouro_ipp_url, call)
         try:
             candidates = list(data["candidates"])
             logradouro_codigo = None
             logradouro_real = None
 
             if parameters["logradouro_bairro_ipp"] == " ":
-                best_distance = 1000000000
                 logger.info(
                     f'Não foi identificado um bairro, então o logradouro escolhido vai ser o mais próximo do lat/long retornado pelo Google, que é lat:{parameters["logradouro_latitude"]} long:{parameters["logradouro_longitude"]}'
                 )
-                for candidato in candidates:
-                    distance = haversine_distance(
-                        parameters["logradouro_latitude"],
-                        parameters["logradouro_longitude"],
-                        candidato["location"]["y"],
-                        candidato["location"]["x"],
+                ranking = rank_ipp_candidates(
+                    candidates,
+                    lat=parameters["logradouro_latitude"],
+                    lng=parameters["logradouro_longitude"],
+                    k=IPP_RANKING_TOP_K,
+                )
+                for candidato, distance in ranking:
+                    logger.info(
+                        f'Logradouro próximo encontrado: {candidato["address"]} com distância de {distance}'
                     )
-                    if (
-                        distance < best_distance and "," in candidato["address"]
-                    ):  # Só considera logradouros com bairro
-                        logger.info(
-                            f'Logradouro mais próximo encontrado: {candidato["address"]} com distância de {distance}'
-                        )
-                        best_distance = distance
-                        logradouro_codigo = candidato["attributes"]["cl"]
-                        logradouro_real = candidato["address"]
+                if ranking:
+                    logradouro_codigo = ranking[0][0]["attributes"]["cl"]
+                    logradouro_real = ranking[0][0]["address"]
                 logger.info(
-                    f"Logradouro no IPP com maior semelhança: {logradouro_real}, cl: {logradouro_codigo}, distância: {best_distance} metros"
+                    f"Logradouro no IPP com maior semelhança: {logradouro_real}, cl: {logradouro_codigo}, distância: {ranking[0][1] if ranking else None} metros"
                 )
             else:
-                best_similarity = 0
                 logger.info(
                     "Já existe um bairro, então o logradouro vai ser selecionado de acordo similaridade de texto"
                 )
-                for candidato in candidates:
-                    similarity = jaro_similarity(candidato["address"], logradouro_completo)
-                    if (
-                        similarity > best_similarity and "," in candidato["address"]
-                    ):  # Só considera logradouros com bairro
-                        best_similarity = similarity
-                        logradouro_codigo = candidato["attributes"]["cl"]
-                        logradouro_real = candidato["address"]
+                ranking = rank_ipp_candidates(
+                    candidates, reference=logradouro_completo, k=IPP_RANKING_TOP_K
+                )
+                if ranking:
+                    logradouro_codigo = ranking[0][0]["attributes"]["cl"]
+                    logradouro_real = ranking[0][0]["address"]
                 logger.info(
-                    f"Logradouro no IPP com maior semelhança: {logradouro_real}, cl: {logradouro_codigo}, semelhança: {best_similarity}"
+                    f"Logradouro no IPP com maior semelhança: {logradouro_real}, cl: {logradouro_codigo}, semelhança: {ranking[0][1] if ranking else 0}"
                 )
             logger.info(
                 f"Logradouro encontrado no Google, com bairro do IPP: {logradouro_completo}"
@@ -137,12 +182,12 @@ async def get_ipp_street_code(parameters: dict) -> dict:
                 logger.info("Logradouro no IPP com maior semelhança não possui bairro no nome")
                 parameters["logradouro_bairro_ipp"] = None
 
-            if (
-                jaro_similarity(best_candidate_bairro_nome_ipp, parameters["logradouro_bairro_ipp"])
-                > THRESHOLD
-            ):
+            similaridade_bairro = jaro_similarity(
+                best_candidate_bairro_nome_ipp, parameters["logradouro_bairro_ipp"]
+            )
+            if similaridade_bairro > THRESHOLD:
                 logger.info(
-                    f"Similaridade entre bairro atual e bairro do Logradouro no IPP com maior semelhança é alta o suficiente: {jaro_similarity(best_candidate_bairro_nome_ipp, parameters['logradouro_bairro_ipp'])}"
+                    f"Similaridade entre bairro atual e bairro do Logradouro no IPP com maior semelhança é alta o suficiente: {similaridade_bairro}"
                 )
                 return parameters
             else:
@@ -152,28 +197,15 @@ async def get_ipp_street_code(parameters: dict) -> dict:
                 logger.info(
                     f'Bairro obtido anteriormente com geolocalização: {parameters["logradouro_bairro_ipp"]}'
                 )
-                url = get_integrations_url("neighborhood_id")
-
-                payload = json.dumps({"name": best_candidate_bairro_nome_ipp})
-
-                key = config.CHATBOT_INTEGRATIONS_KEY
-
-                headers = {
-                    "Content-Type": "application/json",
-                    "Authorization": f"Bearer {key}",
-                }
-
-                async with aiohttp.ClientSession() as session:
-                    async with session.request(
-                        "POST", url, headers=headers, data=payload
-                    ) as response:
-                        response_json = await response.json(content_type=None)
-                        parameters["logradouro_id_bairro_ipp"] = response_json["id"]
-                        parameters["logradouro_bairro_ipp"] = response_json["name"]
+                neighborhood = await get_ipp_neighborhood(best_candidate_bairro_nome_ipp)
+                parameters["logradouro_id_bairro_ipp"] = neighborhood["id"]
+                parameters["logradouro_bairro_ipp"] = neighborhood["name"]
 
                 logger.info(
                     f'Bairro obtido agora com busca por similaridade: {parameters["logradouro_bairro_ipp"]}'
                 )
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            raise
         except:  # noqa: E722
             logger.info("Correspondência não exata entre endereço no Google e no IPP")
             return parameters
@@ -202,35 +234,203 @@ def fix_unicode(text: str) -> str:
     return regex.sub(replace, text)
 
 
-async def get_credentials_from_env() -> service_account.Credentials:
+def same_json_value(a: Any, b: Any) -> bool:
+    """
+    Compares two decoded JSON values. Unlike `==`, values of different types are never equal,
+    so that e.g. `1` and `True` or `1` and `1.0` count as a change.
     """
-    Gets credentials from env vars
+    if type(a) is not type(b):
+        return False
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(same_json_value(a[key], b[key]) for key in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(same_json_value(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def parameters_delta(before: dict, after: dict) -> dict:
     """
-    info: dict = json.loads(base64.b64decode(config.GCP_SERVICE_ACCOUNT))
-    return service_account.Credentials.from_service_account_info(info)
+    Returns the session parameters that a webhook changed. Dialogflow CX merges the returned
+    parameters into the session, so only new or changed keys need to be sent back, and keys
+    that were removed are sent as `None`.
 
+    Exemplos:
+    >>> parameters_delta({"a": 1, "b": 2, "c": 3}, {"a": 1, "b": True, "d": 4})
+    {'b': True, 'd': 4, 'c': None}
+    """
+    delta = {
+        key: value
+        for key, value in after.items()
+        if key not in before or not same_json_value(before[key], value)
+    }
+    for key, value in before.items():
+        if key not in after and value is not None:
+            delta[key] = None
+    return delta
+
+
+class SharedCredentials(Credentials):
+    """
+    Credentials that hold a single access token for the whole process. Every client built with
+    the same instance reuses that token instead of fetching its own.
+    """
+
+    def __init__(self, source: service_account.Credentials):
+        super().__init__()
+        self._source = source
+        self._lock = threading.Lock()
+
+    def refresh(self, request: AuthRequest) -> None:
+        with self._lock:
+            self._source.refresh(request)
+            self.token = self._source.token
+            self.expiry = self._source.expiry
+
+
+_credentials: SharedCredentials = None
+_credentials_lock = asyncio.Lock()
+_credentials_refresh_task: asyncio.Task = None
+
+
+async def refresh_credentials_periodically(credentials: SharedCredentials) -> None:
+    """
+    Keeps the access token valid, refreshing it some time before it expires so that no request
+    has to wait for a token fetch.
+    """
+    while True:
+        delay = (credentials.expiry - datetime.utcnow()).total_seconds()
+        await asyncio.sleep(max(delay - config.GCP_TOKEN_REFRESH_MARGIN, 10))
+        try:
+            await asyncio.to_thread(credentials.refresh, AuthRequest())
+            logger.info(f"Refreshed GCP access token, expires at {credentials.expiry}")
+        except Exception as exc:  # noqa
+            logger.exception(f"Failed to refresh GCP access token: {exc}")
+
+
+async def get_credentials_from_env() -> SharedCredentials:
+    """
+    Gets credentials from env vars. They are decoded and authorized once per process, and the
+    access token is refreshed in the background from then on.
+    """
+    global _credentials, _credentials_refresh_task
+    if _credentials is not None:
+        return _credentials
+    async with _credentials_lock:
+        if _credentials is None:
+            info: dict = json.loads(base64.b64decode(config.GCP_SERVICE_ACCOUNT))
+            source = service_account.Credentials.from_service_account_info(info, scopes=GCP_SCOPES)
+            credentials = SharedCredentials(source)
+            await asyncio.to_thread(credentials.refresh, AuthRequest())
+            _credentials_refresh_task = asyncio.create_task(
+                refresh_credentials_periodically(credentials)
+            )
+            _credentials = credentials
+    return _credentials
+
+
+async def close_credentials() -> None:
+    """
+    Stops refreshing the process credentials.
+    """
+    global _credentials, _credentials_refresh_task
+    if _credentials_refresh_task is not None:
+        _credentials_refresh_task.cancel()
+    _credentials = None
+    _credentials_refresh_task = None
+
+
+ipp_reverse_geocode_cache = TTLCache(
+    "ipp_reverse_geocode", maxsize=config.IPP_CACHE_MAXSIZE, ttl=config.IPP_CACHE_TTL
+)
+IPP_REVERSE_GEOCODE_FIELDS = ["CL", "COD_Bairro", "ShortLabel", "Neighborhood"]
+
+
+def spatial_bucket(lat: float, lng: float, decimals: int = None) -> Tuple[float, float]:
+    """
+    Snaps a lat/lng pair to a grid cell by rounding both coordinates. With 4 decimals the cells
+    are about 11 meters wide.
+
+    Exemplos:
+    >>> spatial_bucket("-22.90684", -43.172896, decimals=4)
+    (-22.9068, -43.1729)
+    """
+    if decimals is None:
+        decimals = config.IPP_CACHE_GRID_DECIMALS
+    return round(float(lat), decimals), round(float(lng), decimals)
+
+
+async def ipp_reverse_geocode(lat: float, lng: float) -> dict:
+    """
+    Calls the IPP `reverseGeocode` service. Successful answers are cached by grid cell, since
+    nearby coordinates resolve to the same street and neighborhood. If the service fails, an
+    expired entry of the cell is served instead.
+
+    Returns:
+        dict: The service response. On cache hits only the `address` fields used by
+            `get_ipp_info` are present.
+    """
+    key = spatial_bucket(lat, lng)
+    address = ipp_reverse_geocode_cache.get(key)
+    hit_ratio = ipp_reverse_geocode_cache.hit_ratio
+    if address is not None:
+        logger.info(f"IPP reverseGeocode cache hit for {key}. Hit ratio: {hit_ratio:.2f}")
+        return {"address": address}
+    logger.info(f"IPP reverseGeocode cache miss for {key}. Hit ratio: {hit_ratio:.2f}")
 
-async def get_ipp_info(parameters: dict) -> bool:
     geocode_ipp_url = str(
-        "https://pgeo3.rio.rj.gov.br/arcgis/rest/services/Geocode/Geocode_Logradouros_WGS84/GeocodeServer/reverseGeocode?"  # noqa
-        + f'location={parameters["logradouro_longitude"]}%2C{parameters["logradouro_latitude"]}'
+        get_ipp_geocode_url("reverseGeocode")
+        + f"location={lng}%2C{lat}"
         + "&langCode=&locationType=&featureTypes=&outSR=&preferredLabelValues=&f=pjson"
     )
 
     logger.info(f"Geocode IPP URL: {geocode_ipp_url}")
 
-    async with aiohttp.ClientSession() as session:
+    session = get_session(geocode_ipp_url)
+
+    async def reverse_geocode() -> dict:
         async with session.request(
             "GET",
             geocode_ipp_url,
+            timeout=upstream_timeout(),
         ) as response:
-            data = await response.json(content_type="text/plain")
+            return await response.json(content_type="text/plain")
+
+    async def call() -> dict:
+        async with circuit_breaker("ipp"):
+            return await hedged("ipp", reverse_geocode)
+
+    try:
+        # Coordinates in the same cell resolve to the same answer, so their lookups are shared
+        data = await single_flight("ipp", ("reverseGeocode", key), call)
+    except Exception:
+        address = ipp_reverse_geocode_cache.get_stale(key)
+        if address is None:
+            raise
+        logger.warning(f"IPP reverseGeocode failed, serving stale cache entry for {key}")
+        return {"address": address}
+
+    address = data.get("address") if isinstance(data, dict) else None
+    if isinstance(address, dict) and all(field in address for field in IPP_REVERSE_GEOCODE_FIELDS):
+        ipp_reverse_geocode_cache.set(
+            key, {field: address[field] for field in IPP_REVERSE_GEOCODE_FIELDS}
+        )
+    return data
+
+
+async def get_ipp_info(parameters: dict) -> bool:
+    data = await ipp_reverse_geocode(
+        parameters["logradouro_latitude"], parameters["logradouro_longitude"]
+    )
 
     try:
         parameters["logradouro_id_ipp"] = str(data["address"]["CL"])
         parameters["logradouro_id_bairro_ipp"] = str(data["address"]["COD_Bairro"])
         parameters["logradouro_nome_ipp"] = str(data["address"]["ShortLabel"])
         parameters["logradouro_bairro_ipp"] = str(data["address"]["Neighborhood"])
+        if parameters["logradouro_id_bairro_ipp"] != "0":
+            neighborhood_resolver.learn(
+                parameters["logradouro_id_bairro_ipp"], parameters["logradouro_bairro_ipp"]
+            )
 
         logger.info(f'Codigo bairro IPP obtido: {parameters["logradouro_id_bairro_ipp"]}')
         logger.info(f'Nome bairro IPP obtido: {parameters["logradouro_bairro_ipp"]}')
@@ -295,6 +495,8 @@ async def get_ipp_info(parameters: dict) -> bool:
         parameters = await get_ipp_street_code(parameters)
 
         return True
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        raise
     except:  # noqa
         logger.info(
             "Erro em alguma das funções: (get_ipp_street_code, get_integrations_url(`neighborhood_id`)"
@@ -318,6 +520,56 @@ def get_integrations_url(endpoint: str) -> str:
     return f"{base_url}/{endpoint}"
 
 
+def get_ipp_geocode_url(operation: str) -> str:
+    """
+    Returns the URL of an operation of the IPP geocoding service, ready for the query string.
+    """
+    return f"{config.PGEO3_URL.rstrip('/')}{IPP_GEOCODE_SERVER_PATH}/{operation}?"
+
+
+async def get_ipp_neighborhood(name: str) -> dict:
+    """
+    Returns the IPP neighborhood (`{"id", "name"}`) that best matches a name. The local table
+    is tried first and the `neighborhood_id` endpoint is only called for unknown names, whose
+    answers are then added to the table.
+    """
+    neighborhood = neighborhood_resolver.lookup(name)
+    if neighborhood is not None:
+        logger.info(f"Bairro {name} encontrado na tabela local: {neighborhood}")
+        return neighborhood
+
+    url = get_integrations_url("neighborhood_id")
+    payload = json.dumps({"name": name})
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {config.CHATBOT_INTEGRATIONS_KEY}",
+    }
+    session = get_session(url)
+    async with circuit_breaker("integrations"):
+        async with session.request(
+            "POST", url, headers=headers, data=payload, timeout=upstream_timeout()
+        ) as response:
+            response_json = await response.json(content_type=None)
+    neighborhood_resolver.learn(response_json["id"], response_json["name"])
+    return {"id": response_json["id"], "name": response_json["name"]}
+
+
+async def integrations_lookup(url: str, payload: dict, headers: dict) -> Any:
+    """
+    Posts a lookup to a chatbot-integrations endpoint and returns the decoded answer.
+
+    Raises:
+        aiohttp.ClientResponseError: If the endpoint answers with an error status.
+    """
+    session = get_session(url)
+    async with circuit_breaker("integrations"):
+        async with session.request(
+            "POST", url, headers=headers, data=json.dumps(payload), timeout=upstream_timeout()
+        ) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+
 async def get_user_info(cpf: str) -> dict:
     """
     Returns user info from CPF.
@@ -345,32 +597,156 @@ async def get_user_info(cpf: str) -> dict:
         "Authorization": f"Bearer {key}",
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                "POST", url, headers=headers, data=json.dumps(payload)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json(content_type=None)
-        return data
+        return await single_flight(
+            "integrations/person", cpf, lambda: integrations_lookup(url, payload, headers)
+        )
+    except asyncio.TimeoutError:
+        raise
     except Exception as exc:  # noqa
         logger.error(exc)
         raise Exception(f"Failed to get user info: {exc}") from exc
 
 
+geocode_cache = TTLCache(
+    "geocode", maxsize=config.GEOCODE_CACHE_MAXSIZE, ttl=config.GEOCODE_CACHE_TTL
+)
+_geocode_store: SQLiteStore = None
+
+
+def get_geocode_store() -> Optional[SQLiteStore]:
+    """
+    Returns the persistent store behind the geocoding cache, if `GEOCODE_CACHE_PATH` is set.
+    """
+    global _geocode_store
+    if _geocode_store is None and config.GEOCODE_CACHE_PATH:
+        _geocode_store = SQLiteStore(config.GEOCODE_CACHE_PATH, "geocode")
+    return _geocode_store
+
+
+def close_geocode_store() -> None:
+    global _geocode_store
+    if _geocode_store is not None:
+        _geocode_store.close()
+        _geocode_store = None
+
+
+def normalize_address(address: str) -> str:
+    """
+    Normalizes an address so that different spellings of the same input share a cache entry.
+
+    Exemplos:
+    >>> normalize_address("  Rua Conde de Bonfim ,Rio de Janeiro - RJ")
+    'rua conde de bonfim, rio de janeiro - rj'
+    """
+    address = unidecode(address).lower()
+    address = re.sub(r"\s*,\s*", ", ", address)
+    return re.sub(r"\s+", " ", address).strip()
+
+
+async def google_maps_request(service: str, params: dict) -> dict:
+    """
+    Calls a Google Maps web service (e.g. `geocode`) on `GMAPS_URL`.
+
+    Args:
+        service (str): Service path under `/maps/api`, e.g. `geocode` or
+            `place/findplacefromtext`.
+        params (dict): Query parameters, without the API key.
+
+    Returns:
+        dict: The decoded response, whose `status` is either `OK` or `ZERO_RESULTS`.
+
+    Raises:
+        Exception: If the service answers with any other status.
+    """
+    url = f"{config.GMAPS_URL.rstrip('/')}/maps/api/{service}/json"
+    session = get_session(url)
+    async with circuit_breaker("google_maps"):
+        async with session.get(
+            url, params={**params, "key": config.GMAPS_API_TOKEN}, timeout=upstream_timeout()
+        ) as response:
+            response.raise_for_status()
+            data = await response.json(content_type=None)
+        if data.get("status") not in ("OK", "ZERO_RESULTS"):
+            raise Exception(
+                f"Google Maps {service} failed: {data.get('status')} {data.get('error_message', '')}"
+            )
+    return data
+
+
+async def cached_google_maps_call(key: str, call: Callable[[], Awaitable]) -> list:
+    """
+    Returns the cached Google Maps result for `key`, calling the API only on cache misses and
+    sharing the call between concurrent misses. Empty results are not cached. Cached results
+    are shared, so they must not be mutated. If the API fails, an expired result is served
+    instead.
+    """
+    result = geocode_cache.get(key)
+    store = get_geocode_store()
+    if result is None and store is not None:
+        result = await asyncio.to_thread(store.get, key)
+        if result is not None:
+            geocode_cache.set(key, result)
+    if result is not None:
+        logger.info(f"Geocode cache hit for '{key}'. Hit ratio: {geocode_cache.hit_ratio:.2f}")
+        return result
+
+    logger.info(f"Geocode cache miss for '{key}'. Hit ratio: {geocode_cache.hit_ratio:.2f}")
+
+    async def call_and_cache() -> list:
+        result = await call()
+        if result:
+            geocode_cache.set(key, result)
+            if store is not None:
+                await asyncio.to_thread(store.set, key, result, config.GEOCODE_CACHE_TTL)
+        return result
+
+    try:
+        return await single_flight("google_maps", key, call_and_cache)
+    except Exception:
+        result = geocode_cache.get_stale(key)
+        if result is None:
+            raise
+        logger.warning(f"Google Maps failed, serving stale geocode cache entry for '{key}'")
+        return result
+
+
+async def google_geocode(address: str) -> list:
+    """
+    Geocodes an address with Google Maps, going through the geocoding cache.
+    """
+
+    async def call() -> list:
+        return (await google_maps_request("geocode", {"address": address}))["results"]
+
+    return await cached_google_maps_call(f"geocode:{normalize_address(address)}", call)
+
+
+async def google_reverse_geocode(lat: float, lng: float) -> list:
+    """
+    Reverse geocodes a lat/lng pair with Google Maps, going through the geocoding cache.
+    """
+
+    async def call() -> list:
+        return (await google_maps_request("geocode", {"latlng": f"{lat},{lng}"}))["results"]
+
+    return await cached_google_maps_call(f"reverse_geocode:{float(lat):.6f},{float(lng):.6f}", call)
+
+
 async def google_find_place(address: str, parameters: dict) -> bool:
     """
     Uses Google Maps API to get the formatted address using find_place and then call
     google_geolocator function
     """
-    async with aiohttp.ClientSession() as maps_session:
-        client = AsyncClient(maps_session, key=config.GMAPS_API_TOKEN)
-        find_place_result = await client.find_place(
-            address,
-            "textquery",
-            fields=["formatted_address", "name"],
-            location_bias="rectangle:-22.74744540190159, -43.098580713057416|-23.100575987851833, -43.79779077663037",  # noqa
-            language="pt",
-        )
+    find_place_result = await google_maps_request(
+        "place/findplacefromtext",
+        {
+            "input": address,
+            "inputtype": "textquery",
+            "fields": "formatted_address,name",
+            "locationbias": "rectangle:-22.74744540190159, -43.098580713057416|-23.100575987851833, -43.79779077663037",  # noqa
+            "language": "pt",
+        },
+    )
 
     if find_place_result["status"] == "OK":
         parameters["logradouro_ponto_referencia_identificado"] = find_place_result["candidates"][0][
@@ -414,9 +790,7 @@ async def google_geolocator(address: str, parameters: dict) -> bool:
         "point_of_interest",
     ]
 
-    async with aiohttp.ClientSession() as maps_session:
-        client = AsyncClient(maps_session, key=config.GMAPS_API_TOKEN)
-        geocode_result = await client.geocode(address)
+    geocode_result = await google_geocode(address)
 
     logger.info("GEOCODE RESULT ABAIXO")
     logger.info(geocode_result)
@@ -433,9 +807,7 @@ async def google_geolocator(address: str, parameters: dict) -> bool:
         logger.info("no geocode result")
         lat = geocode_result[0]["geometry"]["location"]["lat"]
         lng = geocode_result[0]["geometry"]["location"]["lng"]
-        async with aiohttp.ClientSession() as maps_session:
-            client = AsyncClient(maps_session, key=config.GMAPS_API_TOKEN)
-            geocode_result = await client.reverse_geocode((lat, lng))
+        geocode_result = await google_reverse_geocode(lat, lng)
 
     # Ache o primeiro resultado que possui o nome do logradouro
     nome_logradouro_encontrado = False
@@ -504,24 +876,13 @@ async def google_geolocator(address: str, parameters: dict) -> bool:
             return False
     else:
         logger.info("Não foi identificado um município para esse endereço")
-        t0 = time.time()
-        shape_rj = gpd.read_file(Path(__file__).parent.parent.parent / "shape_rj.geojson").iloc[0][
-            "geometry"
-        ]
-        point = Point(
-            float(parameters["logradouro_longitude"]),
+        if not is_inside_rio(
             float(parameters["logradouro_latitude"]),
-        )
-        if not shape_rj.contains(point):
+            float(parameters["logradouro_longitude"]),
+        ):
             logger.info("O endereço identificado está fora do Rio de Janeiro")
-            logger.info(
-                f"Demorou {int(time.time() - t0)} segundos para checar se o ponto está no shape"
-            )
             parameters["logradouro_fora_do_rj"] = True
             return False
-        logger.info(
-            f"Demorou {int(time.time() - t0)} segundos para checar se o ponto está no shape. E está."
-        )
 
     # VERSÃO PONTO DE REFERÊNCIA EQUIVALENTE A NÚMERO #
     # # Caso já tenha sido identificado que existe numero de logradouro no endereço retornado pelo find_place, mas
@@ -622,15 +983,21 @@ async def new_ticket(
         ValueError: If any of the arguments is invalid.
     """
     try:
-        new_ticket: NewTicket = await async_sgrc_new_ticket(
-            classification_code=classification_code,
-            description=description,
-            address=address,
-            date_time=date_time,
-            requester=requester,
-            occurrence_origin_code=occurrence_origin_code,
-            specific_attributes=specific_attributes,
-        )
+        async with circuit_breaker("sgrc", ignore=SGRC_TICKET_ERRORS), track_upstream(
+            "sgrc", "new_ticket"
+        ):
+            # The SGRC client takes no timeout, so it is cancelled when the deadline passes
+            new_ticket: NewTicket = await within_deadline(
+                async_sgrc_new_ticket(
+                    classification_code=classification_code,
+                    description=description,
+                    address=address,
+                    date_time=date_time,
+                    requester=requester,
+                    occurrence_origin_code=occurrence_origin_code,
+                    specific_attributes=specific_attributes,
+                )
+            )
         await send_discord_message(
             message=(
                 "Novo chamado criado:\n"
@@ -641,9 +1008,22 @@ async def new_ticket(
         )
         return new_ticket
     except Exception as exc:  # noqa
+        # The tags handle SGRC errors themselves, so count them here
+        record_error(exc)
         raise exc
 
 
+# SGRC errors caused by the ticket itself, which do not count against the service
+SGRC_TICKET_ERRORS = (
+    SGRCBusinessRuleException,
+    SGRCDuplicateTicketException,
+    SGRCEquivalentTicketException,
+    SGRCInvalidBodyException,
+    SGRCMalformedBodyException,
+    ValueError,
+)
+
+
 async def send_discord_message(message: str, webhook_url: str) -> bool:
     """
     Envia uma mensagem para um canal do Discord através de um webhook.
@@ -659,12 +1039,12 @@ async def send_discord_message(message: str, webhook_url: str) -> bool:
     """
     try:
         data = {"content": message}
-        async with aiohttp.ClientSession() as session:
-            async with session.post(webhook_url, json=data) as response:
-                if response.status == 204:
-                    return True
-                else:
-                    return False
+        session = get_session(webhook_url)
+        async with session.post(webhook_url, json=data, timeout=upstream_timeout()) as response:
+            if response.status == 204:
+                return True
+            else:
+                return False
     except Exception as e:
         logger.error(f"Erro ao enviar mensagem para o Discord: {e}")
         return False
@@ -821,6 +1201,8 @@ async def internal_request(
     url: str,
     method: str = "GET",
     request_kwargs: dict = {},
+    upstream: str = "integrations/request",
+    attempt: int = 1,
 ) -> aiohttp.ClientResponse:
     """
     Uses chatbot-integrations for making requests through the internal network.
@@ -829,6 +1211,9 @@ async def internal_request(
         url (str): The URL to be requested.
         method (str, optional): The HTTP method. Defaults to "GET".
         request_kwargs (dict, optional): The request kwargs. Defaults to {}.
+        upstream (str, optional): Name of the final upstream in metrics and traces. Defaults
+            to "integrations/request".
+        attempt (int, optional): Attempt number, for retries. Defaults to 1.
 
     Returns:
         aiohttp.ClientResponse: The response object.
@@ -846,43 +1231,118 @@ async def internal_request(
         "Content-Type": "application/json",
         "Authorization": f"Bearer {key}",
     }
-    async with aiohttp.ClientSession() as session:
+    session = get_session(integrations_url)
+    # Requests proxied to PGM get a breaker of their own, apart from the proxy's
+    async with circuit_breaker(upstream.split("/")[0]):
         async with session.request(
-            "POST", integrations_url, headers=headers, data=payload
+            "POST",
+            integrations_url,
+            headers=headers,
+            data=payload,
+            timeout=upstream_timeout(),
+            trace_request_ctx={"upstream": upstream, "attempt": attempt},
         ) as response:
             return await response.json(content_type=None)
 
 
-async def pgm_api(endpoint: str = "", data: dict = {}) -> dict:
-    # Pegando o token de autenticação
-    auth_response = await internal_request(
-        url=config.CHATBOT_PGM_API_URL + "/security/token",
-        method="POST",
-        request_kwargs={
-            "verify": False,
-            "headers": {},
-            "data": {
-                "grant_type": "password",
-                "Consumidor": "chatbot",
-                "ChaveAcesso": config.CHATBOT_PGM_ACCESS_KEY,
+_pgm_token: Dict[str, Any] = {"value": None, "expires_at": 0.0}
+_pgm_token_refresh: asyncio.Future = None
+
+
+async def fetch_pgm_token() -> str:
+    """
+    Requests a new PGM access token and stores it until shortly before it expires.
+    """
+    # The refresh is shared by concurrent requests, so it does not follow any one's deadline
+    with without_deadline():
+        auth_response = await internal_request(
+            url=config.CHATBOT_PGM_API_URL + "/security/token",
+            method="POST",
+            upstream="pgm",
+            request_kwargs={
+                "verify": False,
+                "headers": {},
+                "data": {
+                    "grant_type": "password",
+                    "Consumidor": "chatbot",
+                    "ChaveAcesso": config.CHATBOT_PGM_ACCESS_KEY,
+                },
             },
-        },
-    )
+        )
     if "access_token" not in auth_response:
         raise Exception("Failed to get PGM access token")
-    token = f'Bearer {auth_response["access_token"]}'
+    expires_in = float(auth_response.get("expires_in", config.PGM_TOKEN_DEFAULT_EXPIRES_IN))
+    _pgm_token["value"] = f'Bearer {auth_response["access_token"]}'
+    _pgm_token["expires_at"] = time.monotonic() + expires_in - config.PGM_TOKEN_EXPIRY_MARGIN
     logger.info("Token de autenticação obtido com sucesso")
+    return _pgm_token["value"]
+
+
+def _clear_pgm_token_refresh(future: asyncio.Future) -> None:
+    global _pgm_token_refresh
+    _pgm_token_refresh = None
+    if not future.cancelled():
+        future.exception()
+
+
+async def get_pgm_token(force_refresh: bool = False) -> str:
+    """
+    Returns the cached PGM access token, refreshing it when it is about to expire. Concurrent
+    callers share a single in-flight refresh.
+
+    Args:
+        force_refresh (bool, optional): Ignore the cached token. Defaults to False.
+
+    Returns:
+        str: The `Authorization` header value.
+    """
+    global _pgm_token_refresh
+    if not force_refresh and time.monotonic() < _pgm_token["expires_at"]:
+        return _pgm_token["value"]
+    if _pgm_token_refresh is None:
+        _pgm_token_refresh = asyncio.ensure_future(fetch_pgm_token())
+        _pgm_token_refresh.add_done_callback(_clear_pgm_token_refresh)
+    return await within_deadline(asyncio.shield(_pgm_token_refresh))
+
+
+def is_pgm_unauthorized(response: Any) -> bool:
+    """
+    Checks whether a PGM response proxied by `internal_request` was rejected for an invalid
+    or expired token. The proxy does not forward status codes, so we look at the body.
+    """
+    if not isinstance(response, dict) or "success" in response:
+        return False
+    if response.get("status_code") == 401 or response.get("status") == 401:
+        return True
+    return "authorization has been denied" in str(response.get("Message", "")).lower()
+
+
+async def pgm_api(endpoint: str = "", data: dict = {}) -> dict:
+    # Pegando o token de autenticação
+    token = await get_pgm_token()
 
     # Fazer uma solicitação POST
+    request_kwargs = {
+        "verify": False,
+        "headers": {"Authorization": token},
+        "data": data,
+    }
     response = await internal_request(
         url=config.CHATBOT_PGM_API_URL + f"/{endpoint}",
         method="POST",
-        request_kwargs={
-            "verify": False,
-            "headers": {"Authorization": token},
-            "data": data,
-        },
+        request_kwargs=request_kwargs,
+        upstream="pgm",
     )
+    if is_pgm_unauthorized(response):
+        logger.info("Token de autenticação recusado, obtendo um novo")
+        request_kwargs["headers"]["Authorization"] = await get_pgm_token(force_refresh=True)
+        response = await internal_request(
+            url=config.CHATBOT_PGM_API_URL + f"/{endpoint}",
+            method="POST",
+            request_kwargs=request_kwargs,
+            upstream="pgm",
+            attempt=2,
+        )
 
     # Imprimir o conteúdo das respostas
     logger.info("Resposta da solicitação POST:")
@@ -933,18 +1393,72 @@ async def get_user_protocols(person_id: str) -> dict:
         "Authorization": f"Bearer {key}",
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                "POST", url, headers=headers, data=json.dumps(payload)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json(content_type=None)
-        return data
+        return await single_flight(
+            "integrations/protocols",
+            str(person_id),
+            lambda: integrations_lookup(url, payload, headers),
+        )
+    except asyncio.TimeoutError:
+        raise
     except Exception as exc:  # noqa
         logger.error(exc)
         raise Exception(f"Failed to get user protocols: {exc}") from exc
 
 
+citizen_profile_cache = TTLCache(
+    "citizen_profile",
+    maxsize=config.CITIZEN_PROFILE_CACHE_MAXSIZE,
+    ttl=config.CITIZEN_PROFILE_CACHE_TTL,
+)
+
+
+def get_citizen_profile(request_data: dict, cpf: str) -> dict:
+    """
+    Returns the lookups of a CPF made earlier in the conversation (Dialogflow session) of a
+    webhook request, under `user_info` and `user_protocols`. A conversation keeps the profile
+    of a single CPF: the profile starts empty on the first lookup, after it expires or when the
+    CPF changes. Requests without a session get an empty profile that is not kept.
+    """
+    session = request_data.get("sessionInfo", {}).get("session")
+    profile = citizen_profile_cache.get(session) if session else None
+    if profile is None or profile["cpf"] != cpf:
+        profile = {"cpf": cpf}
+        if session:
+            citizen_profile_cache.set(session, profile)
+    return profile
+
+
+def forget_citizen_profile(request_data: dict) -> None:
+    """
+    Drops the citizen profile of the conversation of a webhook request, e.g. once a ticket is
+    opened and the protocols in it are outdated.
+    """
+    session = request_data.get("sessionInfo", {}).get("session")
+    if session:
+        citizen_profile_cache.delete(session)
+
+
+async def get_session_user_info(request_data: dict, cpf: str) -> dict:
+    """
+    Returns user info from CPF (see `get_user_info`), looked up once per conversation.
+    """
+    profile = get_citizen_profile(request_data, cpf)
+    if "user_info" not in profile:
+        profile["user_info"] = await get_user_info(cpf)
+    return profile["user_info"]
+
+
+async def get_session_user_protocols(request_data: dict, cpf: str, person_id: str) -> dict:
+    """
+    Returns user protocols from person_id (see `get_user_protocols`), looked up once per
+    conversation.
+    """
+    profile = get_citizen_profile(request_data, cpf)
+    if "user_protocols" not in profile:
+        profile["user_protocols"] = await get_user_protocols(person_id)
+    return profile["user_protocols"]
+
+
 async def rebi_combinacoes_permitidas(combinação_usuario: list) -> tuple[bool, str, list]:
     COMBINACOES_VALIDAS = [
         [6, 0, 0],
@@ -1007,38 +1521,6 @@ async def rebi_combinacoes_permitidas(combinação_usuario: list) -> tuple[bool,
         return False, justificativa, [0, 0, 0]
 
 
-def haversine_distance(lat1, lon1, lat2, lon2):
-    # Converte strings para floats, se necessário
-    lat1 = float(lat1) if isinstance(lat1, str) else lat1
-    lon1 = float(lon1) if isinstance(lon1, str) else lon1
-    lat2 = float(lat2) if isinstance(lat2, str) else lat2
-    lon2 = float(lon2) if isinstance(lon2, str) else lon2
-
-    # Raio médio da Terra em quilômetros
-    R = 6371.0
-
-    # Converte as coordenadas de graus para radianos
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-
-    # Diferenças entre as coordenadas
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-
-    # Fórmula de Haversine
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
-    # Distância em quilômetros
-    distance_km = R * c
-
-    # Distância em metros
-    distance_m = distance_km * 1000
-    return distance_m
-
-
 async def get_address_protocols(address_data: dict) -> dict:
     """
     Returns user protocols from person_id.
@@ -1086,13 +1568,13 @@ async def get_address_protocols(address_data: dict) -> dict:
         "Authorization": f"Bearer {key}",
     }
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                "POST", url, headers=headers, data=json.dumps(payload)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json(content_type=None)
-        return data
+        return await single_flight(
+            "integrations/address_protocols",
+            json.dumps(payload, sort_keys=True),
+            lambda: integrations_lookup(url, payload, headers),
+        )
+    except asyncio.TimeoutError:
+        raise
     except Exception as exc:  # noqa
         logger.error(exc)
         raise Exception(f"Failed to get address protocols: {exc}") from exc
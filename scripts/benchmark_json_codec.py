@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the JSON codecs available to the routers on webhook payloads. Recorded payloads (e.g.
+request bodies saved from the logs) can be passed as files; without them a synthetic Dialogflow
+CX webhook request with large REBI and Dívida Ativa session parameters is used.
+"""
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+from timeit import repeat
+
+from chatbot_webhooks.webhooks.codec import CODECS
+
+
+def synthetic_payload(items: int) -> bytes:
+    parameters = {
+        "usuario_cpf": "529.982.247-25",
+        "usuario_email": "cidadao@exemplo.com.br",
+        "usuario_nome_cadastrado": "José da Silva Conceição",
+        "logradouro_nome": "Rua Conde de Bonfim",
+        "logradouro_bairro_ipp": "Tijuca",
+        "rebi_material_nome_informado": [f"geladeira {i}" for i in range(items)],
+        "rebi_material_quantidade_informada": list(range(items)),
+        "dicionario_itens": {
+            str(i): {"cda": f"{i:012d}", "valor": i * 10.5, "exercicio": 2020 + i % 4}
+            for i in range(items)
+        },
+        "lista_cdas": [f"{i:012d}" for i in range(items)],
+    }
+    body = {
+        "detectIntentResponseId": "2a1b6f2e-3c4d-4e5f-8a9b-0c1d2e3f4a5b",
+        "fulfillmentInfo": {"tag": "rebi_avaliador_combinacoes_itens"},
+        "sessionInfo": {
+            "session": "projects/p/locations/global/agents/a/sessions/s",
+            "parameters": parameters,
+        },
+        "text": "quero descartar uma geladeira e um sofá",
+        "languageCode": "pt-br",
+    }
+    return json.dumps(body).encode("utf-8")
+
+
+def report(name: str, timings: list, number: int) -> None:
+    best = min(timings) / number
+    print(f"{name:<40} {best * 1e6:>12.2f} us/call")
+
+
+def run(payloads: dict, number: int) -> None:
+    for payload_name, payload in payloads.items():
+        print(f"{payload_name} ({len(payload) / 1024:.1f} KiB)")
+        encoded = {codec.dumps(codec.loads(payload)) for codec in CODECS.values()}
+        if len(encoded) > 1:
+            print("  warning: the codecs encode this payload to different bytes")
+        for codec_name, codec in CODECS.items():
+            obj = codec.loads(payload)
+            timings = repeat(lambda: codec.loads(payload), number=number, repeat=5)
+            report(f"  {codec_name}.loads", timings, number)
+            timings = repeat(lambda: codec.dumps(obj), number=number, repeat=5)
+            report(f"  {codec_name}.dumps", timings, number)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("payloads", nargs="*", type=Path, help="Recorded JSON request bodies")
+    parser.add_argument("--items", type=int, default=200, help="List size of the synthetic body")
+    parser.add_argument("--number", type=int, default=1000)
+    args = parser.parse_args()
+    if args.payloads:
+        payloads = {path.name: path.read_bytes() for path in args.payloads}
+    else:
+        payloads = {"synthetic": synthetic_payload(args.items)}
+    run(payloads, args.number)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the cost of checking whether a point is inside the city of Rio de Janeiro by reading
+`shape_rj.geojson` on every call (the old request path) against `is_inside_rio`.
+"""
+from argparse import ArgumentParser
+from timeit import repeat
+
+import numpy as np
+
+from chatbot_webhooks.webhooks.geo import SHAPE_RJ_PATH, is_inside_rio, load_shape_rj
+
+# Bounding box around the city, with some margin so that part of the points fall outside
+LAT_RANGE = (-23.10, -22.72)
+LNG_RANGE = (-43.85, -43.05)
+
+
+def read_file_contains(lat: float, lng: float) -> bool:
+    import geopandas as gpd
+    from shapely.geometry import Point
+
+    shape_rj = gpd.read_file(SHAPE_RJ_PATH).iloc[0]["geometry"]
+    return shape_rj.contains(Point(lng, lat))
+
+
+def report(name: str, timings: list, number: int) -> None:
+    best = min(timings) / number
+    print(f"{name:<40} {best * 1e6:>12.2f} us/call")
+
+
+def run(points: int, number: int, skip_read_file: bool):
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(*LAT_RANGE, size=points)
+    lngs = rng.uniform(*LNG_RANGE, size=points)
+    lat, lng = float(lats[0]), float(lngs[0])
+
+    timings = repeat(lambda: load_shape_rj(), number=1, repeat=1)
+    report("load_shape_rj (once, at startup)", timings, 1)
+    if not skip_read_file:
+        timings = repeat(
+            lambda: read_file_contains(lat, lng), number=max(number // 100, 1), repeat=3
+        )
+        report("gpd.read_file + contains (per call)", timings, max(number // 100, 1))
+    timings = repeat(lambda: is_inside_rio(lat, lng), number=number, repeat=5)
+    report("is_inside_rio (single point)", timings, number)
+    timings = repeat(lambda: is_inside_rio(lats, lngs), number=10, repeat=5)
+    report(f"is_inside_rio ({points} points, per point)", timings, 10 * points)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--points", type=int, default=10000)
+    parser.add_argument("--number", type=int, default=1000)
+    parser.add_argument("--skip-read-file", action="store_true")
+    args = parser.parse_args()
+    run(args.points, args.number, args.skip_read_file)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Builds the IPP gazetteer data file (see `IPP_GAZETTEER_PATH`) from a GeoJSON export of the IPP
+streets layer, with one feature per street segment.
+"""
+import gzip
+import json
+from argparse import ArgumentParser
+from datetime import date
+from typing import List, Tuple
+
+
+def representative_point(geometry: dict) -> Tuple[float, float]:
+    """
+    Returns the middle vertex of a (Multi)LineString, or the coordinates of a Point, as
+    (lat, lng).
+    """
+    if geometry["type"] == "Point":
+        vertices = [geometry["coordinates"]]
+    elif geometry["type"] == "LineString":
+        vertices = geometry["coordinates"]
+    elif geometry["type"] == "MultiLineString":
+        vertices = [vertex for line in geometry["coordinates"] for vertex in line]
+    else:
+        raise ValueError(f"Unsupported geometry type: {geometry['type']}")
+    lng, lat = vertices[len(vertices) // 2][:2]
+    return lat, lng
+
+
+def run(
+    input_path: str,
+    output_path: str,
+    version: str,
+    cl_field: str,
+    name_field: str,
+    neighborhood_field: str,
+):
+    with open(input_path, "r", encoding="utf-8") as f:
+        features = json.load(f)["features"]
+
+    streets: List[list] = []
+    seen = set()
+    for feature in features:
+        properties = feature["properties"]
+        if not feature.get("geometry") or properties.get(cl_field) is None:
+            continue
+        key = (str(properties[cl_field]), properties.get(neighborhood_field) or "")
+        if key in seen:
+            continue
+        seen.add(key)
+        lat, lng = representative_point(feature["geometry"])
+        streets.append([key[0], properties[name_field], key[1], round(lat, 6), round(lng, 6)])
+
+    opener = gzip.open if output_path.endswith(".gz") else open
+    with opener(output_path, "wt", encoding="utf-8") as f:
+        json.dump({"version": version, "streets": streets}, f, ensure_ascii=False)
+    print(f"Wrote {len(streets)} streets to {output_path} (version {version})")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--version", type=str, default=date.today().isoformat())
+    parser.add_argument("--cl-field", type=str, default="cl")
+    parser.add_argument("--name-field", type=str, default="completo")
+    parser.add_argument("--neighborhood-field", type=str, default="bairro")
+    args = parser.parse_args()
+    run(
+        args.input,
+        args.output,
+        args.version,
+        args.cl_field,
+        args.name_field,
+        args.neighborhood_field,
+    )
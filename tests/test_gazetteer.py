@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from pathlib import Path
+
+from chatbot_webhooks.webhooks.gazetteer import IPPGazetteer, rank_ipp_candidates
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+class IPPGazetteerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.gazetteer = IPPGazetteer.from_file(FIXTURES / "ipp_gazetteer.json")
+        with open(FIXTURES / "ipp_find_address_candidates.json", encoding="utf-8") as f:
+            cls.cases = json.load(f)
+
+    def test_picks_the_same_street_as_the_upstream(self):
+        # Like `get_ipp_street_code`: by similarity to the address, or by distance to the point
+        # returned by Google when the neighborhood is not known
+        for case in self.cases:
+            with self.subTest(address=case["address"]):
+                point = {"lat": case["lat"], "lng": case["lng"]} if "lat" in case else {}
+                local = self.gazetteer.find_address_candidates(case["address"], **point)
+                expected = rank_ipp_candidates(
+                    case["upstream"]["candidates"], case["address"], **point
+                )
+                found = rank_ipp_candidates(local, case["address"], **point)
+                self.assertEqual(
+                    (found[0][0]["address"], found[0][0]["attributes"]["cl"]),
+                    (expected[0][0]["address"], expected[0][0]["attributes"]["cl"]),
+                )
+
+    def test_streets_in_the_neighborhood_come_first(self):
+        streets = self.gazetteer.search("Rua Sao Jose", neighborhood="Vila Isabel", limit=1)
+        self.assertEqual([street.neighborhood for street, _ in streets], ["Vila Isabel"])
+        candidates = self.gazetteer.find_address_candidates("Av. Pres. Vargas, Cidade Nova")
+        self.assertEqual(candidates[0]["address"], "Avenida Presidente Vargas, Cidade Nova")
+
+    def test_ties_at_the_limit_are_kept(self):
+        streets = self.gazetteer.search("Rua São José", limit=20)
+        self.assertEqual(len(streets), 24)
+        self.assertEqual(len(self.gazetteer.search("Rua Conde de Bonfim", limit=1)), 1)
+
+    def test_nearest_streets(self):
+        streets = self.gazetteer.nearest(-22.917, -43.229, limit=2)
+        self.assertEqual(
+            [(street.name, street.neighborhood) for street, _ in streets],
+            [("Rua São José", "Madureira"), ("Rua Conde de Bonfim", "Tijuca")],
+        )
+        self.assertLess(streets[0][1], streets[1][1])
+        streets = self.gazetteer.nearest(-22.917, -43.229, name="R. Conde de Bonfim")
+        self.assertEqual([street.cl for street, _ in streets], ["60456"])
+        streets = self.gazetteer.nearest(-22.917, -43.229, name="Rua Dona Mariana", max_rings=2)
+        self.assertEqual(streets, [])
+
+    def test_no_candidates_without_a_street_in_the_neighborhood(self):
+        self.assertEqual(self.gazetteer.find_address_candidates("Rua Dona Mariana, Tijuca"), [])
+        self.assertEqual(len(self.gazetteer.find_address_candidates("Rua Dona Mariana, ")), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
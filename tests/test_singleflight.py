@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from chatbot_webhooks.webhooks.breaker import (
+    BREAKERS,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    circuit_breaker,
+)
+from chatbot_webhooks.webhooks.deadline import (
+    DeadlineExceeded,
+    deadline,
+    within_deadline,
+)
+from chatbot_webhooks.webhooks.singleflight import _flights, single_flight
+
+
+class SingleFlightTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        BREAKERS.clear()
+        BREAKERS["test"] = CircuitBreaker("test", failure_threshold=5, recovery_timeout=30)
+        _flights.clear()
+        self.calls = 0
+
+    async def lookup(self, seconds: float, answer: str = "ok") -> str:
+        """
+        Stands for an upstream that answers after `seconds`, behind its circuit breaker.
+        """
+        self.calls += 1
+        async with circuit_breaker("test"):
+            await within_deadline(asyncio.sleep(seconds))
+        return answer
+
+    async def test_identical_lookups_share_one_call(self):
+        answers = await asyncio.gather(
+            *(single_flight("test", "key", lambda: self.lookup(0.05)) for _ in range(10))
+        )
+        self.assertEqual(answers, ["ok"] * 10)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(_flights, {})
+
+    async def test_errors_are_shared(self):
+        async def fail():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("upstream error")
+
+        results = await asyncio.gather(
+            *(single_flight("test", "key", fail) for _ in range(3)), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(self.calls, 1)
+
+    async def test_hung_upstream_opens_the_breaker(self):
+        for _ in range(5):
+            with deadline(0.05), self.assertRaises(asyncio.TimeoutError):
+                await single_flight("test", "key", lambda: self.lookup(3600))
+            # Lets the lookup left behind time out on its own
+            await asyncio.sleep(0.01)
+        self.assertEqual(BREAKERS["test"].state, OPEN)
+        with deadline(0.05), self.assertRaises(CircuitOpenError):
+            await single_flight("test", "key", lambda: self.lookup(3600))
+
+    async def test_lookup_lasts_until_the_latest_deadline(self):
+        async def wait(seconds: float, delay: float = 0):
+            await asyncio.sleep(delay)
+            with deadline(seconds):
+                return await single_flight("test", "key", lambda: self.lookup(0.2))
+
+        early, late = await asyncio.gather(wait(0.05), wait(1, 0.01), return_exceptions=True)
+        self.assertIsInstance(early, DeadlineExceeded)
+        self.assertEqual(late, "ok")
+        # The lookup timed out with the earlier deadline and was made again for the later one
+        self.assertEqual(self.calls, 2)
+
+    async def test_abandoned_lookup_is_cancelled(self):
+        cancelled = asyncio.Event()
+
+        async def hang():
+            try:
+                await asyncio.sleep(3600)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        waiter = asyncio.ensure_future(single_flight("test", "key", hang))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        self.assertEqual(_flights, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import unittest
+
+try:
+    from benchmarks import tags as harness
+except (ImportError, OSError) as exc:
+    # The routers load the service settings, which need the dev environment (e.g. Infisical)
+    raise unittest.SkipTest(f"Service settings are not available: {exc}")
+
+from benchmarks import simulator, upstreams
+from chatbot_webhooks.webhooks import clients, utils
+
+
+async def slow_sgrc_new_ticket(**kwargs):
+    await asyncio.sleep(6)
+    return await upstreams.fake_sgrc_new_ticket(**kwargs)
+
+
+class WebhookTimeoutTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.runner, base_url = await simulator.start("instant")
+        harness.point_upstreams_at(base_url)
+        harness.reset_state()
+        self.app = harness.build_app()
+
+    async def asyncTearDown(self):
+        utils.async_sgrc_new_ticket = upstreams.fake_sgrc_new_ticket
+        await clients.close_sessions()
+        await self.runner.cleanup()
+
+    async def test_slow_sgrc_hands_over_without_saying_the_ticket_failed(self):
+        utils.async_sgrc_new_ticket = slow_sgrc_new_ticket
+        body = harness.load_fixtures("abrir_chamado_sgrc_1647")["abrir_chamado_sgrc_1647"]
+        status, content = await harness.post(self.app, "/webhook/", body)
+        self.assertEqual(status, 200)
+        parameters = json.loads(content)["sessionInfo"]["parameters"]
+        self.assertEqual(parameters["solicitacao_retorno"], "erro_timeout")
+        self.assertIs(parameters["encaminhar_transbordo_agora"], True)
+        self.assertIsNone(parameters["solicitacao_criada"])
+
+
+if __name__ == "__main__":
+    unittest.main()